@@ -0,0 +1,390 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import engine
+import gamelog
+from bitboard import BAD, GOOD, SIZE, SQUARE_RC, square
+from common import constants
+
+# 欄位式資料目錄：每個欄位一個 little-endian 原始陣列檔 (<欄位>.col)，以 np.memmap 讀取
+# meta.json 記錄局數與各 segment 已轉換到的位置，names.json 為暱稱表 (player1/player2 欄位是索引)
+TABLE_VERSION = 1
+COLUMN_SUFFIX = ".col"
+# 每累積這麼多局就寫出一次，轉換時記憶體用量與總局數無關
+CHUNK_GAMES = 200_000
+
+# 每局一列；captured_*N 為玩家 N 吃掉的對手好鬼/壞鬼數，move_start 為該局在 moves 欄位的起點
+GAME_COLUMNS = {
+    "started_at": "<f8",
+    "duration": "<f4",
+    "first_player": "u1",
+    "winner": "u1",
+    "reason": "u1",
+    "plies": "<u2",
+    "setup1": "u1",
+    "setup2": "u1",
+    "player1": "<i4",
+    "player2": "<i4",
+    "captured_good1": "u1",
+    "captured_good2": "u1",
+    "captured_bad1": "u1",
+    "captured_bad2": "u1",
+    "move_start": "<i8",
+}
+# 所有對局的移動依序接在一起，每步沿用對局紀錄的 2 bytes 編碼
+MOVE_COLUMN = ("moves", "<u2")
+
+# 對局紀錄的固定標頭 (gamelog._RECORD_HEAD) 直接以 numpy 解析，不逐筆 unpack
+_HEAD_DTYPE = np.dtype(
+    [
+        ("room_id", ">u4"),
+        ("started_at", ">f8"),
+        ("duration_ms", ">u4"),
+        ("gid1", ">u4"),
+        ("gid2", ">u4"),
+        ("first_player", "u1"),
+        ("winner", "u1"),
+        ("reason", "u1"),
+        ("setup1", "u1"),
+        ("setup2", "u1"),
+        ("plies", ">u2"),
+    ]
+)
+
+# 棋盤上分出勝負的原因 (不含斷線)
+BOARD_REASONS = (
+    constants.WIN_REASON_CAPTURE_ALL_GOOD,
+    constants.WIN_REASON_LOSE_ALL_BAD,
+    constants.WIN_REASON_ESCAPE,
+)
+REASON_NAMES = {
+    constants.WIN_REASON_CAPTURE_ALL_GOOD: "吃光好鬼",
+    constants.WIN_REASON_LOSE_ALL_BAD: "壞鬼被吃光",
+    constants.WIN_REASON_ESCAPE: "好鬼逃脫",
+    constants.WIN_REASON_DISCONNECT: "斷線",
+    constants.WIN_REASON_TIMEOUT: "超時",
+}
+
+
+def _rotation_table():
+    # 玩家 1 的佈局轉 180 度換成玩家 2 的格子順序，兩邊的佈局都以自己的視角 (前排在前) 比較
+    index2 = {sq: i for i, sq in enumerate(engine.SETUP_SQUARES[2])}
+    perm = []
+    for sq in engine.SETUP_SQUARES[1]:
+        r, c = SQUARE_RC[sq]
+        perm.append(index2[square(SIZE - 1 - r, SIZE - 1 - c)])
+    table = np.zeros(256, dtype=np.uint8)
+    for value in range(256):
+        table[value] = sum(1 << perm[i] for i in range(8) if value >> i & 1)
+    return table
+
+
+ROTATE_SETUP1 = _rotation_table()
+
+
+def setup_diagram(value):
+    # 以玩家 2 格子順序表示的佈局 -> "前排/後排"，G 為好鬼、B 為壞鬼
+    cells = "".join("G" if value >> i & 1 else "B" for i in range(8))
+    return f"{cells[:4]}/{cells[4:]}"
+
+
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _dump_json(path, data):
+    # 先寫暫存檔再改名，轉換中途中斷也不會留下寫一半的 meta
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class TableBuilder:
+    # 把對局紀錄轉成欄位檔；只讀上次轉換後新附加的紀錄
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta = _load_json(
+            os.path.join(directory, "meta.json"),
+            {"version": TABLE_VERSION, "games": 0, "moves": 0, "segments": {}},
+        )
+        if self.meta["version"] != TABLE_VERSION:
+            raise ValueError(f"{directory} 的欄位格式版本不符，請刪除後重新轉換")
+        self.names = _load_json(os.path.join(directory, "names.json"), [])
+        self.name_ids = {name: i for i, name in enumerate(self.names)}
+        self._truncate()
+        self._reset_chunk()
+
+    def _column_path(self, name):
+        return os.path.join(self.directory, name + COLUMN_SUFFIX)
+
+    def _truncate(self):
+        # 上次轉換若在寫完 meta 前中斷，欄位檔尾端會多出未記錄的資料，先截掉
+        sizes = {name: self.meta["games"] for name in GAME_COLUMNS}
+        sizes[MOVE_COLUMN[0]] = self.meta["moves"]
+        dtypes = dict(GAME_COLUMNS, **{MOVE_COLUMN[0]: MOVE_COLUMN[1]})
+        for name, count in sizes.items():
+            path = self._column_path(name)
+            with open(path, "ab") as f:
+                f.truncate(count * np.dtype(dtypes[name]).itemsize)
+
+    def _reset_chunk(self):
+        self.heads = []
+        self.moves = []
+        self.players = []
+
+    def _name_id(self, name):
+        index = self.name_ids.get(name)
+        if index is None:
+            index = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def add(self, body):
+        # 一筆對局紀錄的內容 (gamelog.read_frames 讀出的 bytes)
+        head, nick1, nick2, moves = gamelog.split_record(body)
+        self.heads.append(head)
+        self.players.append((self._name_id(nick1), self._name_id(nick2)))
+        self.moves.append(moves)
+        if len(self.heads) >= CHUNK_GAMES:
+            self.flush()
+
+    def flush(self):
+        # 把目前累積的對局轉成欄位並附加到檔案
+        count = len(self.heads)
+        if not count:
+            return
+        heads = np.frombuffer(b"".join(self.heads), dtype=_HEAD_DTYPE)
+        moves = np.frombuffer(b"".join(self.moves), dtype=">u2").astype("<u2")
+        players = np.array(self.players, dtype="<i4").reshape(count, 2)
+        plies = heads["plies"].astype(np.int64)
+        starts = np.cumsum(plies) - plies
+
+        # 每一步屬於哪一局、由誰走：先手走偶數步，後手走奇數步
+        game_of_move = np.repeat(np.arange(count), plies)
+        first = heads["first_player"][game_of_move]
+        ply = np.arange(len(moves)) - starts[game_of_move]
+        mover = np.where(ply % 2 == 0, first, 3 - first)
+        captured = moves >> 8 & 3
+
+        columns = {
+            "started_at": heads["started_at"],
+            "duration": heads["duration_ms"] / 1000,
+            "first_player": heads["first_player"],
+            "winner": heads["winner"],
+            "reason": heads["reason"],
+            "plies": plies,
+            "setup1": heads["setup1"],
+            "setup2": heads["setup2"],
+            "player1": players[:, 0],
+            "player2": players[:, 1],
+            "move_start": starts + self.meta["moves"],
+        }
+        for pid in (1, 2):
+            for kind, ghost in (("good", GOOD), ("bad", BAD)):
+                code = gamelog.CAPTURE_CODES[ghost]
+                hits = game_of_move[(mover == pid) & (captured == code)]
+                columns[f"captured_{kind}{pid}"] = np.bincount(hits, minlength=count)
+        for name, dtype in GAME_COLUMNS.items():
+            with open(self._column_path(name), "ab") as f:
+                np.asarray(columns[name], dtype=dtype).tofile(f)
+        with open(self._column_path(MOVE_COLUMN[0]), "ab") as f:
+            moves.tofile(f)
+        self.meta["games"] += count
+        self.meta["moves"] += len(moves)
+        self._reset_chunk()
+
+    def update(self, log_directory, prefix=gamelog.DEFAULT_PREFIX, on_progress=None):
+        # 轉換 log_directory 下尚未轉換的對局，回傳新增的局數
+        before = self.meta["games"]
+        segments = self.meta["segments"]
+        for path in gamelog.list_segments(log_directory, prefix):
+            name = os.path.basename(path)
+            offset = segments.get(name, 0)
+            for offset, body in gamelog.read_frames(path, offset):
+                self.add(body)
+            self.flush()
+            segments[name] = offset
+            self.save()
+            if on_progress:
+                on_progress(name, self.meta["games"])
+        return self.meta["games"] - before
+
+    def save(self):
+        _dump_json(os.path.join(self.directory, "names.json"), self.names)
+        _dump_json(os.path.join(self.directory, "meta.json"), self.meta)
+
+
+class GameTable:
+    # 以 memmap 開啟的欄位資料，報表只讀用到的欄位
+    def __init__(self, directory):
+        self.directory = directory
+        self.meta = _load_json(os.path.join(directory, "meta.json"), None)
+        if self.meta is None:
+            raise FileNotFoundError(f"{directory} 沒有轉換好的對局資料")
+        self.games = self.meta["games"]
+        self._columns = {}
+        self._names = None
+
+    def __len__(self):
+        return self.games
+
+    def __getitem__(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            if name == MOVE_COLUMN[0]:
+                dtype, count = MOVE_COLUMN[1], self.meta["moves"]
+            else:
+                dtype, count = GAME_COLUMNS[name], self.games
+            path = os.path.join(self.directory, name + COLUMN_SUFFIX)
+            if count:
+                column = np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+            else:
+                column = np.zeros(0, dtype=dtype)
+            self._columns[name] = column
+        return column
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = _load_json(os.path.join(self.directory, "names.json"), [])
+        return self._names
+
+    def decided(self):
+        # 在棋盤上分出勝負的對局 (不含斷線與伺服器關閉)
+        codes = [gamelog.REASON_CODES[reason] for reason in BOARD_REASONS]
+        return np.isin(self["reason"], codes)
+
+
+def _rate(wins, games):
+    return np.divide(wins, games, out=np.zeros(len(games)), where=games > 0)
+
+
+def first_mover_report(table):
+    # 依勝負原因統計先手勝率：[(原因, 局數, 先手勝場)]，最後一列為合計
+    mask = table.decided()
+    reason = table["reason"][mask]
+    first_won = table["winner"][mask] == table["first_player"][mask]
+    size = len(gamelog.REASONS)
+    games = np.bincount(reason, minlength=size)
+    wins = np.bincount(reason, weights=first_won, minlength=size).astype(np.int64)
+    rows = []
+    for r in BOARD_REASONS:
+        code = gamelog.REASON_CODES[r]
+        rows.append((r, int(games[code]), int(wins[code])))
+    rows.append((None, int(games.sum()), int(wins.sum())))
+    return rows
+
+
+def length_report(table, bucket=20, max_plies=400):
+    # 依對局長度 (步數區間) 統計各勝負原因的局數：(區間起點 array, 局數矩陣 [區間, 原因代碼])
+    plies = table["plies"]
+    reason = table["reason"]
+    mask = reason > 0
+    nbuckets = max_plies // bucket + 1
+    index = np.minimum(plies[mask] // bucket, nbuckets - 1).astype(np.int64)
+    size = len(gamelog.REASONS)
+    counts = np.bincount(index * size + reason[mask], minlength=nbuckets * size)
+    counts = counts.reshape(nbuckets, size)
+    used = np.flatnonzero(counts.sum(axis=1))
+    return np.arange(nbuckets)[used] * bucket, counts[used]
+
+
+def setup_report(table, min_games=100, top=20):
+    # 依佈局統計勝率 (雙方佈局都以自己的視角比較)：[(佈局, 局數, 勝場)]，依勝率排序
+    mask = table.decided()
+    winner = table["winner"][mask]
+    setups = np.concatenate([ROTATE_SETUP1[table["setup1"][mask]], table["setup2"][mask]])
+    won = np.concatenate([winner == 1, winner == 2])
+    games = np.bincount(setups, minlength=256)
+    wins = np.bincount(setups, weights=won, minlength=256)
+    candidates = np.flatnonzero(games >= min_games)
+    rate = _rate(wins[candidates], games[candidates])
+    order = candidates[np.lexsort((-games[candidates], -rate))][:top]
+    return [(int(s), int(games[s]), int(wins[s])) for s in order]
+
+
+def player_report(table, min_games=20, top=20):
+    # 依暱稱統計勝率 (含斷線判負)：[(暱稱, 局數, 勝場)]，依勝率排序
+    mask = table["winner"] > 0
+    winner = table["winner"][mask]
+    players = np.concatenate([table["player1"][mask], table["player2"][mask]])
+    won = np.concatenate([winner == 1, winner == 2])
+    size = len(table.names)
+    games = np.bincount(players, minlength=size)
+    wins = np.bincount(players, weights=won, minlength=size)
+    candidates = np.flatnonzero(games >= min_games)
+    rate = _rate(wins[candidates], games[candidates])
+    order = candidates[np.lexsort((-games[candidates], -rate))][:top]
+    return [(table.names[p], int(games[p]), int(wins[p])) for p in order]
+
+
+def _percent(part, whole):
+    return f"{100 * part / whole:5.1f}%" if whole else "    -"
+
+
+def print_reports(table, which, bucket, min_games, top):
+    print(f"共 {len(table):,} 局")
+    if "first" in which:
+        print("\n先手勝率 (只計入棋盤上分出勝負的對局)")
+        for reason, games, wins in first_mover_report(table):
+            label = REASON_NAMES[reason] if reason else "合計"
+            print(f"  {label:<8} {games:>12,} 局  先手勝 {_percent(wins, games)}")
+    if "length" in which:
+        starts, counts = length_report(table, bucket)
+        reasons = BOARD_REASONS + (constants.WIN_REASON_DISCONNECT, constants.WIN_REASON_TIMEOUT)
+        print(f"\n各長度的勝負原因 (每 {bucket} 步一個區間)")
+        print("  步數        局數  " + "  ".join(f"{REASON_NAMES[r]:>6}" for r in reasons))
+        for start, row in zip(starts, counts):
+            total = row.sum()
+            cells = "  ".join(f"{_percent(row[gamelog.REASON_CODES[r]], total):>6}" for r in reasons)
+            print(f"  {start:>4}+ {total:>10,}  {cells}")
+    if "setups" in which:
+        print(f"\n勝率最高的佈局 (前排/後排，G 好鬼 B 壞鬼，至少 {min_games} 局)")
+        for setup, games, wins in setup_report(table, min_games, top):
+            print(f"  {setup_diagram(setup)} {games:>12,} 局  勝率 {_percent(wins, games)}")
+    if "players" in which:
+        print(f"\n勝率最高的玩家 (至少 {min_games} 局)")
+        for name, games, wins in player_report(table, min_games, top):
+            print(f"  {name:<16} {games:>10,} 局  勝率 {_percent(wins, games)}")
+
+
+REPORTS = ["first", "length", "setups", "players"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="對局紀錄的欄位式統計")
+    parser.add_argument("table", help="欄位資料目錄")
+    parser.add_argument("--import", dest="log_dir", help="先把此目錄下新增的對局紀錄轉入欄位資料")
+    parser.add_argument("--prefix", default=gamelog.DEFAULT_PREFIX)
+    parser.add_argument("--report", choices=REPORTS, action="append", help="可重複指定，預設全部")
+    parser.add_argument("--bucket", type=int, default=20, help="對局長度區間寬度 (步)")
+    parser.add_argument("--min-games", type=int, default=100, help="佈局與玩家排名的最少局數")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.log_dir:
+        start = time.perf_counter()
+        builder = TableBuilder(args.table)
+
+        def progress(segment, games):
+            elapsed = time.perf_counter() - start
+            print(f"\r{segment}: 共 {games:,} 局  {elapsed:.1f}s", end="", flush=True)
+
+        added = builder.update(args.log_dir, args.prefix, progress)
+        print(f"\n新增 {added:,} 局 ({time.perf_counter() - start:.1f}s)")
+    start = time.perf_counter()
+    print_reports(GameTable(args.table), args.report or REPORTS, args.bucket, args.min_games, args.top)
+    print(f"\n統計耗時 {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
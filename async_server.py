@@ -0,0 +1,432 @@
+import asyncio
+import json
+import time
+
+import bot
+import metrics
+import timers
+from common import codec, constants, framing
+from matchmaking import (
+    DEFAULT_RATING,
+    IDENTIFY_TIMEOUT,
+    MATCH_INTERVAL,
+    MAX_LOBBY_FRAMES,
+    Matchmaker,
+    RatingBook,
+    identify,
+    is_pong,
+    resume_failed_frame,
+    watch_failed_frame,
+)
+from outbound import HIGH_WATERMARK, LOW_WATERMARK, MAX_QUEUED
+from room import DEFAULT_LIMITS, RESUME_GRACE, Room
+from server_log import get_logger
+from spectate import AsyncSpectatorHub, pick_room
+
+log = get_logger("server")
+
+# listen backlog，大量玩家同時登入時避免 SYN 被丟棄
+ACCEPT_BACKLOG = 4096
+
+
+class PlayerProtocol(asyncio.BufferedProtocol):
+    # 一條玩家連線：event loop 直接把資料讀進 FrameReader 的固定緩衝區 (recv_into)
+    # 同時提供 Room 使用的 socket 介面 (sendall/shutdown/close)
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.reader = framing.server_reader()
+        self.pid = None
+        self.room = None
+        self.player_id = None
+        self.frames = []  # 配對前收到的 frame，配對後交給房間
+        self.arrived_at = None
+        self.last_seen = None  # 配對前最後一次收到訊息的時間 (房間內由 Room 記錄)
+        self.watcher = None  # 觀戰中的連線 (spectate.Watcher)
+        self.paused = False  # transport 寫入緩衝超過高水位 (慢速連線)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # 寫入緩衝超過高水位時 pause_writing，降回低水位以下時 resume_writing
+        transport.set_write_buffer_limits(high=HIGH_WATERMARK, low=LOW_WATERMARK)
+        self.server.on_connect(self)
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        room = self.room
+        try:
+            frames = self.reader.consume(nbytes)
+        except framing.FrameError as e:
+            if room is None:
+                log.warning("等待中的玩家 %s 違反連線限制: %s", self.pid, e)
+            else:
+                room.on_violation(self.player_id, e)
+            self.transport.abort()
+            return
+        if self.watcher is not None:
+            # 觀戰者送來的訊息一律忽略
+            return
+        if room is None:
+            self.server.on_waiting_frames(self, frames)
+            return
+        for is_binary, payload in frames:
+            room.handle_frame(self.player_id, is_binary, payload)
+
+    def pause_writing(self):
+        self.paused = True
+        if self.watcher is None:
+            log.warning(
+                "玩家 %s 的送出緩衝達 %s bytes，標記為慢速連線。",
+                self.pid,
+                self.transport.get_write_buffer_size(),
+            )
+            metrics.SLOW_CONSUMERS.inc()
+
+    def resume_writing(self):
+        # 觀戰者的緩衝區送完了，直接補上最新狀態
+        self.paused = False
+        if self.watcher is not None:
+            self.server.spectators.pump(self.watcher)
+        else:
+            log.info("玩家 %s 的送出緩衝已降回 %s bytes 以下。", self.pid, LOW_WATERMARK)
+
+    def eof_received(self):
+        # 回傳 False 讓 transport 關閉連線，後續由 connection_lost 處理
+        return False
+
+    def connection_lost(self, exc):
+        self.server.on_connection_lost(self, exc)
+
+    def attach(self, room, player_id):
+        # 配對成功後把等待期間收到的訊息交給房間，之後的訊息直接由房間處理
+        self.room = room
+        self.player_id = player_id
+        frames, self.frames = self.frames, None
+        room.replay({player_id: frames})
+
+    def resume(self, room, player_id):
+        # 以 resume token 回到原本的房間，房間會送出完整狀態
+        self.room = room
+        self.player_id = player_id
+        frames, self.frames = self.frames, None
+        if not room.reattach(player_id, self, frames):
+            self.close()
+
+    def sendall(self, data):
+        # 寫入 transport 緩衝區，不會阻塞 event loop；緩衝超過上限的慢速連線直接中斷 (視同斷線)
+        if self.transport.is_closing():
+            raise ConnectionError("連線已關閉")
+        if self.transport.get_write_buffer_size() + len(data) > MAX_QUEUED:
+            log.warning("玩家 %s 的送出緩衝超過 %s bytes，中斷連線。", self.pid, MAX_QUEUED)
+            metrics.SLOW_CONSUMERS_DROPPED.inc()
+            self.transport.abort()
+            raise ConnectionError(f"送出緩衝超過 {MAX_QUEUED} bytes")
+        self.transport.write(data)
+
+    def shutdown(self, how):
+        # 房間判定為半開連線時呼叫：直接中斷，後續由 connection_lost 處理
+        self.transport.abort()
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncGhostChessServer:
+    def __init__(
+        self, host, port, resume_grace=RESUME_GRACE, bot_after=0, limits=DEFAULT_LIMITS
+    ):
+        # 單一 event loop 處理 accept、配對與所有房間的讀寫
+        # bot_after > 0 時等待逾時的玩家改與 AI 對戰；limits 為房間的時間限制
+        self.host = host
+        self.port = port
+        self.resume_grace = resume_grace
+        self.limits = limits
+        self.bot_after = bot_after
+        self.loop = None
+        self.server = None
+        self.clients = {}  # 儲存所有連線中的 client
+        self.next_player_id = 1
+        self.next_room_id = 1
+        self.matchmaker = Matchmaker()  # 等待配對的玩家連線 (PlayerProtocol)
+        self.arrivals = {}  # 還沒送出暱稱或 resume 的連線 (依到達順序)
+        self.ratings = RatingBook()
+        self.active_rooms = {}  # 活動中的房間
+        self.sessions = {}  # resume token -> (房間 ID, 房內玩家編號)
+        self.spectators = None  # AsyncSpectatorHub，event loop 啟動後建立
+        metrics.track_server(self)
+        metrics.SEND_QUEUE_BYTES.set_function(
+            lambda: sum(conn.transport.get_write_buffer_size() for conn in self.connections())
+        )
+        metrics.SLOW_CONNECTIONS.set_function(
+            lambda: sum(1 for conn in self.connections() if conn.paused)
+        )
+
+    def connections(self):
+        # 給 metrics 使用 (在 HTTP thread 讀取)：目前房間內與等待中的玩家連線
+        return [conn for conn in list(self.clients.values()) if conn.transport is not None]
+
+    def start(self):
+        # 啟動伺服器並執行 event loop 直到中斷
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        loop = self.loop = asyncio.get_running_loop()
+        # 時間輪的 callback 一律交回 event loop 執行，房間與配對都不需要另外加鎖
+        timers.start(loop.call_soon_threadsafe)
+        self.spectators = AsyncSpectatorHub(loop)
+        self.server = await loop.create_server(
+            lambda: PlayerProtocol(self),
+            self.host,
+            self.port,
+            reuse_address=True,
+            backlog=ACCEPT_BACKLOG,
+        )
+        log.info("伺服器已啟動於 %s:%s (asyncio 模式)，等待玩家連線...", self.host, self.port)
+        matcher = asyncio.create_task(self.match_loop())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            log.info("伺服器正在關閉...")
+        finally:
+            matcher.cancel()
+            timers.stop()
+            self.shutdown_server()
+
+    def on_connect(self, conn):
+        # 新連線等待表明身分 (暱稱或 resume token)，之後才加入配對隊伍
+        addr = conn.transport.get_extra_info("peername")
+        log.debug("來自 %s 的新連線。", addr)
+        conn.pid = self.next_player_id
+        self.next_player_id += 1
+        self.clients[conn.pid] = conn
+        conn.arrived_at = conn.last_seen = time.monotonic()
+        self.arrivals[conn.pid] = conn
+        if self.limits.idle > 0:
+            timers.schedule(self.limits.idle / 3, self.heartbeat, conn)
+        try:
+            # 通知 client 等待對手，實際配對由 match_loop 進行
+            conn.sendall(
+                json.dumps({"type": constants.MSG_TYPE_WAIT_OPPONENT}).encode("utf-8") + b"\n"
+            )
+        except Exception as e:
+            log.warning("向等待中的玩家 %s 發送消息失敗: %s", conn.pid, e)
+
+    def heartbeat(self, conn):
+        # 等待中的連線：閒置時送 ping，超過 idle 時限沒有任何訊息則中斷 (進入房間後改由房間檢查)
+        if conn.room is not None or conn.watcher is not None:
+            return
+        if self.clients.get(conn.pid) is not conn:
+            return
+        idle = time.monotonic() - conn.last_seen
+        if idle >= self.limits.idle:
+            log.info("等待中的玩家 %s 已 %.0f 秒沒有回應，中斷連線。", conn.pid, idle)
+            metrics.IDLE_DROPPED.inc()
+            conn.transport.abort()
+            return
+        if idle >= self.limits.idle / 3:
+            conn.transport.write(codec.encode_json({"type": constants.MSG_TYPE_PING}))
+        timers.schedule(self.limits.idle / 3, self.heartbeat, conn)
+
+    def on_waiting_frames(self, conn, frames):
+        # 等待中的玩家送來訊息：暫存給房間，收到暱稱時依 rating 加入配對，收到 resume 時回到原本的房間
+        conn.last_seen = time.monotonic()
+        frames = [frame for frame in frames if not is_pong(frame)]
+        conn.frames.extend(frames)
+        if len(conn.frames) > MAX_LOBBY_FRAMES:
+            log.warning("等待中的玩家 %s 傳送過多訊息。", conn.pid)
+            conn.transport.abort()
+            return
+        if conn.pid not in self.arrivals:
+            return
+        kind, value = identify(frames)
+        if kind == constants.MSG_TYPE_NICKNAME:
+            self.admit(conn, self.ratings.get(value))
+        elif kind == constants.MSG_TYPE_RESUME:
+            del self.arrivals[conn.pid]
+            self.resume_player(conn, value)
+        elif kind == constants.MSG_TYPE_WATCH:
+            del self.arrivals[conn.pid]
+            self.watch_room(conn, value)
+
+    def admit(self, conn, rating):
+        del self.arrivals[conn.pid]
+        self.matchmaker.enqueue(conn.pid, conn, rating)
+        log.debug("玩家 %s 加入匹配隊伍。等待人數: %s", conn.pid, len(self.matchmaker))
+
+    def resume_player(self, conn, token):
+        # 帶 resume token 的連線回到原本的房間；token 無效時告知後關閉
+        room_id, player_id = self.sessions.get(token, (None, None))
+        room = self.active_rooms.get(room_id)
+        if room is None:
+            log.info("玩家 %s 的 resume token 無效。", conn.pid)
+            conn.transport.write(resume_failed_frame())
+            conn.close()
+            return
+        # 連線改以原本的玩家 ID 記錄，舊連線由房間關閉
+        del self.clients[conn.pid]
+        conn.pid = room.global_ids[player_id]
+        self.clients[conn.pid] = conn
+        conn.resume(room, player_id)
+
+    def watch_room(self, conn, room_id):
+        # 觀戰的連線交給房間的 Audience，不算在 clients 裡
+        room = pick_room(self.active_rooms, room_id)
+        if room is None:
+            log.info("連線 %s 要觀戰的房間 %s 不存在。", conn.pid, room_id)
+            conn.transport.write(watch_failed_frame(list(self.active_rooms)))
+            conn.close()
+            return
+        del self.clients[conn.pid]
+        conn.frames = None
+        room.add_spectator(conn, self.spectators)
+
+    async def match_loop(self):
+        # 定期依 rating 配對，accept 不需等待配對；順便讓逾時未表明身分的連線加入
+        while True:
+            await asyncio.sleep(MATCH_INTERVAL)
+            now = time.monotonic()
+            while self.arrivals:
+                conn = next(iter(self.arrivals.values()))
+                if now - conn.arrived_at < IDENTIFY_TIMEOUT:
+                    break
+                self.admit(conn, DEFAULT_RATING)
+            for a, b in self.matchmaker.match():
+                self.create_room(a.player, b.player)
+            if self.bot_after:
+                for ticket in self.matchmaker.take_overdue(self.bot_after):
+                    self.create_bot_room(ticket.player)
+
+    def create_room(self, p1, p2):
+        # 配對成功的兩位玩家進入新房間
+        room_id = self.next_room_id
+        self.next_room_id += 1
+        log.info("匹配成功！玩家 %s 和玩家 %s 進入房間 %s", p1.pid, p2.pid, room_id)
+        room = Room(
+            room_id,
+            p1,
+            p1.pid,
+            p2,
+            p2.pid,
+            self,
+            resume_grace=self.resume_grace,
+            limits=self.limits,
+        )
+        self.active_rooms[room_id] = room
+        for player_id, token in room.tokens.items():
+            self.sessions[token] = (room_id, player_id)
+        room.begin()
+        p1.attach(room, 1)
+        p2.attach(room, 2)
+
+    def create_bot_room(self, conn):
+        # 等太久沒有對手：與 AI 對戰，AI 的走子由 pool 的 thread 交回 event loop
+        room_id = self.next_room_id
+        self.next_room_id += 1
+        bot_pid = self.next_player_id
+        self.next_player_id += 1
+        log.info("玩家 %s 等待逾時，與 AI 進入房間 %s", conn.pid, room_id)
+        seat = bot.BotSeat(self.loop.call_soon_threadsafe)
+        room = Room(
+            room_id,
+            conn,
+            conn.pid,
+            seat,
+            bot_pid,
+            self,
+            resume_grace=self.resume_grace,
+            limits=self.limits,
+        )
+        seat.attach(room, 2)
+        self.active_rooms[room_id] = room
+        # AI 座位不能以 token 重新連線
+        self.sessions[room.tokens[1]] = (room_id, 1)
+        room.begin()
+        conn.attach(room, 1)
+        room.replay({2: seat.opening_frames()})
+
+    def on_connection_lost(self, conn, exc):
+        # 連線關閉：遊戲進行中則保留座位等待重新連線 (或判對手獲勝)
+        if conn.watcher is not None:
+            self.spectators.detach(conn.watcher)
+        room = conn.room
+        if room is not None and not room.over:
+            global_player_id = room.global_ids[conn.player_id]
+            if exc is None:
+                room.log.info("Player %s disconnected.", global_player_id)
+            else:
+                room.log.warning("玩家 %s 連線錯誤: %s", global_player_id, exc)
+            room.on_disconnect(conn.player_id, conn)
+        # 已被重新連線取代的舊連線不影響新連線的紀錄
+        if self.clients.get(conn.pid) is conn:
+            self.remove_client(conn.pid)
+
+    def record_result(self, winner_name, loser_name):
+        # 對局結束時由房間呼叫，更新雙方 rating
+        self.ratings.record(winner_name, loser_name)
+
+    def remove_room(self, room_id):
+        # 移除已結束的房間
+        if room_id in self.active_rooms:
+            log.info("移除已結束的房間 %s。", room_id)
+            room = self.active_rooms.pop(room_id)
+            for token in room.tokens.values():
+                self.sessions.pop(token, None)
+        else:
+            log.warning("嘗試移除不存在的房間 %s。", room_id)
+
+    def remove_client(self, pid):
+        # 移除離線或中斷連線的 client
+        conn = self.clients.pop(pid, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        if conn is not None and conn.room is None:
+            self.arrivals.pop(pid, None)
+            self.matchmaker.cancel(pid)
+
+    def shutdown_server(self):
+        # 關閉伺服器，通知所有 client 並釋放資源
+        log.info("正在關閉所有活動房間和客戶端連接...")
+        # 先關閉 AI 的搜尋 pool，之後不會再有 AI 的走子排進 event loop
+        bot.stop()
+        log.info("配對等待時間統計: %s", self.matchmaker.wait_stats())
+        for room in list(self.active_rooms.values()):
+            with room.lock:
+                if room.over:
+                    continue
+                room.over = True
+                room.end_reason = "伺服器關閉。"
+                room.broadcast(
+                    {"type": constants.MSG_TYPE_GAME_OVER, "winner": None, "reason": "伺服器關閉。"}
+                )
+                room.cleanup()
+        self.active_rooms.clear()
+        self.sessions.clear()
+        for conn in [ticket.player for ticket in self.matchmaker] + list(self.arrivals.values()):
+            try:
+                conn.sendall(
+                    json.dumps({"type": constants.MSG_TYPE_ERROR, "message": "伺服器正在關閉。"}).encode(
+                        "utf-8"
+                    )
+                    + b"\n"
+                )
+                conn.close()
+            except Exception:
+                pass
+        self.matchmaker = Matchmaker()
+        self.arrivals.clear()
+        for pid, conn in self.clients.items():
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.clients.clear()
+        log.info("伺服器已關閉。")
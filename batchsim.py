@@ -0,0 +1,235 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from bitboard import BIT, ESCAPE_MASK, NEIGHBOR_SQUARES, NUM_SQUARES, SQUARE_RC, iter_squares
+from common import constants
+from engine import SETUP_SQUARES, GameState
+from selfplay import REASON_MAX_PLIES, SelfPlayStats
+
+# 以 numpy 陣列同時進行 B 局隨機對局，每一步對所有進行中的對局各走一步 (規則同 GameState)
+# 棋盤為 (B, 37) 的 int8：格子內容代碼如下，第 37 格是棋盤外，讓出界的移動也能直接查表
+EMPTY = 0
+P1_GOOD, P1_BAD, P2_GOOD, P2_BAD = 1, 2, 3, 4
+OFF = NUM_SQUARES
+
+_OWNER = np.array([0, 1, 1, 2, 2], np.int8)  # 代碼 -> 所屬玩家
+_GOOD = np.array([False, True, False, True, False])  # 代碼 -> 是否為好鬼
+# 每格往 4 個方向的相鄰格 (出界為 OFF)；一局的所有可能移動攤平成 36 * 4 = 144 個編號
+_DEST = np.full((NUM_SQUARES, 4), OFF, np.intp)
+for _sq, _near in enumerate(NEIGHBOR_SQUARES):
+    _DEST[_sq, : len(_near)] = _near
+_ON_BOARD = _DEST != OFF
+_MOVE_FROM = np.repeat(np.arange(NUM_SQUARES), 4)
+_MOVE_TO = _DEST.ravel()
+_ESCAPE = np.zeros((3, NUM_SQUARES + 1), bool)
+for _pid in (1, 2):
+    for _sq in iter_squares(ESCAPE_MASK[_pid]):
+        _ESCAPE[_pid, _sq] = True
+_SETUP = (None, np.array(SETUP_SQUARES[1]), np.array(SETUP_SQUARES[2]))
+
+# 勝負原因代碼，0 表示尚未結束
+REASONS = (
+    None,
+    constants.WIN_REASON_CAPTURE_ALL_GOOD,
+    constants.WIN_REASON_LOSE_ALL_BAD,
+    constants.WIN_REASON_ESCAPE,
+    REASON_MAX_PLIES,
+)
+_CAPTURE_ALL_GOOD, _LOSE_ALL_BAD, _ESCAPED, _MAX_PLIES = 1, 2, 3, 4
+
+
+class BatchSimulator:
+    # B 個對局位置 (slot)，每個 slot 一局；結束的 slot 可用 reset 換上新的一局，batch 一直保持滿的
+    def __init__(self, size, seed=0, max_plies=400):
+        self.size = size
+        self.max_plies = max_plies
+        self.rng = np.random.default_rng(seed)
+        self.board = np.zeros((size, NUM_SQUARES + 1), np.int8)
+        self.captured = np.zeros((size, 3, 2), np.int8)  # captured[b, pid] = [吃掉的好鬼, 壞鬼]
+        self.turn = np.zeros(size, np.int8)
+        self.first = np.zeros(size, np.int8)
+        self.ply = np.zeros(size, np.int32)
+        self.winner = np.zeros(size, np.int8)  # 0 為和局或尚未結束
+        self.reason = np.zeros(size, np.int8)
+        self.active = np.zeros(size, bool)
+
+    def reset(self, slots, setups=None):
+        # 在指定的 slot 開始新的一局，隨機決定先手
+        # setups: (len(slots), 2) 的佈局 byte (同 gamelog.setup_byte)，未指定時雙方隨機佈局
+        n = len(slots)
+        self.board[slots] = EMPTY
+        for pid, good_code, bad_code in ((1, P1_GOOD, P1_BAD), (2, P2_GOOD, P2_BAD)):
+            if setups is None:
+                # 8 個佈局格依亂數排序，前 4 格放好鬼
+                good = np.argsort(self.rng.random((n, 8)), axis=1) < 4
+            else:
+                good = (setups[:, pid - 1, None] >> np.arange(8) & 1).astype(bool)
+            codes = np.where(good, good_code, bad_code).astype(np.int8)
+            self.board[slots[:, None], _SETUP[pid]] = codes
+        self.captured[slots] = 0
+        self.first[slots] = self.turn[slots] = self.rng.integers(1, 3, n, dtype=np.int8)
+        self.ply[slots] = 0
+        self.winner[slots] = 0
+        self.reason[slots] = 0
+        self.active[slots] = True
+
+    def legal_mask(self, slots):
+        # (len(slots), 144) 的合法步遮罩：起點是自己的棋子、終點在棋盤上且不是自己的棋子
+        mine = _OWNER[self.board[slots]] == self.turn[slots, None]  # 棋盤外那一格永遠是空的
+        legal = mine[:, :NUM_SQUARES, None] & _ON_BOARD & ~mine[:, _DEST]
+        return legal.reshape(len(slots), -1)
+
+    def step(self, record=None):
+        # 每個進行中的對局均勻隨機走一步，回傳這一步結束的 slot
+        # record: list，傳入時附加這一步各 slot 的 (from, to)，沒有走的 slot 為 -1 (交叉檢查用)
+        slots = np.flatnonzero(self.active)
+        legal = self.legal_mask(slots)
+        keys = self.rng.random(legal.shape, np.float32) * legal
+        choice = keys.argmax(axis=1)
+        frm = _MOVE_FROM[choice]
+        to = _MOVE_TO[choice]
+        player = self.turn[slots]
+        opp = 3 - player
+        moved = self.board[slots, frm]
+        captured = self.board[slots, to]
+        self.board[slots, to] = moved
+        self.board[slots, frm] = EMPTY
+        hit = captured != EMPTY
+        kind = (~_GOOD[captured]).astype(np.intp)  # 0 好鬼 / 1 壞鬼
+        self.captured[slots[hit], player[hit], kind[hit]] += 1
+        self.ply[slots] += 1
+        if record is not None:
+            moves = np.full((self.size, 2), -1, np.int8)
+            moves[slots, 0] = frm
+            moves[slots, 1] = to
+            record.append(moves)
+
+        # 勝負判斷順序同 GameState._check_win
+        mine = self.captured[slots, player]
+        theirs = self.captured[slots, opp]
+        winner = np.zeros(len(slots), np.int8)
+        reason = np.zeros(len(slots), np.int8)
+        rules = (
+            (mine[:, 0] >= 4, player, _CAPTURE_ALL_GOOD),
+            (theirs[:, 1] >= 4, player, _LOSE_ALL_BAD),
+            (mine[:, 1] >= 4, opp, _LOSE_ALL_BAD),
+            (_GOOD[moved] & _ESCAPE[player, to], player, _ESCAPED),
+        )
+        for condition, who, why in rules:
+            condition &= winner == 0
+            winner[condition] = who[condition]
+            reason[condition] = why
+        # 沒有合法步的對局 (實際上不會發生) 與超過步數上限的對局都視為和局
+        stuck = (self.ply[slots] >= self.max_plies) | ~legal.any(axis=1)
+        reason[(reason == 0) & stuck] = _MAX_PLIES
+        self.winner[slots] = winner
+        self.reason[slots] = reason
+        self.turn[slots] = np.where(reason == 0, opp, player)
+        finished = slots[reason != 0]
+        self.active[finished] = False
+        return finished
+
+
+def simulate(games, batch=4096, seed=0, max_plies=400):
+    # 進行 games 局，同時最多 batch 局；回傳 (SelfPlayStats, 總步數)
+    batch = min(batch, games)
+    sim = BatchSimulator(batch, seed, max_plies)
+    sim.reset(np.arange(batch))
+    remaining = games - batch
+    stats = SelfPlayStats()
+    total_moves = 0
+    while sim.active.any():
+        total_moves += int(sim.active.sum())
+        finished = sim.step()
+        if not len(finished):
+            continue
+        for winner, reason, plies, first in zip(
+            sim.winner[finished].tolist(),
+            sim.reason[finished].tolist(),
+            sim.ply[finished].tolist(),
+            sim.first[finished].tolist(),
+        ):
+            stats.add(winner or None, REASONS[reason], plies, first)
+        if remaining:
+            refill = finished[:remaining]
+            sim.reset(refill)
+            remaining -= len(refill)
+    return stats, total_moves
+
+
+def cross_check(games, seed=0, max_plies=400):
+    # 同時進行 games 局並記錄每一步，再逐局以 GameState.apply_move 重播，比對合法性與勝負、步數、最後的盤面
+    # 回傳不一致的局數
+    sim = BatchSimulator(games, seed, max_plies)
+    sim.reset(np.arange(games))
+    opening = sim.board.copy()
+    record = []
+    while sim.active.any():
+        sim.step(record)
+    moves = np.stack(record, axis=1) if record else np.zeros((games, 0, 2), np.int8)
+    mismatches = 0
+    for b in range(games):
+        game = GameState()
+        for pid, good_code in ((1, P1_GOOD), (2, P2_GOOD)):
+            good = np.flatnonzero(opening[b, :NUM_SQUARES] == good_code)
+            game.setup_from_good(pid, good.tolist())
+        game.start(int(sim.first[b]))
+        ok = True
+        for frm, to in moves[b].tolist():
+            if frm < 0:
+                break
+            result = game.apply_move(game.turn, SQUARE_RC[frm], SQUARE_RC[to])
+            if not result.ok:
+                ok = False
+                break
+        reason = REASONS[sim.reason[b]]
+        expected = (game.winner or 0, game.reason or REASON_MAX_PLIES, game.ply)
+        ok = ok and expected == (int(sim.winner[b]), reason, int(sim.ply[b]))
+        for pid, good_code, bad_code in ((1, P1_GOOD, P1_BAD), (2, P2_GOOD, P2_BAD)):
+            ok = ok and _mask(sim.board[b], good_code) == game.bb.good[pid]
+            ok = ok and _mask(sim.board[b], bad_code) == game.bb.bad[pid]
+            ok = ok and sim.captured[b, pid].tolist() == game.captured[pid]
+        if not ok:
+            mismatches += 1
+    return mismatches
+
+
+def _mask(row, code):
+    mask = 0
+    for sq in np.flatnonzero(row[:NUM_SQUARES] == code).tolist():
+        mask |= BIT[sq]
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description="numpy 批次隨機對局模擬")
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument(
+        "--batch", default="4096", help="同時進行的局數，可用逗號分隔多個值比較吞吐量 (例如 1,64,4096)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-plies", type=int, default=400, help="超過此步數視為和局")
+    parser.add_argument("--check", type=int, default=0, help="先以 GameState 交叉檢查這麼多局")
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = cross_check(args.check, args.seed, args.max_plies)
+        print(f"交叉檢查 {args.check} 局：{mismatches} 局與 GameState 不一致")
+        if mismatches:
+            raise SystemExit(1)
+    for batch in (int(b) for b in args.batch.split(",")):
+        start = time.perf_counter()
+        stats, total_moves = simulate(args.games, batch, args.seed, args.max_plies)
+        elapsed = time.perf_counter() - start
+        print(
+            f"batch {batch:>6}: {args.games} 局  {total_moves} 步  {elapsed:.2f}s  "
+            f"games/sec {args.games / elapsed:,.0f}  moves/sec {total_moves / elapsed:,.0f}"
+        )
+    print(json.dumps(stats.to_dict(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import time
+
+from common import codec, constants
+
+# 代表性的訊息：每步都會出現的 update_state / state_delta / move / 回合訊息
+SAMPLES = {
+    "update_state": {
+        "type": constants.MSG_TYPE_UPDATE_STATE,
+        "board": [
+            [".", "g", "g", "b", "g", "."],
+            [".", "b", ".", "b", "b", "."],
+            [".", ".", "g", ".", ".", "."],
+            [".", ".", ".", "X", ".", "."],
+            [".", "X", "X", ".", "X", "."],
+            [".", "X", "X", "X", "X", "."],
+        ],
+        "current_player": 2,
+        "my_player_id": 1,
+        "my_good_captured_by_opponent": 0,
+        "my_bad_captured_by_opponent": 1,
+        "opponent_good_captured_by_me": 1,
+        "opponent_bad_captured_by_me": 0,
+        "last_action_desc": "玩家 7 從 (1,2) 移動到 (2,2)",
+        "my_nickname": "alice",
+        "opponent_nickname": "bob",
+    },
+    "state_delta": {
+        "type": constants.MSG_TYPE_STATE_DELTA,
+        "seq": 42,
+        "changes": [[1, 2, "."], [2, 2, "g"]],
+        "mover": 1,
+        "captured": None,
+        "turn": 2,
+    },
+    "move": {"type": constants.MSG_TYPE_MOVE, "from_sq": [1, 2], "to_sq": [2, 2]},
+    "your_turn": {"type": constants.MSG_TYPE_YOUR_TURN},
+}
+
+
+def bench(func, arg, iterations):
+    # 回傳每秒可執行次數
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON 與 binary 編碼的 encode/decode 效能比較")
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'訊息':<14}{'編碼':<8}{'bytes':>7}{'encode/s':>14}{'decode/s':>14}")
+    for name, msg in SAMPLES.items():
+        json_frame = codec.encode_json(msg)
+        binary_frame = codec.encode_binary(msg)
+        assert codec.decode_json(json_frame[:-1]) == msg
+        binary_body = binary_frame[codec.FRAME_HEADER.size :]
+        assert codec.decode_binary(binary_body) == msg, name
+        rows = [
+            ("json", json_frame, codec.encode_json, codec.decode_json, json_frame[:-1]),
+            ("binary", binary_frame, codec.encode_binary, codec.decode_binary, binary_body),
+        ]
+        for encoding, frame, encode, decode, payload in rows:
+            enc = bench(encode, msg, args.iterations)
+            dec = bench(decode, payload, args.iterations)
+            print(f"{name:<14}{encoding:<8}{len(frame):>7}{enc:>14,.0f}{dec:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import random
+import time
+
+from engine import SETUP_SQUARES, GameState
+
+
+def random_game(rng, max_plies):
+    # 雙方隨機佈局、隨機走子直到分出勝負或超過步數上限，回傳 (步數, 勝方)
+    game = GameState()
+    for pid in (1, 2):
+        game.setup_from_good(pid, rng.sample(SETUP_SQUARES[pid], 4))
+    game.start(rng.choice((1, 2)))
+    while game.winner is None and game.ply < max_plies:
+        game.push(*rng.choice(game.legal_moves()))
+    return game.ply, game.winner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="規則引擎吞吐量測試 (隨機對局)")
+    parser.add_argument("--games", type=int, default=20000)
+    parser.add_argument("--max-plies", type=int, default=400, help="超過此步數視為和局")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    total_moves = 0
+    draws = 0
+    start = time.perf_counter()
+    for _ in range(args.games):
+        plies, winner = random_game(rng, args.max_plies)
+        total_moves += plies
+        if winner is None:
+            draws += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"對局數: {args.games}  總步數: {total_moves}  和局: {draws}  耗時: {elapsed:.2f}s")
+    print(f"games/sec: {args.games / elapsed:,.0f}")
+    print(f"moves/sec: {total_moves / elapsed:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+from common import constants
+
+# 棋盤大小與格子編號：第 r 列第 c 行對應 bit (r * 6 + c)，整個棋盤是一個 36-bit 整數
+SIZE = 6
+NUM_SQUARES = SIZE * SIZE
+FULL_MASK = (1 << NUM_SQUARES) - 1
+
+GOOD = "G"  # 好鬼
+BAD = "B"  # 壞鬼
+
+
+def square(r, c):
+    # (列, 行) 轉成格子編號
+    return r * SIZE + c
+
+
+def iter_squares(mask):
+    # 依序取出 mask 中每個為 1 的格子編號
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+# 預先計算的查表：格子座標、單一 bit、上下左右相鄰格
+SQUARE_RC = tuple(divmod(sq, SIZE) for sq in range(NUM_SQUARES))
+BIT = tuple(1 << sq for sq in range(NUM_SQUARES))
+
+
+def _neighbor_squares(sq):
+    r, c = SQUARE_RC[sq]
+    result = []
+    for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+        nr, nc = r + dr, c + dc
+        if 0 <= nr < SIZE and 0 <= nc < SIZE:
+            result.append(square(nr, nc))
+    return tuple(result)
+
+
+NEIGHBOR_SQUARES = tuple(_neighbor_squares(sq) for sq in range(NUM_SQUARES))
+NEIGHBORS = tuple(sum(BIT[n] for n in NEIGHBOR_SQUARES[sq]) for sq in range(NUM_SQUARES))
+
+# 各玩家好鬼的逃脫點 (索引 0 不使用，讓玩家 ID 可直接當索引)
+ESCAPE_MASK = (
+    0,
+    sum(BIT[square(r, c)] for r, c in constants.P1_ESCAPE_CORNERS),
+    sum(BIT[square(r, c)] for r, c in constants.P2_ESCAPE_CORNERS),
+)
+
+
+class BitBoard:
+    # 以整數 mask 儲存雙方好鬼/壞鬼位置，good[pid] / bad[pid] 的索引即為玩家 ID
+    __slots__ = ("good", "bad")
+
+    def __init__(self, good=(0, 0, 0), bad=(0, 0, 0)):
+        self.good = list(good)
+        self.bad = list(bad)
+
+    def copy(self):
+        return BitBoard(self.good, self.bad)
+
+    def occupied(self, owner):
+        # 指定玩家所有棋子的位置
+        return self.good[owner] | self.bad[owner]
+
+    def all_occupied(self):
+        return self.good[1] | self.bad[1] | self.good[2] | self.bad[2]
+
+    def piece_at(self, sq):
+        # 回傳 (owner, ghost_type)，空格回傳 None
+        bit = BIT[sq]
+        for owner in (1, 2):
+            if self.good[owner] & bit:
+                return owner, GOOD
+            if self.bad[owner] & bit:
+                return owner, BAD
+        return None
+
+    def place(self, owner, ghost_type, sq):
+        # 佈局時放置棋子
+        if ghost_type == GOOD:
+            self.good[owner] |= BIT[sq]
+        else:
+            self.bad[owner] |= BIT[sq]
+
+    def is_legal(self, owner, frm, to):
+        # 起點是自己的棋子、終點相鄰且不是自己的棋子
+        own = self.good[owner] | self.bad[owner]
+        return bool(own & BIT[frm]) and bool(NEIGHBORS[frm] & BIT[to]) and not own & BIT[to]
+
+    def legal_moves(self, owner):
+        # 產生指定玩家所有合法移動 (frm, to)
+        own = self.good[owner] | self.bad[owner]
+        moves = []
+        for frm in iter_squares(own):
+            for to in iter_squares(NEIGHBORS[frm] & ~own):
+                moves.append((frm, to))
+        return moves
+
+    def move(self, owner, frm, to):
+        # 移動棋子 (不檢查合法性)，回傳 (移動的鬼種類, 被吃掉的鬼種類或 None)
+        path = BIT[frm] | BIT[to]
+        if self.good[owner] & BIT[frm]:
+            self.good[owner] ^= path
+            moved = GOOD
+        else:
+            self.bad[owner] ^= path
+            moved = BAD
+        opp = 3 - owner
+        bit = BIT[to]
+        if self.good[opp] & bit:
+            self.good[opp] ^= bit
+            return moved, GOOD
+        if self.bad[opp] & bit:
+            self.bad[opp] ^= bit
+            return moved, BAD
+        return moved, None
+
+    def unmove(self, owner, frm, to, moved, captured):
+        # 還原 move()：把棋子移回起點，並放回被吃掉的鬼
+        path = BIT[frm] | BIT[to]
+        if moved == GOOD:
+            self.good[owner] ^= path
+        else:
+            self.bad[owner] ^= path
+        if captured == GOOD:
+            self.good[3 - owner] |= BIT[to]
+        elif captured == BAD:
+            self.bad[3 - owner] |= BIT[to]
+
+    def is_escape(self, owner, sq):
+        # 該格是否為指定玩家的逃脫點
+        return bool(ESCAPE_MASK[owner] & BIT[sq])
+
+    def rows(self):
+        # 轉回 6x6 list-of-lists 形式 ((owner, ghost_type) 或 None)，除錯用
+        return [[self.piece_at(square(r, c)) for c in range(SIZE)] for r in range(SIZE)]
@@ -0,0 +1,50 @@
+from bitboard import GOOD, SQUARE_RC, iter_squares
+from common import constants
+
+OBSERVER = 0  # 觀戰者視角：雙方棋子都顯示為未現形
+
+# 各玩家自己棋子的顯示字元 (好鬼, 壞鬼)
+PIECE_CHARS = {
+    1: (constants.P1_GOOD_CHAR, constants.P1_BAD_CHAR),
+    2: (constants.P2_GOOD_CHAR, constants.P2_BAD_CHAR),
+}
+
+
+def build_view(bb, viewer):
+    # 由 bitboard 完整產生一個視角的 6x6 棋盤 (隱藏對手資訊)
+    view = [[constants.EMPTY_SQUARE_CHAR] * 6 for _ in range(6)]
+    hidden = bb.all_occupied()
+    if viewer != OBSERVER:
+        good_char, bad_char = PIECE_CHARS[viewer]
+        for sq in iter_squares(bb.good[viewer]):
+            r, c = SQUARE_RC[sq]
+            view[r][c] = good_char
+        for sq in iter_squares(bb.bad[viewer]):
+            r, c = SQUARE_RC[sq]
+            view[r][c] = bad_char
+        hidden ^= bb.occupied(viewer)
+    for sq in iter_squares(hidden):
+        r, c = SQUARE_RC[sq]
+        view[r][c] = constants.OPPONENT_GHOST_CHAR
+    return view
+
+
+class BoardViews:
+    # 雙方玩家與觀戰者的棋盤視角快取，每步只更新起點與終點兩格
+    __slots__ = ("views",)
+
+    def __init__(self, bb):
+        self.views = {viewer: build_view(bb, viewer) for viewer in (1, 2, OBSERVER)}
+
+    def get(self, viewer):
+        # 回傳快取本身：呼叫端不可修改，且必須在下一步套用前完成序列化
+        return self.views[viewer]
+
+    def apply_move(self, player, frm, to, moved):
+        # 套用一步移動 (吃子時終點直接被覆蓋)
+        from_r, from_c = SQUARE_RC[frm]
+        to_r, to_c = SQUARE_RC[to]
+        own_char = PIECE_CHARS[player][0 if moved == GOOD else 1]
+        for viewer, view in self.views.items():
+            view[from_r][from_c] = constants.EMPTY_SQUARE_CHAR
+            view[to_r][to_c] = own_char if viewer == player else constants.OPPONENT_GHOST_CHAR
@@ -0,0 +1,418 @@
+import json
+import math
+import multiprocessing
+import os
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from bitboard import BIT, ESCAPE_MASK, SQUARE_RC, iter_squares
+from common import constants, openings
+from engine import GameState
+from policies import RandomPolicy
+from server_log import get_logger
+from tablebase import Tablebase
+from transposition import TranspositionTable
+
+log = get_logger("bot")
+
+BOT_NICKNAME = "電腦 (ISMCTS)"
+# 每一步的思考時間 (秒)
+THINK_TIME = 1.0
+# 每一步拆成幾份同時搜尋 (root parallelization)，結果依各步模擬次數合併
+ROOT_JOBS = 2
+# 搜尋 process 的 nice 值，AI 再忙也不搶房間 thread 與 event loop 的 CPU
+WORKER_NICE = 10
+# 排隊太久已過期限時至少仍模擬這麼多次
+MIN_ITERATIONS = 64
+# 模擬最多走幾步，之後依吃子數估計勝率
+ROLLOUT_PLIES = 60
+# UCB 探索係數
+EXPLORATION = 0.7
+# 每局置換表的大小 (2^N 格)
+TABLE_BITS = 15
+# 每個搜尋 process 最多保留幾局的置換表
+MAX_TABLES = 32
+
+
+class Node:
+    # 搜尋節點，對應搜尋方的一個資訊集 (看不到對手鬼的身分，不同抽樣共用同一個節點)
+    # 節點以資訊集的 Zobrist hash 存在置換表中，不同走法順序到達同一個資訊集時共用，所以是圖而不是樹
+    __slots__ = ("player", "children", "visits", "wins")
+
+    def __init__(self, player=None):
+        self.player = player  # 走進這個節點的玩家
+        self.children = {}  # (frm, to) -> Node
+        self.visits = 0
+        self.wins = 0.0  # 以 player 的角度累計的勝場
+
+    def select(self):
+        # UCB1：兼顧目前勝率高與試得少的子節點，回傳 (走法, 節點)
+        log_n = math.log(self.visits)
+        return max(
+            self.children.items(),
+            key=lambda item: item[1].wins / item[1].visits
+            + EXPLORATION * math.sqrt(log_n / item[1].visits),
+        )
+
+
+def observe(game, me):
+    # me 看得到的資訊：自己的好鬼/壞鬼、對手棋子的位置、雙方已吃掉的鬼 (吃掉時會現形)
+    # 只含整數與 tuple，可直接交給其他 process
+    bb = game.bb
+    opp = 3 - me
+    return (
+        me,
+        bb.good[me],
+        bb.bad[me],
+        bb.occupied(opp),
+        tuple(game.captured[me]),
+        tuple(game.captured[opp]),
+    )
+
+
+def determinize(info, rng):
+    # 依可見資訊隨機決定對手剩下的鬼哪些是好鬼，產生一個完整的對局狀態 (輪到 me)
+    me, good, bad, opp_occupied, mine, theirs = info
+    opp = 3 - me
+    opp_good = 0
+    for sq in rng.sample(list(iter_squares(opp_occupied)), 4 - mine[0]):
+        opp_good |= BIT[sq]
+    game = GameState()
+    game.bb.good[me] = good
+    game.bb.bad[me] = bad
+    game.bb.good[opp] = opp_good
+    game.bb.bad[opp] = opp_occupied ^ opp_good
+    game.captured[me] = list(mine)
+    game.captured[opp] = list(theirs)
+    game.ready = [False, True, True]
+    game.start(me)
+    return game
+
+
+def evaluate(game, me):
+    # 模擬未分出勝負時的估計：吃到對手好鬼有利、吃到壞鬼不利
+    opp = 3 - me
+    mine, theirs = game.captured[me], game.captured[opp]
+    score = (mine[0] - theirs[0]) - 0.5 * (mine[1] - theirs[1])
+    return 0.5 + max(-0.4, min(0.4, 0.1 * score))
+
+
+_tablebase = None  # 搜尋 process 內載入的殘局庫 (見 load_tablebase)
+
+
+def load_tablebase(path):
+    # 讓這個 process 的模擬在棋子夠少時直接查殘局庫
+    global _tablebase
+    _tablebase = Tablebase(path)
+
+
+def _tablebase_score(game, me):
+    # 抽樣後雙方鬼的身分都已確定，剩下的棋子在殘局庫範圍內時以完美對弈的結果作為 me 的得分
+    if _tablebase is None:
+        return None
+    found = _tablebase.probe(game)
+    if found is None:
+        return None
+    return 0.5 + 0.5 * (found[0] if game.turn == me else -found[0])
+
+
+def rollout(game, me, rng):
+    # 快速模擬：好鬼能逃脫就逃脫，否則隨機走；回傳 me 的得分 (0~1)
+    # 只有吃子會改變棋子數，所以只在開始與吃子後查殘局庫
+    score = _tablebase_score(game, me)
+    for _ in range(ROLLOUT_PLIES):
+        if score is not None:
+            return score
+        if game.over:
+            return 1.0 if game.winner == me else 0.0
+        player = game.turn
+        moves = game.legal_moves()
+        good = game.bb.good[player]
+        escape = ESCAPE_MASK[player]
+        for frm, to in moves:
+            if good & BIT[frm] and escape & BIT[to]:
+                break
+        else:
+            frm, to = rng.choice(moves)
+        if game.push(frm, to).captured is not None:
+            score = _tablebase_score(game, me)
+    if score is not None:
+        return score
+    if game.over:
+        return 1.0 if game.winner == me else 0.0
+    return evaluate(game, me)
+
+
+def search(info, deadline, seed=None, table=None):
+    # Information-Set MCTS：每次模擬先重新抽樣對手的鬼身分，再沿同一張圖選擇、展開、模擬、回傳
+    # 走法只取決於棋子位置，所以同一個節點在每個抽樣下的合法步都相同，不同的只有勝負
+    # table: 資訊集 hash -> Node 的置換表；傳入同一局上一步用過的表，就能沿用已模擬過的節點
+    # deadline 為 time.time() 的期限 (跨 process 共用)；回傳 ({(frm, to): (模擬次數, 勝場)}, 模擬次數)
+    rng = random.Random(seed)
+    me = info[0]
+    if table is None:
+        table = TranspositionTable(TABLE_BITS)
+    table.new_search()
+    root_key = determinize(info, rng).view_key(me)
+    root = table.get(root_key)
+    if root is None:
+        root = Node()
+        table.put(root_key, root)
+    iterations = 0
+    while iterations < MIN_ITERATIONS or time.time() < deadline:
+        iterations += 1
+        game = determinize(info, rng)
+        node = root
+        path = [root]
+        while not game.over:
+            moves = game.legal_moves()
+            if len(node.children) < len(moves):
+                move = rng.choice([m for m in moves if m not in node.children])
+                player = game.turn
+                game.push(*move)
+                key = game.view_key(me)
+                child = table.get(key)
+                if child is None:
+                    child = Node(player)
+                    # 越靠近根的節點越不容易被取代
+                    table.put(key, child, -len(path))
+                node.children[move] = child
+                path.append(child)
+                break
+            move, node = node.select()
+            game.push(*move)
+            if node in path:
+                # 棋子來回走回到同一個資訊集，改由模擬決定結果，避免在圖上繞圈
+                break
+            path.append(node)
+        result = rollout(game, me, rng)
+        for node in path:
+            node.visits += 1
+            if node.player is not None:
+                node.wins += result if node.player == me else 1.0 - result
+    return {move: (child.visits, child.wins) for move, child in root.children.items()}, iterations
+
+
+_tables = OrderedDict()  # 搜尋 process 內：table_id -> 該局的置換表
+
+
+def search_game(info, deadline, seed, table_id):
+    # 在 pool 的 process 內執行：同一局 (table_id) 的每一步共用置換表，超過 MAX_TABLES 局時丟掉最久沒用的
+    table = _tables.pop(table_id, None)
+    if table is None:
+        table = TranspositionTable(TABLE_BITS)
+    _tables[table_id] = table
+    while len(_tables) > MAX_TABLES:
+        _tables.popitem(last=False)
+    return search(info, deadline, seed, table)
+
+
+def best_move(stats):
+    # 模擬次數最多的一步 (比勝率穩定)
+    return max(stats, key=lambda move: stats[move][0])
+
+
+class ISMCTSPolicy(RandomPolicy):
+    # 給 selfplay.py 使用的策略 (--p1 bot:ISMCTSPolicy)，在目前的 process 內搜尋
+    name = "ismcts"
+    think_time = 0.1
+
+    def __init__(self):
+        self.table = TranspositionTable(TABLE_BITS)
+
+    def choose_move(self, game, rng):
+        info = observe(game, game.turn)
+        stats, _ = search(info, time.time() + self.think_time, rng.random(), self.table)
+        return best_move(stats)
+
+
+def _init_worker(tablebase):
+    try:
+        os.nice(WORKER_NICE)
+    except OSError:
+        pass
+    if tablebase:
+        load_tablebase(tablebase)
+
+
+class BotPool:
+    # 所有 AI 座位共用的搜尋 process pool；同時進行的 AI 對局再多，也只占用固定數量的 process
+    def __init__(self, workers, think_time=THINK_TIME, jobs=ROOT_JOBS, tablebase=None):
+        self.think_time = think_time
+        self.jobs = max(1, min(jobs, workers))
+        self.workers = workers
+        self.tablebase = tablebase
+        self.closed = False  # shutdown 之後 (伺服器正在關閉) 不再走子
+        self.lock = threading.Lock()
+        self.executor = self.new_executor()
+
+    def new_executor(self):
+        return ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.tablebase,),
+        )
+
+    def request_move(self, info, table_id, on_move):
+        # 把一步的搜尋分成 jobs 份交給 pool，全部完成後在 pool 的 thread 呼叫 on_move((frm, to))
+        # table_id 識別同一局，讓搜尋 process 沿用該局的置換表
+        deadline = time.time() + self.think_time
+        executor = self.executor
+        try:
+            futures = [
+                executor.submit(search_game, info, deadline, secrets.randbits(32), table_id)
+                for _ in range(self.jobs)
+            ]
+        except RuntimeError as e:
+            if self.closed:
+                return
+            # pool 已失效 (BrokenProcessPool)：換一個新的 pool，這一步隨機走；
+            # 呼叫端持有房間的 lock，所以和搜尋完成時一樣在另一個 thread 呼叫 on_move
+            log.error("AI 搜尋 pool 無法使用: %s", e)
+            self.replace(executor)
+            move = random.choice(determinize(info, random).legal_moves())
+            threading.Thread(target=on_move, args=(move,), daemon=True).start()
+            return
+        lock = threading.Lock()
+        pending = [len(futures)]
+
+        def done(_):
+            with lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            if self.closed:
+                # 關閉 pool 時取消的搜尋沒有結果
+                return
+            totals = {}
+            for future in futures:
+                try:
+                    stats, _ = future.result()
+                except Exception as e:
+                    log.warning("AI 搜尋失敗: %s", e)
+                    if isinstance(e, BrokenProcessPool):
+                        self.replace(executor)
+                    continue
+                for move, (visits, wins) in stats.items():
+                    old_visits, old_wins = totals.get(move, (0, 0.0))
+                    totals[move] = (old_visits + visits, old_wins + wins)
+            if totals:
+                on_move(best_move(totals))
+            else:
+                on_move(random.choice(determinize(info, random).legal_moves()))
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def replace(self, broken):
+        # 搜尋 process 異常結束時整個 pool 都無法再使用，換一個新的 (同時失敗的多個房間只換一次)
+        with self.lock:
+            if self.closed or self.executor is not broken:
+                return
+            log.warning("重新建立 AI 搜尋 pool。")
+            self.executor = self.new_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BotSeat:
+    # 房間裡由 server 端 AI 操作的座位：對 Room 提供 socket 介面 (sendall/close)，
+    # 像 client 一樣依收到的訊息行動，走子也經由 Room.handle_message，規則與人類玩家完全相同
+    # dispatch(func) 決定 AI 的走子在哪裡執行 (asyncio 模式要交回 event loop)，預設直接呼叫
+    local = True  # Room 不為這個座位開讀取 thread
+
+    def __init__(self, dispatch=None):
+        self.room = None
+        self.player_id = None
+        self.dispatch = dispatch or (lambda func: func())
+        self.closed = False
+        self.table_id = secrets.token_hex(8)  # 搜尋 process 中這一局的置換表
+
+    def attach(self, room, player_id):
+        self.room = room
+        self.player_id = player_id
+
+    def opening_frames(self):
+        # 相當於 client 在配對期間送出的訊息：暱稱與佈局 (有開局庫時挑得分率高的佈局，否則隨機)
+        if _book is not None:
+            setup = _book.choose(self.player_id)
+        else:
+            setup = random.choice(openings.SETUPS)
+        messages = [
+            {"type": constants.MSG_TYPE_NICKNAME, "nickname": BOT_NICKNAME},
+            {
+                "type": constants.MSG_TYPE_SETUP_DATA,
+                "placements": openings.placements(self.player_id, setup),
+            },
+        ]
+        return [(False, json.dumps(msg).encode("utf-8")) for msg in messages]
+
+    def sendall(self, data):
+        # 房間送來的訊息 (房間持有 lock)：輪到自己時把目前局面交給 pool 搜尋
+        if self.closed:
+            return
+        try:
+            msg = json.loads(data)
+        except ValueError:
+            return
+        if msg.get("type") != constants.MSG_TYPE_YOUR_TURN:
+            return
+        game = self.room.game
+        if game.over or game.turn != self.player_id or _pool is None:
+            return
+        _pool.request_move(observe(game, self.player_id), self.table_id, self.on_move)
+
+    def on_move(self, move):
+        # 在 pool 的 thread 呼叫；房間已清理 (座位已關閉) 時丟掉結果，關閉中的 event loop 不能再排入工作
+        if self.closed:
+            return
+        self.dispatch(lambda: self.play(move))
+
+    def play(self, move):
+        if self.closed:
+            return
+        frm, to = move
+        self.room.handle_message(
+            self.player_id,
+            {"type": constants.MSG_TYPE_MOVE, "from_sq": SQUARE_RC[frm], "to_sq": SQUARE_RC[to]},
+        )
+
+    def close(self):
+        self.closed = True
+
+
+_pool = None
+_book = None  # 佈局開局庫 (setupbook.py 產生)，沒有時隨機佈局
+
+
+def start(workers, think_time=THINK_TIME, tablebase=None):
+    # 啟用 AI 對手 (server 啟動時呼叫一次)；tablebase 為殘局庫檔案 (tablebase.py 產生)
+    global _pool, _book
+    _book = openings.load_default()
+    if _book is not None:
+        log.info("AI 佈局使用開局庫 %s (%s)", openings.DEFAULT_PATH, _book.fingerprint)
+    if tablebase:
+        # 先在這裡開一次，檔案有問題時 server 啟動就失敗，而不是每個搜尋 process 各自出錯
+        Tablebase(tablebase).close()
+    _pool = BotPool(workers, think_time, tablebase=tablebase)
+    log.info("AI 對手：%s 個搜尋 process，每步思考 %s 秒", workers, think_time)
+    if tablebase:
+        log.info("AI 使用殘局庫 %s", tablebase)
+    return _pool
+
+
+def stop():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
@@ -1,11 +1,11 @@
-import json
 import socket
 import threading
 import time
 import tkinter as tk
+from collections import deque
 from tkinter import font, messagebox, simpledialog
 
-from common import constants
+from common import codec, constants, framing, openings
 
 # GUI 顏色和字體
 BG_COLOR = "#F0F0F0"
@@ -15,11 +15,100 @@ GOOD_COLOR = "deep sky blue"  # 淺藍
 BAD_COLOR = "salmon"  # 淺紅
 OPPONENT_HIDDEN_COLOR = "gray"
 SELECTED_PIECE_COLOR = "yellow"
+DISABLED_TEXT_COLOR = "gray45"  # 不能點擊的格子的文字顏色 (與停用的按鈕相同)
+SQUARE_SIZE = 48  # 棋盤每一格的像素
+SQUARE_GAP = 2
 
 MY_GOOD_DISPLAY = "G"
 MY_BAD_DISPLAY = "B"
 OPPONENT_HIDDEN_DISPLAY = "X"
 
+# 連線後向 server 要求的編碼 (舊 server 不回 hello_ack 時維持 JSON)
+PREFERRED_ENCODING = codec.ENCODING_BINARY
+# 斷線後自動重新連線：每次嘗試的間隔與放棄前的總時間 (秒)
+RECONNECT_DELAY = 1.0
+RECONNECT_TIMEOUT = 30.0
+# 剩餘時間的更新間隔 (毫秒)；server 端的計時為準，這裡只是依 clock 訊息自行倒數
+CLOCK_REFRESH_MS = 1000
+# 接收 thread 收到訊息後最多等這麼久 (一個 UI frame) 再一次交給 GUI 處理 (毫秒)
+UI_FRAME_MS = 16
+# 帶有棋盤狀態的訊息：update_state 是完整快照，之前的狀態訊息都可以略過
+STATE_TYPES = (constants.MSG_TYPE_UPDATE_STATE, constants.MSG_TYPE_STATE_DELTA)
+
+
+def format_seconds(seconds):
+    # 剩餘時間顯示為 分:秒
+    minutes, seconds = divmod(max(0, int(seconds)), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def is_state(item):
+    return isinstance(item, dict) and item.get("type") in STATE_TYPES
+
+
+def coalesce(items):
+    # 略過被較新的 update_state 取代的狀態訊息；其他訊息 (invalid_move、game_over...) 與函式照原順序保留
+    last = None
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and item.get("type") == constants.MSG_TYPE_UPDATE_STATE:
+            last = i
+    if last is None:
+        return list(items)
+    return [item for i, item in enumerate(items) if i >= last or not is_state(item)]
+
+
+class BoardCanvas:
+    # 以單一 Canvas 畫出 6x6 棋盤：每格的方塊與文字只建立一次，記錄每格上次畫出的樣子，只重畫有變動的格子
+    # 點擊依座標換算成格子，只有 enabled 的格子會呼叫 on_click(r, c)
+    def __init__(self, parent, piece_font, on_click):
+        self.on_click = on_click
+        size = 6 * SQUARE_SIZE
+        self.canvas = tk.Canvas(
+            parent, width=size, height=size, bg=BG_COLOR, highlightthickness=0, borderwidth=0
+        )
+        self.items = [[None] * 6 for _ in range(6)]  # (方塊, 文字) 的 item id
+        self.rendered = [[None] * 6 for _ in range(6)]  # (文字, 顯示的文字顏色, 底色, 可否點擊)
+        inset = SQUARE_GAP // 2
+        for r in range(6):
+            for c in range(6):
+                x, y = c * SQUARE_SIZE, r * SQUARE_SIZE
+                rect = self.canvas.create_rectangle(
+                    x + inset,
+                    y + inset,
+                    x + SQUARE_SIZE - inset,
+                    y + SQUARE_SIZE - inset,
+                    fill=BOARD_COLOR,
+                    outline="",
+                )
+                text = self.canvas.create_text(
+                    x + SQUARE_SIZE / 2, y + SQUARE_SIZE / 2, text="", font=piece_font
+                )
+                self.items[r][c] = (rect, text)
+        self.canvas.bind("<Button-1>", self._on_click)
+
+    def grid(self, **kwargs):
+        self.canvas.grid(**kwargs)
+
+    def draw(self, r, c, text, fg, bg, enabled):
+        # 畫出一格：只更新與上次不同的 item (空白格的文字顏色看不到，不算變動)，回傳是否重畫
+        shown = (fg if enabled else DISABLED_TEXT_COLOR) if text.strip() else None
+        look = (text, shown, bg, enabled)
+        old = self.rendered[r][c]
+        if old == look:
+            return False
+        rect, item = self.items[r][c]
+        if old is None or old[2] != bg:
+            self.canvas.itemconfigure(rect, fill=bg)
+        if old is None or old[:2] != look[:2]:
+            self.canvas.itemconfigure(item, text=text, fill=shown or fg)
+        self.rendered[r][c] = look
+        return True
+
+    def _on_click(self, event):
+        r, c = event.y // SQUARE_SIZE, event.x // SQUARE_SIZE
+        if 0 <= r < 6 and 0 <= c < 6 and self.rendered[r][c] and self.rendered[r][c][3]:
+            self.on_click(r, c)
+
 
 class GhostChessGUI:
     def __init__(self, host, port):
@@ -38,6 +127,20 @@ class GhostChessGUI:
         self.setup_cols = []
         self.selected = None
         self.last_action = ""
+        # [我方好鬼損失, 我方壞鬼損失, 吃掉對手好鬼, 吃掉對手壞鬼]
+        self.captured_counts = [0, 0, 0, 0]
+        self.state_seq = None  # 協定 v2：最後套用的狀態序號
+        self.resync_pending = False
+        self.encoder = codec.encode_json  # server 確認 hello 前一律送 JSON
+        self.resume_token = None  # assign_id 帶來的 token，斷線後用來回到原本的對局
+        self.resuming = False  # 重新連線中，尚未收到 assign_id
+        self.clock = None  # 最近一次的 clock 訊息 (加上收到的時間)，沒有時間限制時為 None
+        self.clock_job = None
+        # 接收 thread 放進 inbox，GUI 每個 frame 最多處理一次 (_drain_inbox)
+        self.inbox = deque()
+        self.inbox_lock = threading.Lock()
+        self.drain_scheduled = False
+        self.book = openings.load_default()  # 佈局開局庫，沒有時不顯示推薦佈局按鈕
 
         # --- Tkinter ---
         self.root = tk.Tk()
@@ -63,15 +166,10 @@ class GhostChessGUI:
         self.board_frame = tk.Frame(main_frame, bg=BG_COLOR, relief=tk.FLAT, borderwidth=0)
         self.board_frame.grid(row=0, column=0, padx=0, pady=0, sticky="nsew")
 
-        for i in range(6):
-            self.board_frame.grid_rowconfigure(i, weight=1, minsize=0)
-            self.board_frame.grid_columnconfigure(i, weight=1, minsize=0)
-
         self.info_panel = tk.Frame(main_frame, bg=BG_COLOR, padx=10, pady=10)
         self.info_panel.grid(row=0, column=1, padx=5, pady=5, sticky="nsew")
         main_frame.grid_columnconfigure(1, weight=1)
 
-        self.board_btns = [[None for _ in range(6)] for _ in range(6)]
         self._create_board()
         self._create_info()
 
@@ -89,20 +187,10 @@ class GhostChessGUI:
         self.root.destroy()
 
     def _create_board(self):
-        # 建立棋盤按鈕
-        for r in range(6):
-            for c in range(6):
-                btn = tk.Button(
-                    self.board_frame,
-                    text=" ",
-                    font=self.button_font,
-                    width=3,
-                    height=1,
-                    bg=EMPTY_SQUARE_COLOR,
-                    command=lambda r=r, c=c: self._on_board_click(r, c),
-                )
-                btn.grid(row=r, column=c, padx=1, pady=1, sticky="nsew")
-                self.board_btns[r][c] = btn
+        # 建立棋盤 (單一 Canvas)
+        self.board_view = BoardCanvas(self.board_frame, self.button_font, self._on_board_click)
+        self.board_view.grid(row=0, column=0)
+        self._update_board()
 
     def _create_info(self):
         # 建立右側資訊面板
@@ -122,6 +210,10 @@ class GhostChessGUI:
         self.status_label.grid(row=row, column=0, sticky="w", pady=5)
         row += 1
 
+        self.clock_label = tk.Label(self.info_panel, text="", font=self.info_font, bg=BG_COLOR)
+        self.clock_label.grid(row=row, column=0, sticky="w", pady=2)
+        row += 1
+
         tk.Label(self.info_panel, text="--- 統計資料 ---", font=self.info_font, bg=BG_COLOR).grid(
             row=row, column=0, sticky="w", pady=3
         )
@@ -172,6 +264,17 @@ class GhostChessGUI:
         self.setup_label.grid(row=row, column=0, sticky="w", pady=3)
         row += 1
 
+        self.book_btn = tk.Button(
+            self.info_panel,
+            text="使用推薦佈局",
+            font=self.info_font,
+            state=tk.DISABLED,
+            command=self._use_book_setup,
+        )
+        if self.book is not None:
+            self.book_btn.grid(row=row, column=0, sticky="w", pady=3)
+        row += 1
+
         # 顯示自己的暱稱
         self.nickname_label = tk.Label(
             self.info_panel, text=f"暱稱: {self.nickname}", font=self.info_font, bg=BG_COLOR
@@ -189,13 +292,49 @@ class GhostChessGUI:
         if self.root.winfo_exists():
             self.root.after(0, func, *args)
 
+    def _post(self, item):
+        # 接收 thread 呼叫：放進 inbox (訊息或要依序執行的函式)，尚未排定時才排一次 _drain_inbox
+        with self.inbox_lock:
+            self.inbox.append(item)
+            if self.drain_scheduled:
+                return
+            self.drain_scheduled = True
+        if self.root.winfo_exists():
+            self.root.after(UI_FRAME_MS, self._drain_inbox)
+
+    def _drain_inbox(self):
+        # GUI thread：一次處理 inbox 內累積的訊息，被取代的狀態略過，連續的狀態訊息只畫最後一則
+        # 每次只從 inbox 取出一項，處理中跳出的對話框讓 GUI 先處理之後的訊息時也不會亂序
+        with self.inbox_lock:
+            self.drain_scheduled = False
+            items = coalesce(self.inbox)
+            self.inbox.clear()
+            self.inbox.extend(items)
+        while True:
+            with self.inbox_lock:
+                if not self.inbox:
+                    return
+                item = self.inbox.popleft()
+                render = not is_state(item) or not any(map(is_state, self.inbox))
+            if callable(item):
+                item()
+            else:
+                self._on_server_msg(item, render)
+
     def connect(self):
         # 連線到 server 並啟動接收 thread
         try:
             self.sock.connect((self.host, self.port))
             self._update_gui(lambda: self.status_label.config(text="成功連線，等待ID..."))
-            # 連線後立即送出暱稱
-            self.send({"type": "nickname", "nickname": self.nickname})
+            # 連線後立即要求編碼並送出暱稱
+            self.send({"type": constants.MSG_TYPE_HELLO, "encoding": PREFERRED_ENCODING})
+            self.send(
+                {
+                    "type": constants.MSG_TYPE_NICKNAME,
+                    "nickname": self.nickname,
+                    "protocol": constants.PROTOCOL_VERSION_DELTA,
+                }
+            )
             threading.Thread(target=self._recv, daemon=True).start()
 
         except Exception as e:
@@ -207,40 +346,111 @@ class GhostChessGUI:
         if self.game_over:
             return
         try:
-            self.sock.sendall(json.dumps(data).encode("utf-8") + b"\n")
+            self.sock.sendall(self.encoder(data))
         except OSError as e:
+            if self.resume_token is not None:
+                # 接收 thread 會發現斷線並重新連線
+                return
             self._update_gui(lambda: messagebox.showerror("發送錯誤", f"發送訊息時連線錯誤: {e}"))
             self.game_over = True
 
     def _recv(self):
-        # 接收 server 訊息 (threaded)
-        buffer = ""
-        try:
-            while not self.game_over:
-                chunk = self.sock.recv(4096)
-                if not chunk:
-                    self._update_gui(lambda: messagebox.showinfo("連線中斷", "伺服器已關閉連線。"))
-                    self.game_over = True
-                    break
-                buffer += chunk.decode("utf-8")
-                while "\n" in buffer:
-                    msg_str, buffer = buffer.split("\n", 1)
-                    if not self.game_over:
-                        try:
-                            msg = json.loads(msg_str)
-                            print(f"[DEBUG] 收到伺服器訊息: {msg}")
-                            self._update_gui(self._on_server_msg, msg)
-                        except json.JSONDecodeError:
-                            print(f"收到無效的JSON訊息: {msg_str}")
-        except Exception as e:
-            if not self.game_over:
+        # 接收 server 訊息 (threaded)；對局中斷線時以 resume token 自動重新連線
+        while not self.game_over:
+            try:
+                if self._recv_loop():
+                    return
+                error = None
+            except Exception as e:
+                error = e
+            if self.game_over:
+                return
+            if self.resume_token is not None and self._reconnect():
+                continue
+            if error is None:
+                self._update_gui(lambda: messagebox.showinfo("連線中斷", "伺服器已關閉連線。"))
+            else:
                 self._update_gui(
-                    lambda: messagebox.showerror("接收錯誤", f"接收訊息時發生錯誤: {e}")
+                    lambda: messagebox.showerror("接收錯誤", f"接收訊息時發生錯誤: {error}")
                 )
             self.game_over = True
 
-    def _on_server_msg(self, msg):
-        # 處理 server 傳來的各種訊息，更新 GUI 狀態
+    def _recv_loop(self):
+        # 讀取目前的連線直到對方關閉 (回傳 False) 或遊戲結束 (回傳 True)，JSON 行與 binary frame 皆可
+        reader = framing.FrameReader(framing.CLIENT_MAX_FRAME_SIZE)
+        while not self.game_over:
+            frames = reader.recv(self.sock)
+            if frames is None:
+                return False
+            for is_binary, payload in frames:
+                if self.game_over:
+                    break
+                try:
+                    msg = codec.decode_frame(is_binary, payload)
+                except ValueError:
+                    print(f"收到無效的訊息: {payload!r}")
+                    continue
+                print(f"[DEBUG] 收到伺服器訊息: {msg}")
+                t = msg.get("type")
+                if t == constants.MSG_TYPE_PING:
+                    # 心跳直接在接收 thread 回覆，不經過 GUI
+                    self.send({"type": constants.MSG_TYPE_PONG})
+                    continue
+                if t == constants.MSG_TYPE_HELLO_ACK:
+                    # server 同意後改用協商的編碼送出
+                    self.encoder = codec.ENCODERS.get(msg.get("encoding"), codec.encode_json)
+                    continue
+                if t == constants.MSG_TYPE_ASSIGN_ID:
+                    self.resume_token = msg.get("resume_token")
+                    self.resuming = False
+                elif t == constants.MSG_TYPE_WAIT_OPPONENT and self.resuming:
+                    continue
+                elif t in (constants.MSG_TYPE_GAME_OVER, constants.MSG_TYPE_RESUME_FAILED):
+                    # 對局已結束，server 隨後關閉連線不需再重新連線
+                    self.resume_token = None
+                    self._post(msg)
+                    return True
+                self._post(msg)
+        return True
+
+    def _reconnect(self):
+        # 以 resume token 重新連線，成功連上並送出 resume 時回傳 True
+        self._update_gui(
+            lambda: self.status_label.config(text="連線中斷，重新連線中...", fg="orange red")
+        )
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        deadline = time.monotonic() + RECONNECT_TIMEOUT
+        while not self.game_over and time.monotonic() < deadline:
+            time.sleep(RECONNECT_DELAY)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect((self.host, self.port))
+            except OSError:
+                sock.close()
+                continue
+            self.sock = sock
+            self.encoder = codec.encode_json
+            self.resuming = True
+            # 新連線要重新協商編碼；server 會送來 assign_id 與一則完整狀態
+            # 與訊息走同一個 inbox，確保在新連線的訊息之前執行
+            self._post(self._on_reconnected)
+            self.send({"type": constants.MSG_TYPE_HELLO, "encoding": PREFERRED_ENCODING})
+            self.send({"type": constants.MSG_TYPE_RESUME, "token": self.resume_token})
+            return True
+        return False
+
+    def _on_reconnected(self):
+        # 捨棄差量序號，等待 server 送來的完整狀態
+        self.state_seq = None
+        self.resync_pending = False
+        self.selected = None
+        self.status_label.config(text="已重新連線，等待對局狀態...", fg="blue")
+
+    def _on_server_msg(self, msg, render=True):
+        # 處理 server 傳來的各種訊息，更新 GUI 狀態；render=False 時狀態訊息只更新資料，由之後的訊息重畫
         if not self.root.winfo_exists():
             return
         if self.game_over and msg.get("type") != constants.MSG_TYPE_GAME_OVER:
@@ -275,11 +485,13 @@ class GhostChessGUI:
             self.setup_label.config(
                 text=f"請點擊 4 個位置放置好鬼 (G)。\n區域: 行 {self.setup_rows}, 列 {cols_disp}"
             )
-            self._clear_board_for_setup()
+            self._show_setup()
+            self.book_btn.config(state=tk.NORMAL)
         elif t == constants.MSG_TYPE_SETUP_INVALID:
             messagebox.showerror("佈局無效", msg.get("message"))
             self.good_ghosts = []
-            self._clear_board_for_setup()
+            self._show_setup()
+            self.book_btn.config(state=tk.NORMAL)
             self.status_label.config(text="佈局無效，請重新佈局")
         elif t == constants.MSG_TYPE_INFO:
             self.msg_label.config(text=f"[伺服器訊息] {msg.get('message')}")
@@ -291,25 +503,23 @@ class GhostChessGUI:
             self.setup_label.config(text="")
             self.board = msg.get("board")
             self.is_my_turn = self.player_id == msg.get("current_player")
-
-            my_good_cap = msg.get("my_good_captured_by_opponent", 0)
-            my_bad_cap = msg.get("my_bad_captured_by_opponent", 0)
-            opp_good_cap = msg.get("opponent_good_captured_by_me", 0)
-            opp_bad_cap = msg.get("opponent_bad_captured_by_me", 0)
-            self.my_stats.config(text=f"我方損失: 好鬼 {my_good_cap}/4, 壞鬼 {my_bad_cap}/4")
-            self.opp_stats.config(text=f"吃掉對手: 好鬼 {opp_good_cap}/4, 壞鬼 {opp_bad_cap}/4")
-
+            self.state_seq = msg.get("seq")
+            self.resync_pending = False
+
+            self.captured_counts = [
+                msg.get("my_good_captured_by_opponent", 0),
+                msg.get("my_bad_captured_by_opponent", 0),
+                msg.get("opponent_good_captured_by_me", 0),
+                msg.get("opponent_bad_captured_by_me", 0),
+            ]
             self.last_action = msg.get("last_action_desc", "")
-            self.last_action_label.config(text=f"上一個動作: {self.last_action}")
-
-            self._update_board()
-            self.msg_label.config(text="")
-
-            if not self.game_over:
-                if self.is_my_turn:
-                    self.status_label.config(text="輪到你了！", fg="green")
-                else:
-                    self.status_label.config(text="等待對手移動...", fg="orange red")
+            if render:
+                self._show_state()
+        elif t == constants.MSG_TYPE_STATE_DELTA:
+            self._apply_delta(msg, render)
+        elif t == constants.MSG_TYPE_CLOCK:
+            self.clock = dict(msg, at=time.monotonic())
+            self._tick_clock()
         elif t == constants.MSG_TYPE_YOUR_TURN:
             self.is_my_turn = True
             if not self.game_over:
@@ -328,6 +538,7 @@ class GhostChessGUI:
 
             self._update_board()
             self.status_label.config(text="遊戲結束！", fg="black")
+            self._tick_clock()
 
             title = "遊戲結束！"
             final_msg = f"{reason}\n"
@@ -340,22 +551,104 @@ class GhostChessGUI:
             else:
                 final_msg += f"很遺憾，對手獲勝。"
                 messagebox.showerror(title, final_msg)
-            for r in range(6):
-                for c in range(6):
-                    if self.root.winfo_exists() and self.board_btns[r][c].winfo_exists():
-                        self.board_btns[r][c].config(state=tk.DISABLED)
         elif t == constants.MSG_TYPE_ERROR:
             messagebox.showerror("伺服器錯誤", msg.get("message"))
-
-    def _clear_board_for_setup(self):
-        # 佈局模式下清空棋盤
+        elif t == constants.MSG_TYPE_RESUME_FAILED:
+            self.game_over = True
+            self.is_my_turn = False
+            self.status_label.config(text="無法回到對局", fg="black")
+            messagebox.showinfo("重新連線失敗", msg.get("message"))
+
+    def _apply_delta(self, msg, render=True):
+        # 協定 v2：套用差量更新，序號不連續時要求完整快照
+        seq = msg.get("seq")
+        if self.state_seq is None or seq != self.state_seq + 1:
+            if not self.resync_pending:
+                self.resync_pending = True
+                self.send({"type": constants.MSG_TYPE_RESYNC})
+            return
+        self.state_seq = seq
+        changes = msg.get("changes", [])
+        for r, c, piece in changes:
+            self.board[r][c] = piece
+        mover = msg.get("mover")
+        captured = msg.get("captured")
+        if captured:
+            index = 0 if captured == "G" else 1
+            if mover == self.player_id:
+                index += 2
+            self.captured_counts[index] += 1
+        self.is_my_turn = self.player_id == msg.get("turn")
+        if len(changes) == 2:
+            (fr, fc, _), (tr, tc, _) = changes
+            who = "你" if mover == self.player_id else self.opponent_nickname
+            self.last_action = f"{who} 從 ({fr},{fc}) 移動到 ({tr},{tc})"
+            if captured:
+                self.last_action += f"，吃掉了{'好鬼' if captured == 'G' else '壞鬼'}！"
+        if render:
+            self._show_state()
+
+    def _show_state(self):
+        # 依目前狀態更新吃子統計、上一動作、棋盤與回合提示
+        my_good_cap, my_bad_cap, opp_good_cap, opp_bad_cap = self.captured_counts
+        self.my_stats.config(text=f"我方損失: 好鬼 {my_good_cap}/4, 壞鬼 {my_bad_cap}/4")
+        self.opp_stats.config(text=f"吃掉對手: 好鬼 {opp_good_cap}/4, 壞鬼 {opp_bad_cap}/4")
+        self.last_action_label.config(text=f"上一個動作: {self.last_action}")
+
+        self._update_board()
+        self.msg_label.config(text="")
+
+        if not self.game_over:
+            if self.is_my_turn:
+                self.status_label.config(text="輪到你了！", fg="green")
+            else:
+                self.status_label.config(text="等待對手移動...", fg="orange red")
+        self._tick_clock()
+
+    def _tick_clock(self):
+        # 更新剩餘時間：換手時扣掉上一位玩家用掉的時間，新的一步從每步時限重新倒數
+        if self.clock_job is not None:
+            self.root.after_cancel(self.clock_job)
+            self.clock_job = None
+        clock = self.clock
+        if clock is None or self.game_over or self.player_id is None:
+            self.clock_label.config(text="")
+            return
+        now = time.monotonic()
+        time_left = clock.get("time_left")
+        turn = self.player_id if self.is_my_turn else 3 - self.player_id
+        if turn != clock.get("turn"):
+            if time_left is not None and clock.get("turn") in (1, 2):
+                time_left[clock["turn"] - 1] -= now - clock["at"]
+            limits = [clock["move_time"]] if clock.get("move_time") else []
+            if time_left is not None:
+                limits.append(time_left[turn - 1])
+            clock.update(turn=turn, at=now, turn_left=min(limits) if limits else None)
+        elapsed = now - clock["at"]
+        parts = []
+        if clock.get("turn_left") is not None:
+            parts.append(f"本步剩餘 {format_seconds(clock['turn_left'] - elapsed)}")
+        if time_left is not None:
+            mine, theirs = time_left[self.player_id - 1], time_left[2 - self.player_id]
+            if turn == self.player_id:
+                mine -= elapsed
+            else:
+                theirs -= elapsed
+            parts.append(f"總時間 我方 {format_seconds(mine)} / 對手 {format_seconds(theirs)}")
+        self.clock_label.config(text="  ".join(parts))
+        self.clock_job = self.root.after(CLOCK_REFRESH_MS, self._tick_clock)
+
+    def _show_setup(self):
+        # 佈局模式的棋盤：佈局區域內可點擊，已放置的好鬼顯示為 G
+        good_cells = {(p["row"], p["col"]) for p in self.good_ghosts}
         for r in range(6):
             for c in range(6):
-                btn = self.board_btns[r][c]
-                if r in self.setup_rows and c in self.setup_cols:
-                    btn.config(text=" ", bg=EMPTY_SQUARE_COLOR, state=tk.NORMAL)
+                if (r, c) in good_cells:
+                    self.board_view.draw(r, c, MY_GOOD_DISPLAY, "white", GOOD_COLOR, True)
+                elif r in self.setup_rows and c in self.setup_cols:
+                    self.board_view.draw(r, c, " ", "black", EMPTY_SQUARE_COLOR, True)
                 else:
-                    btn.config(text=" ", bg=BOARD_COLOR, state=tk.DISABLED)
+                    self.board_view.draw(r, c, " ", "black", BOARD_COLOR, False)
 
     def _get_piece_display(self, piece, r, c):
         # 根據棋子種類決定顯示內容與顏色
@@ -381,17 +674,13 @@ class GhostChessGUI:
         return text, fg, bg
 
     def _update_board(self):
-        # 更新棋盤按鈕顯示與狀態
-        if not self.board or not self.root.winfo_exists():
+        # 更新棋盤顯示與可點擊的格子 (只重畫有變動的格子)
+        if not self.board:
             return
         for r in range(6):
             for c in range(6):
-                if not self.board_btns[r][c].winfo_exists():
-                    continue
-                btn = self.board_btns[r][c]
                 piece = self.board[r][c]
                 text, fg, bg = self._get_piece_display(piece, r, c)
-                btn.config(text=text, fg=fg, bg=bg)
                 if self.is_my_turn and not self.game_over:
                     is_mine = False
                     if self.player_id == constants.P1_ID and (
@@ -407,16 +696,14 @@ class GhostChessGUI:
                         can_click = True
                     elif is_mine:
                         can_click = True
-                    btn.config(state=tk.NORMAL if can_click else tk.DISABLED)
-                elif (
-                    not self.game_over
-                    and self.setup_mode
-                    and r in self.setup_rows
-                    and c in self.setup_cols
-                ):
-                    btn.config(state=tk.NORMAL)
                 else:
-                    btn.config(state=tk.DISABLED)
+                    can_click = (
+                        not self.game_over
+                        and self.setup_mode
+                        and r in self.setup_rows
+                        and c in self.setup_cols
+                    )
+                self.board_view.draw(r, c, text, fg, bg, can_click)
 
     def _on_board_click(self, r, c):
         # 處理棋盤點擊事件 (佈局/移動)
@@ -432,13 +719,12 @@ class GhostChessGUI:
             coords = [(p["row"], p["col"]) for p in self.good_ghosts]
             if (r, c) in coords:
                 self.good_ghosts = [p for p in self.good_ghosts if (p["row"], p["col"]) != (r, c)]
-                self.board_btns[r][c].config(text=" ", bg=EMPTY_SQUARE_COLOR)
+                self._show_setup()
                 self.setup_label.config(text=f"已放置 {len(self.good_ghosts)}/4 個好鬼。")
                 return
             if len(self.good_ghosts) < 4:
                 self.good_ghosts.append({"row": r, "col": c, "ghost_type": "G"})
-                good_bg = GOOD_COLOR if self.player_id == constants.P1_ID else GOOD_COLOR
-                self.board_btns[r][c].config(text=MY_GOOD_DISPLAY, bg=good_bg, fg="white")
+                self._show_setup()
                 self.setup_label.config(text=f"已放置 {len(self.good_ghosts)}/4 個好鬼。")
 
                 if len(self.good_ghosts) == 4:
@@ -488,39 +774,38 @@ class GhostChessGUI:
                 self.selected = None
                 self.status_label.config(text="移動已發送，等待回應...", fg="blue")
 
-    def _finalize_setup(self):
-        # 佈局完成後自動補齊壞鬼並送出資料
-        all_placements = list(self.good_ghosts)
-        num_bad = 4
-        current = {(p["row"], p["col"]): "G" for p in self.good_ghosts}
-        for r in self.setup_rows:
-            for c in self.setup_cols:
-                if num_bad == 0:
-                    break
-                if (r, c) not in current:
-                    all_placements.append({"row": r, "col": c, "ghost_type": "B"})
-                    bad_bg = BAD_COLOR if self.player_id == constants.P1_ID else BAD_COLOR
-                    if self.root.winfo_exists() and self.board_btns[r][c].winfo_exists():
-                        self.board_btns[r][c].config(text=MY_BAD_DISPLAY, bg=bad_bg, fg="white")
-                    num_bad -= 1
-            if num_bad == 0:
-                break
-        if len(all_placements) != 8:
-            messagebox.showerror(
-                "佈局錯誤",
-                f"自動填充壞鬼後棋子總數 ({len(all_placements)}) 不正確。請重試。",
-            )
-            self.good_ghosts = []
-            self._clear_board_for_setup()
-            self.status_label.config(text="佈局錯誤，請重新佈局好鬼")
-            self.setup_label.config(text=f"請點擊 4 個位置放置好鬼 (G)。")
+    def _use_book_setup(self):
+        # 依佈局開局庫挑一個得分率高的佈局直接送出
+        if not self.setup_mode or self.book is None:
             return
-        self.send({"type": constants.MSG_TYPE_SETUP_DATA, "placements": all_placements})
+        setup = self.book.choose(self.player_id)
+        self.good_ghosts = [
+            {"row": r, "col": c, "ghost_type": "G"}
+            for i, (r, c) in enumerate(openings.setup_cells(self.player_id))
+            if setup >> i & 1
+        ]
+        self.setup_label.config(text="已套用推薦佈局，發送中...")
+        self._finalize_setup()
+
+    def _finalize_setup(self):
+        # 佈局完成後送出資料：好鬼以外的佈局格都放壞鬼
+        good_cells = [(p["row"], p["col"]) for p in self.good_ghosts]
+        setup = openings.setup_from_cells(self.player_id, good_cells)
+        placements = openings.placements(self.player_id, setup)
+        self.send({"type": constants.MSG_TYPE_SETUP_DATA, "placements": placements})
         self.setup_mode = False
+        self.book_btn.config(state=tk.DISABLED)
+        # 送出後整個棋盤不可點擊，等待 server 送來的狀態
+        placed = {(p["row"], p["col"]): p["ghost_type"] for p in placements}
         for r in range(6):
             for c in range(6):
-                if self.root.winfo_exists() and self.board_btns[r][c].winfo_exists():
-                    self.board_btns[r][c].config(state=tk.DISABLED)
+                ghost = placed.get((r, c))
+                if ghost == "G":
+                    self.board_view.draw(r, c, MY_GOOD_DISPLAY, "white", GOOD_COLOR, False)
+                elif ghost:
+                    self.board_view.draw(r, c, MY_BAD_DISPLAY, "white", BAD_COLOR, False)
+                else:
+                    self.board_view.draw(r, c, " ", "black", BOARD_COLOR, False)
 
     def start(self):
         # 啟動 client 主程式 (連線+GUI主迴圈)
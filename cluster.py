@@ -0,0 +1,555 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import connection, reduction
+
+import gamelog
+import metrics
+import timers
+from common import framing
+from matchmaking import Lobby, RatingBook, WaitingPlayer, resume_failed_frame
+from outbound import Writer
+from room import DEFAULT_LIMITS, RESUME_GRACE, Room, new_token
+from server_log import get_logger, setup_logging
+
+log = get_logger("cluster")
+
+# listen backlog，與單一 process 模式相同
+ACCEPT_BACKLOG = 4096
+# 子 process 回報統計的間隔 (秒)
+STATS_INTERVAL = 1.0
+# supervisor 在紀錄中輸出叢集彙總的間隔 (秒)
+SUMMARY_INTERVAL = 10.0
+# worker 與 coordinator 斷線後重連的間隔 (秒)
+RECONNECT_DELAY = 0.5
+# 子 process 結束後多久重新啟動 (秒)
+RESTART_DELAY = 1.0
+
+# worker <-> coordinator 控制訊息 (multiprocessing Connection，socket fd 以 SCM_RIGHTS 另外傳送)
+# worker -> coordinator: ("hello", worker_id) / ("client",) + fd / ("result", 勝方暱稱, 敗方暱稱) / ("closed", room_id)
+# coordinator -> worker: ("room", room_id, [(pid, resume token, frames, 未完整的 bytes), ...]) + 兩個 fd
+#                        ("resume", room_id, 房內玩家編號, frames, 未完整的 bytes) + fd
+MSG_HELLO = "hello"
+MSG_CLIENT = "client"
+MSG_RESULT = "result"
+MSG_CLOSED = "closed"
+MSG_ROOM = "room"
+MSG_RESUME = "resume"
+
+
+def make_listener(host, port):
+    # 每個 worker 各自 bind 同一個 port，由 kernel 以 SO_REUSEPORT 分配新連線
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(ACCEPT_BACKLOG)
+    return sock
+
+
+def report_stats(stats_conn):
+    # 定期把本 process 的 metrics snapshot 送給 supervisor
+    def loop():
+        while True:
+            time.sleep(STATS_INTERVAL)
+            try:
+                stats_conn.send(metrics.REGISTRY.snapshot())
+            except OSError:
+                return
+
+    threading.Thread(target=loop, daemon=True).start()
+
+
+class WorkerLink:
+    # coordinator 端對一個 worker 的控制連線
+    __slots__ = ("worker_id", "conn", "rooms")
+
+    def __init__(self, worker_id, conn):
+        self.worker_id = worker_id
+        self.conn = conn
+        self.rooms = 0  # 目前分配給該 worker 的房間數
+
+
+class Coordinator:
+    # 協調 process：接收 worker 轉交的新連線並配對，把配對好的兩條連線交給負責該房間的 worker
+    def __init__(self, control_path, authkey, idle_timeout=DEFAULT_LIMITS.idle):
+        self.control_path = control_path
+        self.authkey = authkey
+        self.ratings = RatingBook()
+        self.lobby = Lobby(
+            self.ratings,
+            self.assign_room,
+            self.drop_waiting,
+            self.resume_player,
+            idle_timeout=idle_timeout,
+        )
+        self.matchmaker = self.lobby.matchmaker
+        self.workers = {}  # worker_id -> WorkerLink，只由配對 thread 存取
+        self.sessions = {}  # resume token -> (worker_id, 房間 ID, 房內玩家編號)
+        self.room_tokens = {}  # 房間 ID -> 該房間的 resume token
+        self.next_player_id = 1
+        self.next_room_id = 1
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.matchmaker))
+        # 等待中的玩家由 coordinator 持有，房間內的玩家由 worker 回報
+        metrics.CONNECTED_CLIENTS.set_function(lambda: len(self.matchmaker))
+
+    def run(self):
+        listener = connection.Listener(self.control_path, "AF_UNIX", authkey=self.authkey)
+        log.info("coordinator 已啟動，控制 socket: %s", self.control_path)
+        timers.start()
+        self.lobby.start()
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, connection.AuthenticationError) as e:
+                log.warning("worker 控制連線失敗: %s", e)
+                continue
+            self.lobby.call(lambda conn=conn: self.add_worker(conn))
+
+    def add_worker(self, conn):
+        # 配對 thread：worker 連上後先送 hello 表明身分
+        try:
+            kind, worker_id = conn.recv()
+        except (EOFError, OSError, ValueError):
+            conn.close()
+            return
+        if kind != MSG_HELLO:
+            conn.close()
+            return
+        link = WorkerLink(worker_id, conn)
+        old = self.workers.get(worker_id)
+        if old is not None:
+            self.lobby.unwatch(old.conn)
+            old.conn.close()
+        self.workers[worker_id] = link
+        self.lobby.watch(conn, lambda: self.on_worker_message(link))
+        log.info("worker %s 已連線。", worker_id)
+
+    def on_worker_message(self, link):
+        try:
+            msg = link.conn.recv()
+            if msg[0] == MSG_CLIENT:
+                sock = socket.socket(fileno=reduction.recv_handle(link.conn))
+        except (EOFError, OSError):
+            log.warning("worker %s 控制連線中斷。", link.worker_id)
+            self.lobby.unwatch(link.conn)
+            link.conn.close()
+            if self.workers.get(link.worker_id) is link:
+                del self.workers[link.worker_id]
+                # 該 worker 的房間已不存在，無法再重新連線
+                for token, session in list(self.sessions.items()):
+                    if session[0] == link.worker_id:
+                        del self.sessions[token]
+            return
+        kind = msg[0]
+        if kind == MSG_CLIENT:
+            pid = self.next_player_id
+            self.next_player_id += 1
+            self.lobby.enqueue(WaitingPlayer(sock, pid))
+        elif kind == MSG_RESULT:
+            self.ratings.record(msg[1], msg[2])
+        elif kind == MSG_CLOSED:
+            link.rooms = max(0, link.rooms - 1)
+            for token in self.room_tokens.pop(msg[1], ()):
+                self.sessions.pop(token, None)
+
+    def assign_room(self, p1, p2):
+        # 配對成功：交給房間最少的 worker，連同配對期間讀到的訊息
+        room_id = self.next_room_id
+        self.next_room_id += 1
+        players = (p1, p2)
+        tokens = (new_token(), new_token())
+        links = sorted(self.workers.values(), key=lambda link: link.rooms)
+        for link in links:
+            try:
+                link.conn.send(
+                    (
+                        MSG_ROOM,
+                        room_id,
+                        [
+                            (w.pid, token, w.frames, w.reader.pending())
+                            for w, token in zip(players, tokens)
+                        ],
+                    )
+                )
+                for w in players:
+                    reduction.send_handle(link.conn, w.conn.fileno(), None)
+            except OSError as e:
+                log.warning("無法把房間 %s 交給 worker %s: %s", room_id, link.worker_id, e)
+                continue
+            link.rooms += 1
+            self.room_tokens[room_id] = tokens
+            for player_id, token in enumerate(tokens, 1):
+                self.sessions[token] = (link.worker_id, room_id, player_id)
+            log.info(
+                "匹配成功！玩家 %s 和玩家 %s 進入房間 %s (worker %s)",
+                p1.pid,
+                p2.pid,
+                room_id,
+                link.worker_id,
+            )
+            break
+        else:
+            log.warning("沒有可用的 worker，房間 %s 的玩家被中斷連線。", room_id)
+        # fd 已複製到 worker，coordinator 的這份可以關閉
+        for w in players:
+            w.conn.close()
+
+    def drop_waiting(self, waiting):
+        waiting.conn.close()
+
+    def resume_player(self, waiting, token):
+        # 重新連線：把連線交給房間所在的 worker
+        worker_id, room_id, player_id = self.sessions.get(token, (None, None, None))
+        link = self.workers.get(worker_id)
+        if link is None:
+            return False
+        try:
+            link.conn.send(
+                (MSG_RESUME, room_id, player_id, waiting.frames, waiting.reader.pending())
+            )
+            reduction.send_handle(link.conn, waiting.conn.fileno(), None)
+        except OSError as e:
+            log.warning("無法把重新連線的玩家 %s 交給 worker %s: %s", waiting.pid, worker_id, e)
+            return False
+        log.info("玩家 %s 重新連線到房間 %s (worker %s)", waiting.pid, room_id, worker_id)
+        waiting.conn.close()
+        return True
+
+
+class Worker:
+    # worker process：以 SO_REUSEPORT 接受連線並轉交 coordinator，執行 coordinator 分配過來的房間
+    # 對 Room 提供與 GhostChessServer 相同的介面 (remove_room / record_result)
+    def __init__(
+        self,
+        worker_id,
+        host,
+        port,
+        control_path,
+        authkey,
+        resume_grace=RESUME_GRACE,
+        limits=DEFAULT_LIMITS,
+    ):
+        self.worker_id = worker_id
+        self.host = host
+        self.port = port
+        self.resume_grace = resume_grace
+        self.limits = limits
+        self.control_path = control_path
+        self.authkey = authkey
+        self.clients = {}
+        self.active_rooms = {}
+        self.server_lock = threading.RLock()
+        self.link = None  # 到 coordinator 的控制連線
+        self.link_lock = threading.Lock()  # 多個 thread 共用 link 送訊息
+        self.writer = Writer()  # 房間內玩家連線的送出佇列
+        metrics.ACTIVE_ROOMS.set_function(lambda: len(self.active_rooms))
+        metrics.CONNECTED_CLIENTS.set_function(lambda: len(self.clients))
+        metrics.SEND_QUEUE_BYTES.set_function(self.writer.queued_bytes)
+        metrics.SLOW_CONNECTIONS.set_function(self.writer.slow_count)
+
+    def run(self):
+        sock = make_listener(self.host, self.port)
+        log.info("worker %s 已啟動於 %s:%s", self.worker_id, self.host, self.port)
+        timers.start()
+        threading.Thread(target=self.control_loop, daemon=True).start()
+        self.writer.start()
+        while True:
+            conn, addr = sock.accept()
+            log.debug("來自 %s 的新連線。", addr)
+            self.forward(conn)
+
+    def forward(self, conn):
+        # 新連線直接交給 coordinator 配對；coordinator 重啟中則拒絕連線
+        with self.link_lock:
+            if self.link is not None:
+                try:
+                    self.link.send((MSG_CLIENT,))
+                    reduction.send_handle(self.link, conn.fileno(), None)
+                except OSError as e:
+                    log.warning("無法把連線交給 coordinator: %s", e)
+                    self.link = None
+        conn.close()
+
+    def notify(self, msg):
+        with self.link_lock:
+            if self.link is not None:
+                try:
+                    self.link.send(msg)
+                except OSError:
+                    self.link = None
+
+    def control_loop(self):
+        # 連上 coordinator 並接收分配過來的房間；中斷時重連
+        while True:
+            try:
+                link = connection.Client(self.control_path, "AF_UNIX", authkey=self.authkey)
+                link.send((MSG_HELLO, self.worker_id))
+            except (OSError, EOFError, connection.AuthenticationError):
+                time.sleep(RECONNECT_DELAY)
+                continue
+            with self.link_lock:
+                self.link = link
+            try:
+                while True:
+                    msg = link.recv()
+                    if msg[0] == MSG_ROOM:
+                        self.open_room(link, msg[1], msg[2])
+                    elif msg[0] == MSG_RESUME:
+                        self.resume_player(link, *msg[1:])
+            except (EOFError, OSError) as e:
+                log.warning("與 coordinator 的連線中斷: %s", e)
+            with self.link_lock:
+                if self.link is link:
+                    self.link = None
+            link.close()
+            time.sleep(RECONNECT_DELAY)
+
+    def open_room(self, link, room_id, players):
+        # 收下兩條連線與配對期間的訊息，建立房間 (每個房間開新 thread 處理遊戲流程)
+        conns, pids, tokens, readers, pending = {}, {}, {}, {}, {}
+        for player_id, (pid, token, frames, leftover) in enumerate(players, 1):
+            conns[player_id] = socket.socket(fileno=reduction.recv_handle(link))
+            conns[player_id].setblocking(True)
+            pids[player_id] = pid
+            tokens[player_id] = token
+            readers[player_id] = framing.server_reader()
+            pending[player_id] = frames + readers[player_id].feed(leftover)
+        room = Room(
+            room_id,
+            self.writer.wrap(conns[1], f"玩家 {pids[1]}"),
+            pids[1],
+            self.writer.wrap(conns[2], f"玩家 {pids[2]}"),
+            pids[2],
+            self,
+            tokens=tokens,
+            resume_grace=self.resume_grace,
+            limits=self.limits,
+        )
+        with self.server_lock:
+            self.active_rooms[room_id] = room
+            for player_id in (1, 2):
+                self.clients[pids[player_id]] = conns[player_id]
+        threading.Thread(target=room.start, args=(readers, pending), daemon=True).start()
+
+    def resume_player(self, link, room_id, player_id, frames, leftover):
+        # 收下重新連線的 socket，交回原本的房間 (在新 thread 送出狀態並接手讀取)
+        conn = socket.socket(fileno=reduction.recv_handle(link))
+        conn.setblocking(True)
+        with self.server_lock:
+            room = self.active_rooms.get(room_id)
+            if room is not None:
+                self.clients[room.global_ids[player_id]] = conn
+        if room is None:
+            try:
+                conn.sendall(resume_failed_frame())
+            except OSError:
+                pass
+            conn.close()
+            return
+        reader = framing.server_reader()
+        frames = frames + reader.feed(leftover)
+        conn = self.writer.wrap(conn, f"玩家 {room.global_ids[player_id]}")
+        threading.Thread(
+            target=room.resume, args=(player_id, conn, reader, frames), daemon=True
+        ).start()
+
+    def record_result(self, winner_name, loser_name):
+        # rating 由 coordinator 統一保存
+        self.notify((MSG_RESULT, winner_name, loser_name))
+
+    def remove_room(self, room_id):
+        with self.server_lock:
+            room = self.active_rooms.pop(room_id, None)
+            if room is None:
+                return
+            for pid in room.global_ids.values():
+                self.clients.pop(pid, None)
+        self.notify((MSG_CLOSED, room_id))
+
+
+def coordinator_main(control_path, authkey, stats_conn, log_level, log_format, idle_timeout):
+    setup_logging(log_level, log_format, with_process=True)
+    report_stats(stats_conn)
+    try:
+        Coordinator(control_path, authkey, idle_timeout).run()
+    except KeyboardInterrupt:
+        pass
+
+
+def worker_main(
+    worker_id,
+    host,
+    port,
+    control_path,
+    authkey,
+    resume_grace,
+    stats_conn,
+    log_level,
+    log_format,
+    game_log=None,
+    limits=DEFAULT_LIMITS,
+):
+    setup_logging(log_level, log_format, with_process=True)
+    report_stats(stats_conn)
+    if game_log:
+        # 每個 worker 寫自己的 segment 檔，不需要跨 process 加鎖
+        gamelog.start(game_log, prefix=f"{gamelog.DEFAULT_PREFIX}-w{worker_id}")
+        # supervisor 以 SIGTERM 結束 worker，轉成 SystemExit 讓 finally 把紀錄寫完
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        Worker(worker_id, host, port, control_path, authkey, resume_grace, limits).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gamelog.stop()
+
+
+class Supervisor:
+    # 啟動 coordinator 與 N 個 worker process，結束的 process 自動重啟，並彙總各 process 的統計
+    def __init__(
+        self,
+        host,
+        port,
+        workers,
+        resume_grace=RESUME_GRACE,
+        log_level="INFO",
+        log_format="text",
+        game_log=None,
+        limits=DEFAULT_LIMITS,
+    ):
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.resume_grace = resume_grace
+        self.log_level = log_level
+        self.log_format = log_format
+        self.game_log = game_log
+        self.limits = limits
+        self.ctx = multiprocessing.get_context("spawn")
+        self.control_dir = tempfile.mkdtemp(prefix="geister-")
+        self.control_path = os.path.join(self.control_dir, "coordinator.sock")
+        self.authkey = os.urandom(32)
+        self.procs = {}  # 名稱 -> (Process, 統計 pipe 的接收端)
+        self.snapshots = {}  # 名稱 -> 最近一次的 metrics snapshot
+        self.lock = threading.Lock()
+
+    def spawn(self, name):
+        stats_recv, stats_send = self.ctx.Pipe(duplex=False)
+        if name == "coordinator":
+            target = coordinator_main
+            args = (
+                self.control_path,
+                self.authkey,
+                stats_send,
+                self.log_level,
+                self.log_format,
+                self.limits.idle,
+            )
+        else:
+            target = worker_main
+            args = (
+                int(name.split("-")[1]),
+                self.host,
+                self.port,
+                self.control_path,
+                self.authkey,
+                self.resume_grace,
+                stats_send,
+                self.log_level,
+                self.log_format,
+                self.game_log,
+                self.limits,
+            )
+        proc = self.ctx.Process(target=target, args=args, name=name, daemon=True)
+        proc.start()
+        stats_send.close()
+        with self.lock:
+            self.procs[name] = (proc, stats_recv)
+            self.snapshots.pop(name, None)
+
+    def merged_snapshot(self):
+        with self.lock:
+            snapshots = list(self.snapshots.values())
+        return metrics.REGISTRY.merge(snapshots)
+
+    def render_metrics(self):
+        return metrics.REGISTRY.render(self.merged_snapshot())
+
+    def collect_stats(self):
+        # 接收各 process 回報的 snapshot，只保留最新的一份
+        while True:
+            with self.lock:
+                receivers = {recv: name for name, (_, recv) in self.procs.items() if recv}
+            if not receivers:
+                time.sleep(STATS_INTERVAL)
+                continue
+            for recv in connection.wait(list(receivers), timeout=STATS_INTERVAL):
+                name = receivers[recv]
+                try:
+                    snapshot = recv.recv()
+                except (EOFError, OSError):
+                    # process 已結束，等重新啟動後換成新的 pipe
+                    with self.lock:
+                        proc, current = self.procs[name]
+                        if current is recv:
+                            self.procs[name] = (proc, None)
+                    continue
+                with self.lock:
+                    if self.procs[name][1] is recv:
+                        self.snapshots[name] = snapshot
+
+    def start(self, metrics_port=0):
+        log.info(
+            "叢集模式：1 個 coordinator + %s 個 worker，監聽 %s:%s",
+            self.num_workers,
+            self.host,
+            self.port,
+        )
+        self.spawn("coordinator")
+        for i in range(1, self.num_workers + 1):
+            self.spawn(f"worker-{i}")
+        threading.Thread(target=self.collect_stats, daemon=True).start()
+        if metrics_port:
+            metrics.start_http_server("127.0.0.1", metrics_port, self.render_metrics)
+        next_summary = time.monotonic() + SUMMARY_INTERVAL
+        try:
+            while True:
+                time.sleep(RESTART_DELAY)
+                for name, (proc, _) in list(self.procs.items()):
+                    if not proc.is_alive():
+                        log.warning("%s 已結束 (exit code %s)，重新啟動。", name, proc.exitcode)
+                        self.spawn(name)
+                if time.monotonic() >= next_summary:
+                    next_summary += SUMMARY_INTERVAL
+                    self.log_summary()
+        except KeyboardInterrupt:
+            log.info("伺服器正在關閉...")
+        finally:
+            self.shutdown()
+
+    def log_summary(self):
+        snap = self.merged_snapshot()
+        log.info(
+            "叢集彙總: 房間 %s、連線 %s、等待配對 %s、收到訊息 %s、送出訊息 %s、已結束對局 %s",
+            snap["geister_active_rooms"],
+            snap["geister_connected_clients"],
+            snap["geister_matching_queue_depth"],
+            snap["geister_messages_received_total"],
+            snap["geister_messages_sent_total"],
+            snap["geister_games_finished_total"],
+        )
+
+    def shutdown(self):
+        for proc, _ in self.procs.values():
+            proc.terminate()
+        for proc, _ in self.procs.values():
+            proc.join(timeout=5)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        log.info("伺服器已關閉。")
@@ -0,0 +1,369 @@
+import json
+import struct
+
+from common import constants
+
+# 編碼方式
+ENCODING_JSON = "json"  # 預設：一行一則 JSON，以 "\n" 結尾
+ENCODING_BINARY = "binary"  # 長度前綴的 binary frame
+
+# binary frame = MAGIC(1) + body 長度(2, big-endian) + body；body 第一個 byte 為訊息代碼
+# JSON 行一定以 "{" 開頭，MAGIC 不會與之衝突，因此同一條連線上兩種 frame 可以混用
+FRAME_MAGIC = 0xB7
+FRAME_HEADER = struct.Struct(">BH")
+MAX_BINARY_BODY = 0xFFFF
+
+_U8 = struct.Struct(">B")
+_U16 = struct.Struct(">H")
+_ASSIGN_ID = struct.Struct(">BI")
+_MOVE = struct.Struct(">4B")
+_PLACEMENT = struct.Struct(">BBc")
+_UPDATE_STATE = struct.Struct(">36sBB4BI")
+_DELTA_HEAD = struct.Struct(">IBcBB")
+_DELTA_CHANGE = struct.Struct(">BBc")
+
+# 無法以固定格式表示的訊息 (例如多了欄位) 改用 JSON 內容包在 binary frame 中
+CODE_JSON = 0xFF
+
+
+class CodecError(ValueError):
+    pass
+
+
+def encode_json(msg):
+    return json.dumps(msg).encode("utf-8") + b"\n"
+
+
+def decode_json(payload):
+    return json.loads(payload)
+
+
+def _pack_str(value):
+    data = value.encode("utf-8")
+    return _U16.pack(len(data)) + data
+
+
+def _unpack_str(body, offset):
+    (size,) = _U16.unpack_from(body, offset)
+    offset += 2
+    end = offset + size
+    if end > len(body):
+        raise CodecError("字串長度超出 frame")
+    return bytes(body[offset:end]).decode("utf-8"), end
+
+
+def _pid(value):
+    # 玩家 ID，None 以 0 表示
+    return 0 if value is None else value
+
+
+def _text_message(field):
+    def encode(msg):
+        return _pack_str(msg[field])
+
+    def decode(msg, body, offset):
+        msg[field], offset = _unpack_str(body, offset)
+        return offset
+
+    return encode, decode
+
+
+def _empty_encode(msg):
+    return b""
+
+
+def _empty_decode(msg, body, offset):
+    return offset
+
+
+def _encode_assign_id(msg):
+    return (
+        _ASSIGN_ID.pack(msg["player_id"], msg["global_player_id"])
+        + _pack_str(msg["my_nickname"])
+        + _pack_str(msg["opponent_nickname"])
+        + (_pack_str(msg["resume_token"]) if "resume_token" in msg else b"")
+    )
+
+
+def _decode_assign_id(msg, body, offset):
+    msg["player_id"], msg["global_player_id"] = _ASSIGN_ID.unpack_from(body, offset)
+    offset += _ASSIGN_ID.size
+    msg["my_nickname"], offset = _unpack_str(body, offset)
+    msg["opponent_nickname"], offset = _unpack_str(body, offset)
+    if offset < len(body):
+        msg["resume_token"], offset = _unpack_str(body, offset)
+    return offset
+
+
+def _encode_setup_data(msg):
+    placements = msg["placements"]
+    parts = [_U8.pack(len(placements))]
+    for p in placements:
+        if len(p) != 3:
+            raise CodecError("佈局欄位不符")
+        parts.append(_PLACEMENT.pack(p["row"], p["col"], p["ghost_type"].encode("ascii")))
+    return b"".join(parts)
+
+
+def _decode_setup_data(msg, body, offset):
+    (count,) = _U8.unpack_from(body, offset)
+    offset += 1
+    placements = []
+    for _ in range(count):
+        r, c, t = _PLACEMENT.unpack_from(body, offset)
+        offset += _PLACEMENT.size
+        placements.append({"row": r, "col": c, "ghost_type": t.decode("ascii")})
+    msg["placements"] = placements
+    return offset
+
+
+def _encode_move(msg):
+    from_r, from_c = msg["from_sq"]
+    to_r, to_c = msg["to_sq"]
+    return _MOVE.pack(from_r, from_c, to_r, to_c)
+
+
+def _decode_move(msg, body, offset):
+    from_r, from_c, to_r, to_c = _MOVE.unpack_from(body, offset)
+    msg["from_sq"] = [from_r, from_c]
+    msg["to_sq"] = [to_r, to_c]
+    return offset + _MOVE.size
+
+
+def _encode_update_state(msg):
+    board = msg["board"]
+    if len(board) != 6 or any(len(row) != 6 for row in board):
+        raise CodecError("棋盤大小不符")
+    cells = "".join("".join(row) for row in board).encode("ascii")
+    if len(cells) != 36:
+        raise CodecError("棋盤格子必須是單一字元")
+    seq = msg.get("seq", 0)
+    if "seq" in msg and seq < 1:
+        raise CodecError("seq 必須大於 0")
+    return (
+        _UPDATE_STATE.pack(
+            cells,
+            _pid(msg["current_player"]),
+            msg["my_player_id"],
+            msg["my_good_captured_by_opponent"],
+            msg["my_bad_captured_by_opponent"],
+            msg["opponent_good_captured_by_me"],
+            msg["opponent_bad_captured_by_me"],
+            seq,
+        )
+        + _pack_str(msg["last_action_desc"])
+        + _pack_str(msg["my_nickname"])
+        + _pack_str(msg["opponent_nickname"])
+    )
+
+
+def _decode_update_state(msg, body, offset):
+    cells, current, me, my_good, my_bad, opp_good, opp_bad, seq = _UPDATE_STATE.unpack_from(
+        body, offset
+    )
+    offset += _UPDATE_STATE.size
+    text = cells.decode("ascii")
+    msg["board"] = [list(text[r * 6 : r * 6 + 6]) for r in range(6)]
+    msg["current_player"] = current or None
+    msg["my_player_id"] = me
+    msg["my_good_captured_by_opponent"] = my_good
+    msg["my_bad_captured_by_opponent"] = my_bad
+    msg["opponent_good_captured_by_me"] = opp_good
+    msg["opponent_bad_captured_by_me"] = opp_bad
+    msg["last_action_desc"], offset = _unpack_str(body, offset)
+    msg["my_nickname"], offset = _unpack_str(body, offset)
+    msg["opponent_nickname"], offset = _unpack_str(body, offset)
+    if seq:
+        msg["seq"] = seq
+    return offset
+
+
+def _encode_state_delta(msg):
+    changes = msg["changes"]
+    captured = msg["captured"]
+    parts = [
+        _DELTA_HEAD.pack(
+            msg["seq"],
+            msg["mover"],
+            captured.encode("ascii") if captured else b"\0",
+            _pid(msg["turn"]),
+            len(changes),
+        )
+    ]
+    for r, c, piece in changes:
+        parts.append(_DELTA_CHANGE.pack(r, c, piece.encode("ascii")))
+    return b"".join(parts)
+
+
+def _decode_state_delta(msg, body, offset):
+    seq, mover, captured, turn, count = _DELTA_HEAD.unpack_from(body, offset)
+    offset += _DELTA_HEAD.size
+    changes = []
+    for _ in range(count):
+        r, c, piece = _DELTA_CHANGE.unpack_from(body, offset)
+        offset += _DELTA_CHANGE.size
+        changes.append([r, c, piece.decode("ascii")])
+    msg["seq"] = seq
+    msg["changes"] = changes
+    msg["mover"] = mover
+    msg["captured"] = None if captured == b"\0" else captured.decode("ascii")
+    msg["turn"] = turn or None
+    return offset
+
+
+def _encode_game_over(msg):
+    return _U8.pack(_pid(msg["winner"])) + _pack_str(msg["reason"])
+
+
+def _decode_game_over(msg, body, offset):
+    (winner,) = _U8.unpack_from(body, offset)
+    msg["winner"] = winner or None
+    msg["reason"], offset = _unpack_str(body, offset + 1)
+    return offset
+
+
+def _encode_nickname(msg):
+    if "protocol" in msg and msg["protocol"] < 1:
+        raise CodecError("protocol 必須大於 0")
+    return _U8.pack(msg.get("protocol", 0)) + _pack_str(msg["nickname"])
+
+
+def _decode_nickname(msg, body, offset):
+    (protocol,) = _U8.unpack_from(body, offset)
+    msg["nickname"], offset = _unpack_str(body, offset + 1)
+    if protocol:
+        msg["protocol"] = protocol
+    return offset
+
+
+# (代碼, 訊息類型, 必要欄位, 選用欄位, encode, decode)
+_SCHEMAS = [
+    (
+        1,
+        constants.MSG_TYPE_ASSIGN_ID,
+        ("player_id", "global_player_id", "my_nickname", "opponent_nickname"),
+        ("resume_token",),
+        _encode_assign_id,
+        _decode_assign_id,
+    ),
+    (2, constants.MSG_TYPE_WAIT_OPPONENT, (), (), _empty_encode, _empty_decode),
+    (3, constants.MSG_TYPE_START_SETUP, (), (), _empty_encode, _empty_decode),
+    (4, constants.MSG_TYPE_SETUP_DATA, ("placements",), (), _encode_setup_data, _decode_setup_data),
+    (5, constants.MSG_TYPE_SETUP_INVALID, ("message",), (), *_text_message("message")),
+    (6, constants.MSG_TYPE_YOUR_TURN, (), (), _empty_encode, _empty_decode),
+    (7, constants.MSG_TYPE_OPPONENT_TURN, (), (), _empty_encode, _empty_decode),
+    (8, constants.MSG_TYPE_MOVE, ("from_sq", "to_sq"), (), _encode_move, _decode_move),
+    (9, constants.MSG_TYPE_INVALID_MOVE, ("message",), (), *_text_message("message")),
+    (
+        10,
+        constants.MSG_TYPE_UPDATE_STATE,
+        (
+            "board",
+            "current_player",
+            "my_player_id",
+            "my_good_captured_by_opponent",
+            "my_bad_captured_by_opponent",
+            "opponent_good_captured_by_me",
+            "opponent_bad_captured_by_me",
+            "last_action_desc",
+            "my_nickname",
+            "opponent_nickname",
+        ),
+        ("seq",),
+        _encode_update_state,
+        _decode_update_state,
+    ),
+    (
+        11,
+        constants.MSG_TYPE_GAME_OVER,
+        ("winner", "reason"),
+        (),
+        _encode_game_over,
+        _decode_game_over,
+    ),
+    (12, constants.MSG_TYPE_ERROR, ("message",), (), *_text_message("message")),
+    (13, constants.MSG_TYPE_INFO, ("message",), (), *_text_message("message")),
+    (
+        14,
+        constants.MSG_TYPE_STATE_DELTA,
+        ("seq", "changes", "mover", "captured", "turn"),
+        (),
+        _encode_state_delta,
+        _decode_state_delta,
+    ),
+    (15, constants.MSG_TYPE_RESYNC, (), (), _empty_encode, _empty_decode),
+    (
+        16,
+        constants.MSG_TYPE_NICKNAME,
+        ("nickname",),
+        ("protocol",),
+        _encode_nickname,
+        _decode_nickname,
+    ),
+    (17, constants.MSG_TYPE_RESUME, ("token",), (), *_text_message("token")),
+    (18, constants.MSG_TYPE_RESUME_FAILED, ("message",), (), *_text_message("message")),
+    (19, constants.MSG_TYPE_PING, (), (), _empty_encode, _empty_decode),
+    (20, constants.MSG_TYPE_PONG, (), (), _empty_encode, _empty_decode),
+]
+
+_ENCODERS = {}  # 訊息類型 -> (代碼 byte, 必要欄位數, 允許欄位, encode)
+_DECODERS = {}  # 代碼 -> (訊息類型, decode)
+for _code, _type, _required, _optional, _encode, _decode in _SCHEMAS:
+    _ENCODERS[_type] = (
+        _U8.pack(_code),
+        frozenset(("type",) + _required),
+        frozenset(("type",) + _required + _optional),
+        _encode,
+    )
+    _DECODERS[_code] = (_type, _decode)
+
+
+def _frame(body):
+    if len(body) > MAX_BINARY_BODY:
+        raise CodecError("訊息過大，無法以 binary frame 傳送")
+    return FRAME_HEADER.pack(FRAME_MAGIC, len(body)) + body
+
+
+def encode_binary(msg):
+    # 已知的訊息類型以 struct 打包；欄位不符或值超出範圍時退回包在 binary frame 內的 JSON
+    schema = _ENCODERS.get(msg.get("type"))
+    if schema is not None:
+        code, required, allowed, encode = schema
+        keys = msg.keys()
+        if required <= keys <= allowed:
+            try:
+                return _frame(code + encode(msg))
+            except (AttributeError, KeyError, TypeError, ValueError, struct.error):
+                pass
+    return _frame(bytes((CODE_JSON,)) + json.dumps(msg).encode("utf-8"))
+
+
+def decode_binary(body):
+    # 解開一個 binary frame 的 body (不含 header)
+    try:
+        code = body[0]
+        if code == CODE_JSON:
+            msg = json.loads(bytes(body[1:]))
+            if not isinstance(msg, dict):
+                # 和 JSON 行一樣，只接受物件
+                raise CodecError("JSON 訊息不是物件")
+            return msg
+        entry = _DECODERS.get(code)
+        if entry is None:
+            raise CodecError(f"未知的訊息代碼 {code}")
+        msg_type, decode = entry
+        msg = {"type": msg_type}
+        if decode(msg, body, 1) != len(body):
+            raise CodecError("frame 長度與內容不符")
+        return msg
+    except (IndexError, UnicodeDecodeError, json.JSONDecodeError, struct.error) as e:
+        raise CodecError(f"無效的 binary frame: {e}") from e
+
+
+ENCODERS = {ENCODING_JSON: encode_json, ENCODING_BINARY: encode_binary}
+
+
+def decode_frame(is_binary, payload):
+    # 依 frame 種類解碼成訊息 dict
+    return decode_binary(payload) if is_binary else decode_json(payload)
+
@@ -16,6 +16,9 @@ P2_GOOD_CHAR = "G"  # 好鬼
 P2_BAD_CHAR = "B"  # 壞鬼
 P2_ESCAPE_CORNERS = [(0, 0), (0, 5)]  # 逃脫點
 
+# 佈局區域的行 (雙方相同)
+SETUP_COLS = [1, 2, 3, 4]
+
 # Client 顯示的對手棋子
 OPPONENT_GHOST_CHAR = "X"  # 未現形
 EMPTY_SQUARE_CHAR = "."  # 空格
@@ -34,3 +37,28 @@ MSG_TYPE_UPDATE_STATE = "update_state"
 MSG_TYPE_GAME_OVER = "game_over"
 MSG_TYPE_ERROR = "error"
 MSG_TYPE_INFO = "info"
+MSG_TYPE_STATE_DELTA = "state_delta"  # 協定 v2：每步只送變動的格子
+MSG_TYPE_RESYNC = "resync"  # 協定 v2：client 要求完整快照
+MSG_TYPE_NICKNAME = "nickname"
+MSG_TYPE_HELLO = "hello"  # client 要求改用其他編碼 (見 common/codec.py)
+MSG_TYPE_HELLO_ACK = "hello_ack"  # server 確認編碼，之後的訊息改用該編碼
+MSG_TYPE_RESUME = "resume"  # 斷線後以 assign_id 的 resume_token 回到原本的房間
+MSG_TYPE_RESUME_FAILED = "resume_failed"  # token 無效或對局已結束
+MSG_TYPE_WATCH = "watch"  # 觀戰：room_id 省略時觀看觀戰人數最多的房間
+MSG_TYPE_WATCH_ACK = "watch_ack"  # 開始觀戰 (房間編號與雙方暱稱)
+MSG_TYPE_WATCH_FAILED = "watch_failed"  # 找不到房間，附上目前可觀戰的房間編號
+MSG_TYPE_SPECTATE_STATE = "spectate_state"  # 觀戰者視角的完整狀態 (雙方的鬼都不顯示好壞)
+MSG_TYPE_PING = "ping"  # 心跳：收到的一方回覆 pong (server 對閒置的連線送出)
+MSG_TYPE_PONG = "pong"
+MSG_TYPE_CLOCK = "clock"  # 時間限制與雙方剩下的時間 (遊戲開始、resync 與重新連線時送出)
+
+# 協定版本 (client 在 nickname 訊息帶 "protocol" 欄位選用)
+PROTOCOL_VERSION_FULL = 1  # 每步送完整棋盤 + 回合訊息
+PROTOCOL_VERSION_DELTA = 2  # 每步每位玩家一則差量訊息，回合合併在內
+
+# 勝負原因代碼
+WIN_REASON_CAPTURE_ALL_GOOD = "capture_all_good"  # 吃掉對手所有好鬼
+WIN_REASON_LOSE_ALL_BAD = "lose_all_bad"  # 自己的壞鬼全被吃掉
+WIN_REASON_ESCAPE = "escape"  # 好鬼逃脫
+WIN_REASON_DISCONNECT = "disconnect"  # 對手斷線或違規
+WIN_REASON_TIMEOUT = "timeout"  # 超過每步時限或用完總時間
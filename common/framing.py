@@ -0,0 +1,152 @@
+import time
+
+from common.codec import FRAME_HEADER, FRAME_MAGIC, MAX_BINARY_BODY
+
+# 單一 frame (JSON 行或 binary body) 的上限；正常訊息不到 1KB
+MAX_FRAME_SIZE = 4096
+# client 端接收上限：server 送出的狀態含雙方暱稱，可能比 client 送出的訊息大
+CLIENT_MAX_FRAME_SIZE = MAX_BINARY_BODY
+# server 對每條連線的速率上限 (每秒)，超過即斷線
+MAX_BYTES_PER_SEC = 256 * 1024
+MAX_FRAMES_PER_SEC = 500
+
+
+class FrameError(ValueError):
+    # 對方違反 frame 大小或速率限制，呼叫端應中斷連線
+    pass
+
+
+class FrameReader:
+    # 固定大小的接收緩衝區：以 recv_into 直接寫入 bytearray，切 frame 時不搬移整個緩衝區
+    # 只有緩衝區寫滿時才把尚未完整的最後一個 frame 移回開頭 (最多 max_frame bytes)
+    __slots__ = (
+        "buf",
+        "view",
+        "capacity",
+        "start",
+        "end",
+        "scan",
+        "max_frame",
+        "max_bytes_per_sec",
+        "max_frames_per_sec",
+        "clock",
+        "window_start",
+        "window_bytes",
+        "window_frames",
+    )
+
+    def __init__(
+        self,
+        max_frame=MAX_FRAME_SIZE,
+        max_bytes_per_sec=None,
+        max_frames_per_sec=None,
+        clock=time.monotonic,
+    ):
+        self.max_frame = max_frame
+        # 一個上限大小的 frame 連同 header 或換行一定放得下
+        self.capacity = max_frame + FRAME_HEADER.size + 1
+        self.buf = bytearray(self.capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0  # 尚未處理的資料起點
+        self.end = 0  # 已收到的資料終點
+        self.scan = 0  # 目前這行 JSON 已找過換行的位置，避免重複掃描
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_frames_per_sec = max_frames_per_sec
+        self.clock = clock
+        self.window_start = clock()
+        self.window_bytes = 0
+        self.window_frames = 0
+
+    def get_buffer(self):
+        # 回傳可寫入的空間 (給 recv_into 或 asyncio.BufferedProtocol.get_buffer)
+        if self.end == self.capacity:
+            self._compact()
+        return self.view[self.end :]
+
+    def recv(self, sock):
+        # 從 socket 讀一次，回傳完整的 frame list；對方關閉連線時回傳 None
+        n = sock.recv_into(self.get_buffer())
+        if not n:
+            return None
+        return self.consume(n)
+
+    def feed(self, data):
+        # 給已拿到 bytes 的呼叫端 (例如 asyncio StreamReader) 使用
+        frames = []
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            target = self.get_buffer()
+            n = min(len(target), len(data) - pos)
+            target[:n] = data[pos : pos + n]
+            pos += n
+            frames += self.consume(n)
+        return frames
+
+    def pending(self):
+        # 尚未組成完整 frame 的 bytes (把連線交給另一個 process 時一併帶走)
+        return bytes(self.view[self.start : self.end])
+
+    def consume(self, nbytes):
+        # 緩衝區新寫入 nbytes 後切出完整的 [(is_binary, payload bytes), ...]
+        self.end += nbytes
+        buf = self.buf
+        pos = self.start
+        end = self.end
+        frames = []
+        while pos < end:
+            if buf[pos] == FRAME_MAGIC:
+                if end - pos < FRAME_HEADER.size:
+                    break
+                _, size = FRAME_HEADER.unpack_from(buf, pos)
+                if size > self.max_frame:
+                    raise FrameError(f"binary frame 過大 ({size} bytes)")
+                body = pos + FRAME_HEADER.size
+                if end - body < size:
+                    break
+                frames.append((True, bytes(self.view[body : body + size])))
+                pos = body + size
+            else:
+                newline = buf.find(b"\n", max(pos, self.scan), end)
+                if newline < 0:
+                    if end - pos > self.max_frame:
+                        raise FrameError(f"訊息超過 {self.max_frame} bytes 仍未換行")
+                    self.scan = end
+                    break
+                frames.append((False, bytes(self.view[pos:newline])))
+                pos = newline + 1
+        if pos == end:
+            self.start = self.end = self.scan = 0
+        else:
+            self.start = pos
+        self._charge(nbytes, len(frames))
+        return frames
+
+    def _compact(self):
+        # 把未完整的 frame 移到緩衝區開頭 (consume 已保證它不超過 max_frame)
+        remaining = self.end - self.start
+        self.buf[:remaining] = self.view[self.start : self.end]
+        self.scan = max(0, self.scan - self.start)
+        self.start = 0
+        self.end = remaining
+
+    def _charge(self, nbytes, nframes):
+        # 以每秒為一個視窗累計流量，超過上限時拋出 FrameError
+        if self.max_bytes_per_sec is None and self.max_frames_per_sec is None:
+            return
+        now = self.clock()
+        if now - self.window_start >= 1.0:
+            self.window_start = now
+            self.window_bytes = 0
+            self.window_frames = 0
+        self.window_bytes += nbytes
+        self.window_frames += nframes
+        if self.max_bytes_per_sec is not None and self.window_bytes > self.max_bytes_per_sec:
+            raise FrameError(f"每秒傳送超過 {self.max_bytes_per_sec} bytes")
+        if self.max_frames_per_sec is not None and self.window_frames > self.max_frames_per_sec:
+            raise FrameError(f"每秒傳送超過 {self.max_frames_per_sec} 則訊息")
+
+
+def server_reader():
+    # server 端每條連線使用的 reader：限制 frame 大小與速率
+    return FrameReader(MAX_FRAME_SIZE, MAX_BYTES_PER_SEC, MAX_FRAMES_PER_SEC)
@@ -0,0 +1,113 @@
+import os
+import random
+import struct
+from itertools import combinations
+
+from common import constants
+
+# 佈局開局庫：雙方各 70 種佈局 (佈局區域 8 格中選 4 格放好鬼) 兩兩對戰的 70x70 結果
+# 佈局以 1 byte 表示，bit i 為佈局區域第 i 格 (列優先，同 gamelog.setup_byte) 是否為好鬼
+SETUPS = tuple(sum(1 << i for i in combo) for combo in combinations(range(8), 4))
+SETUP_INDEX = {setup: i for i, setup in enumerate(SETUPS)}
+DEFAULT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "setup_book.gsb"
+)
+# 推薦佈局時從勝率最高的幾種中隨機挑一種，避免每局都一樣被對手摸清
+TOP_CHOICES = 5
+
+# 檔案格式：標頭 (magic, 版本, fingerprint 長度)、fingerprint (產生結果的策略與規則)，
+# 之後每組 (玩家 1 佈局, 玩家 2 佈局) 依序三個 uint32：局數、玩家 1 勝場、玩家 2 勝場
+BOOK_MAGIC = b"GSB1"
+BOOK_VERSION = 1
+_HEADER = struct.Struct(">4sBH")
+_CELLS = struct.Struct(f">{3 * len(SETUPS) ** 2}I")
+
+
+class SetupBook:
+    def __init__(self, fingerprint="", cells=None):
+        self.fingerprint = fingerprint
+        self.cells = list(cells) if cells is not None else [0] * (3 * len(SETUPS) ** 2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, size = _HEADER.unpack_from(data)
+        if magic != BOOK_MAGIC or version != BOOK_VERSION:
+            raise ValueError(f"{path} 不是佈局開局庫檔案")
+        fingerprint = data[_HEADER.size : _HEADER.size + size].decode("utf-8")
+        return cls(fingerprint, _CELLS.unpack_from(data, _HEADER.size + size))
+
+    def save(self, path):
+        # 先寫暫存檔再改名，產生途中中斷也不會留下壞掉的檔案
+        fingerprint = self.fingerprint.encode("utf-8")
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(BOOK_MAGIC, BOOK_VERSION, len(fingerprint)))
+            f.write(fingerprint)
+            f.write(_CELLS.pack(*self.cells))
+        os.replace(tmp, path)
+
+    def cell(self, index1, index2):
+        # (局數, 玩家 1 勝場, 玩家 2 勝場)；index 為 SETUPS 中的位置
+        base = 3 * (index1 * len(SETUPS) + index2)
+        return tuple(self.cells[base : base + 3])
+
+    def add(self, index1, index2, games, wins1, wins2):
+        base = 3 * (index1 * len(SETUPS) + index2)
+        self.cells[base] += games
+        self.cells[base + 1] += wins1
+        self.cells[base + 2] += wins2
+
+    def win_rates(self, player_id):
+        # 每種佈局對上所有對手佈局的平均得分 (和局算半場)：[(佈局, 得分率, 局數)]，依得分率排序
+        result = []
+        for mine in range(len(SETUPS)):
+            games = wins = draws = 0
+            for theirs in range(len(SETUPS)):
+                if player_id == constants.P1_ID:
+                    n, won, lost = self.cell(mine, theirs)
+                else:
+                    n, lost, won = self.cell(theirs, mine)
+                games += n
+                wins += won
+                draws += n - won - lost
+            if games:
+                result.append((SETUPS[mine], (wins + 0.5 * draws) / games, games))
+        result.sort(key=lambda item: -item[1])
+        return result
+
+    def choose(self, player_id, rng=random, top=TOP_CHOICES):
+        # 從得分率最高的 top 種佈局中隨機挑一種；開局庫是空的時完全隨機
+        rates = self.win_rates(player_id)
+        if not rates:
+            return rng.choice(SETUPS)
+        return rng.choice(rates[:top])[0]
+
+
+def load_default(path=DEFAULT_PATH):
+    # 讀取開局庫，檔案不存在或格式不符時回傳 None (呼叫端改用原本的佈局方式)
+    try:
+        return SetupBook.load(path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def setup_cells(player_id):
+    # 佈局區域的 8 格 (列, 行)，順序即佈局 byte 的 bit 順序
+    rows = constants.P1_SETUP_ROWS if player_id == constants.P1_ID else constants.P2_SETUP_ROWS
+    return [(r, c) for r in rows for c in constants.SETUP_COLS]
+
+
+def setup_from_cells(player_id, good_cells):
+    # 好鬼所在的 (列, 行) -> 佈局 byte
+    good_cells = set(good_cells)
+    return sum(1 << i for i, cell in enumerate(setup_cells(player_id)) if cell in good_cells)
+
+
+def placements(player_id, setup):
+    # 佈局 byte -> setup_data 訊息的 placements (好鬼以外的格子都放壞鬼)
+    return [
+        {"row": r, "col": c, "ghost_type": "G" if setup >> i & 1 else "B"}
+        for i, (r, c) in enumerate(setup_cells(player_id))
+    ]
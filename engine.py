@@ -0,0 +1,248 @@
+from collections import namedtuple
+
+import zobrist
+from bitboard import BAD, BIT, ESCAPE_MASK, GOOD, NEIGHBORS, BitBoard, square
+from common import constants
+
+# 佈局錯誤代碼
+SETUP_BAD_COUNT = "bad_count"  # 棋子數不是 8
+SETUP_BAD_COMPOSITION = "bad_composition"  # 好鬼/壞鬼不是各 4 個
+SETUP_BAD_POSITION = "bad_position"  # 位置不在佈局區域
+SETUP_DUPLICATE = "duplicate"  # 同一格放了兩個棋子
+SETUP_LOCKED = "locked"  # 遊戲已開始，不能再佈局
+
+# 移動錯誤代碼
+MOVE_GAME_OVER = "game_over"
+MOVE_NOT_YOUR_TURN = "not_your_turn"
+MOVE_OUT_OF_BOUNDS = "out_of_bounds"
+MOVE_NOT_YOUR_PIECE = "not_your_piece"
+MOVE_NOT_ADJACENT = "not_adjacent"
+MOVE_OWN_PIECE = "own_piece"
+
+# square: 發生錯誤的 (列, 行)
+SetupResult = namedtuple("SetupResult", "ok error square")
+# frm/to 為格子編號；moved/captured 為鬼種類 ("G"/"B"/None)；winner/reason 為勝負結果
+MoveResult = namedtuple("MoveResult", "ok error player frm to moved captured winner reason")
+
+_SETUP_OK = SetupResult(True, None, None)
+
+
+def setup_squares(player_id):
+    # 指定玩家佈局區域的 8 個格子編號
+    rows = constants.P1_SETUP_ROWS if player_id == 1 else constants.P2_SETUP_ROWS
+    return tuple(square(r, c) for r in rows for c in constants.SETUP_COLS)
+
+
+SETUP_SQUARES = (None, setup_squares(1), setup_squares(2))
+SETUP_MASK = (0, sum(BIT[sq] for sq in SETUP_SQUARES[1]), sum(BIT[sq] for sq in SETUP_SQUARES[2]))
+
+
+def _is_coord(v):
+    return type(v) is int and 0 <= v < 6
+
+
+def _move_error(player_id, error):
+    return MoveResult(False, error, player_id, None, None, None, None, None, None)
+
+
+class GameState:
+    # 不依賴 socket 的幽靈棋規則引擎，所有操作回傳結構化結果
+    __slots__ = (
+        "bb",
+        "captured",
+        "turn",
+        "winner",
+        "reason",
+        "ply",
+        "history",
+        "ready",
+        "zobrist",
+    )
+
+    def __init__(self):
+        self.bb = BitBoard()
+        self.captured = [None, [0, 0], [0, 0]]  # captured[pid] = [吃掉的好鬼, 吃掉的壞鬼]
+        self.turn = None  # 輪到的玩家，None 表示尚未開始
+        self.winner = None
+        self.reason = None  # constants.WIN_REASON_*
+        self.ply = 0  # 已走的步數
+        self.history = []  # undo 用的移動紀錄
+        self.ready = [False, False, False]  # 雙方是否已完成佈局
+        self.zobrist = [0, 0, 0]  # 三部分的局面 hash (見 zobrist.py)，遊戲開始後每步更新
+
+    def copy(self):
+        other = GameState.__new__(GameState)
+        other.bb = self.bb.copy()
+        other.captured = [None, self.captured[1][:], self.captured[2][:]]
+        other.turn = self.turn
+        other.winner = self.winner
+        other.reason = self.reason
+        other.ply = self.ply
+        other.history = self.history[:]
+        other.ready = self.ready[:]
+        other.zobrist = self.zobrist[:]
+        return other
+
+    @property
+    def over(self):
+        return self.winner is not None
+
+    def key(self):
+        # 完整局面 (含雙方鬼的身分) 的 Zobrist hash
+        h = self.zobrist
+        return h[0] ^ h[1] ^ h[2]
+
+    def view_key(self, player_id):
+        # player_id 看得到的局面 (對手的鬼不分好壞) 的 hash，搜尋樹以資訊集為節點時使用
+        return self.zobrist[0] ^ self.zobrist[player_id]
+
+    def apply_setup(self, player_id, placements):
+        # 驗證並套用佈局 (placements 為 {"row", "col", "ghost_type"} 的 list)
+        if self.turn is not None:
+            return SetupResult(False, SETUP_LOCKED, None)
+        if not isinstance(placements, list) or len(placements) != 8:
+            return SetupResult(False, SETUP_BAD_COUNT, None)
+        if not all(isinstance(p, dict) for p in placements):
+            return SetupResult(False, SETUP_BAD_COMPOSITION, None)
+        good = sum(1 for p in placements if p.get("ghost_type") == GOOD)
+        bad = sum(1 for p in placements if p.get("ghost_type") == BAD)
+        if good != 4 or bad != 4:
+            return SetupResult(False, SETUP_BAD_COMPOSITION, None)
+        rows = constants.P1_SETUP_ROWS if player_id == 1 else constants.P2_SETUP_ROWS
+        placed = 0
+        good_mask = 0
+        for p in placements:
+            r, c = p.get("row"), p.get("col")
+            if not (_is_coord(r) and _is_coord(c)) or r not in rows or c not in constants.SETUP_COLS:
+                return SetupResult(False, SETUP_BAD_POSITION, (r, c))
+            bit = BIT[square(r, c)]
+            if placed & bit:
+                return SetupResult(False, SETUP_DUPLICATE, (r, c))
+            placed |= bit
+            if p["ghost_type"] == GOOD:
+                good_mask |= bit
+        self.bb.good[player_id] = good_mask
+        self.bb.bad[player_id] = placed ^ good_mask
+        self.ready[player_id] = True
+        return _SETUP_OK
+
+    def setup_from_good(self, player_id, good_squares):
+        # 快速佈局 (不驗證)：good_squares 放好鬼，其餘佈局格放壞鬼
+        good_mask = 0
+        for sq in good_squares:
+            good_mask |= BIT[sq]
+        self.bb.good[player_id] = good_mask
+        self.bb.bad[player_id] = SETUP_MASK[player_id] ^ good_mask
+        self.ready[player_id] = True
+
+    def start(self, first_player):
+        # 雙方佈局完成後開始遊戲，由 first_player 先手
+        self.turn = first_player
+        self.zobrist = zobrist.compute(self)
+
+    def legal_moves(self):
+        # 輪到的玩家所有合法移動 (frm, to)，遊戲結束時為空
+        if self.winner is not None or self.turn is None:
+            return []
+        return self.bb.legal_moves(self.turn)
+
+    def apply_move(self, player_id, from_sq, to_sq):
+        # 驗證並執行一步移動，from_sq/to_sq 為 (列, 行)
+        if self.winner is not None:
+            return _move_error(player_id, MOVE_GAME_OVER)
+        if self.turn != player_id:
+            return _move_error(player_id, MOVE_NOT_YOUR_TURN)
+        try:
+            from_r, from_c = from_sq
+            to_r, to_c = to_sq
+        except (TypeError, ValueError):
+            return _move_error(player_id, MOVE_OUT_OF_BOUNDS)
+        if not all(_is_coord(v) for v in (from_r, from_c, to_r, to_c)):
+            return _move_error(player_id, MOVE_OUT_OF_BOUNDS)
+        frm = square(from_r, from_c)
+        to = square(to_r, to_c)
+        own = self.bb.occupied(player_id)
+        if not own & BIT[frm]:
+            return _move_error(player_id, MOVE_NOT_YOUR_PIECE)
+        if not NEIGHBORS[frm] & BIT[to]:
+            return _move_error(player_id, MOVE_NOT_ADJACENT)
+        if own & BIT[to]:
+            return _move_error(player_id, MOVE_OWN_PIECE)
+        return self.push(frm, to)
+
+    def push(self, frm, to):
+        # 執行一步已知合法的移動 (例如來自 legal_moves)，不做驗證
+        player = self.turn
+        moved, captured = self.bb.move(player, frm, to)
+        # hash 更新與 _hash_move 相同，走子是最常執行的路徑所以直接展開
+        h = self.zobrist
+        occupied = zobrist.OCCUPIED[player]
+        h[0] ^= occupied[frm] ^ occupied[to]
+        if moved == GOOD:
+            good = zobrist.GOOD_GHOST[player]
+            h[player] ^= good[frm] ^ good[to]
+        if captured is not None:
+            opp = 3 - player
+            h[0] ^= zobrist.OCCUPIED[opp][to]
+            kind = 0 if captured == GOOD else 1
+            if kind == 0:
+                h[opp] ^= zobrist.GOOD_GHOST[opp][to]
+            count = self.captured[player][kind]
+            keys = zobrist.CAPTURED[player][kind]
+            h[0] ^= keys[count] ^ keys[count + 1]
+            self.captured[player][kind] = count + 1
+        self.history.append((player, frm, to, moved, captured))
+        self.ply += 1
+        winner, reason = self._check_win(player, moved, to)
+        if winner is not None:
+            self.winner = winner
+            self.reason = reason
+        else:
+            self.turn = 3 - player
+            self.zobrist[0] ^= zobrist.SIDE_TO_MOVE
+        return MoveResult(True, None, player, frm, to, moved, captured, winner, reason)
+
+    def undo(self):
+        # 撤銷最後一步
+        player, frm, to, moved, captured = self.history.pop()
+        self.bb.unmove(player, frm, to, moved, captured)
+        self._hash_move(player, frm, to, moved, captured)
+        if captured is not None:
+            kind = 0 if captured == GOOD else 1
+            count = self.captured[player][kind]
+            keys = zobrist.CAPTURED[player][kind]
+            self.zobrist[0] ^= keys[count] ^ keys[count - 1]
+            self.captured[player][kind] = count - 1
+        if self.winner is None:
+            self.zobrist[0] ^= zobrist.SIDE_TO_MOVE
+        self.ply -= 1
+        self.turn = player
+        self.winner = None
+        self.reason = None
+
+    def _hash_move(self, player, frm, to, moved, captured):
+        # 移動與吃子對 hash 的影響 (XOR 兩次即還原，push 與 undo 共用)
+        h = self.zobrist
+        occupied = zobrist.OCCUPIED[player]
+        h[0] ^= occupied[frm] ^ occupied[to]
+        if moved == GOOD:
+            good = zobrist.GOOD_GHOST[player]
+            h[player] ^= good[frm] ^ good[to]
+        if captured is not None:
+            opp = 3 - player
+            h[0] ^= zobrist.OCCUPIED[opp][to]
+            if captured == GOOD:
+                h[opp] ^= zobrist.GOOD_GHOST[opp][to]
+
+    def _check_win(self, player, moved, to):
+        # 勝負判斷，順序與原本 Room.check_win 相同
+        opp = 3 - player
+        if self.captured[player][0] >= 4:
+            return player, constants.WIN_REASON_CAPTURE_ALL_GOOD
+        if self.captured[opp][1] >= 4:
+            return player, constants.WIN_REASON_LOSE_ALL_BAD
+        if self.captured[player][1] >= 4:
+            return opp, constants.WIN_REASON_LOSE_ALL_BAD
+        if moved == GOOD and ESCAPE_MASK[player] & BIT[to]:
+            return player, constants.WIN_REASON_ESCAPE
+        return None, None
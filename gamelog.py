@@ -0,0 +1,387 @@
+import argparse
+import glob
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+import engine
+from bitboard import BAD, BIT, GOOD
+from common import constants
+from server_log import get_logger
+
+log = get_logger("gamelog")
+
+# 對局紀錄檔：segment 檔頭之後是一筆筆 [長度(4) + CRC32(4) + 內容]，只會附加不會修改
+SEGMENT_MAGIC = b"GLOG"
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = ".glog"
+DEFAULT_PREFIX = "games"
+# segment 超過這個大小或存在太久就換新檔
+MAX_SEGMENT_BYTES = 64 * 1024 * 1024
+MAX_SEGMENT_AGE = 3600.0
+# 背景 thread 寫出與 fsync 的間隔 (秒)
+FLUSH_INTERVAL = 0.2
+FSYNC_INTERVAL = 1.0
+
+_SEGMENT_HEAD = struct.Struct(">4sB")
+_RECORD_FRAME = struct.Struct(">II")
+# 房號、開始時間 (epoch)、對局毫秒數、雙方玩家 ID、先手、勝方、原因代碼、雙方佈局、步數
+_RECORD_HEAD = struct.Struct(">IdIIIBBBBBH")
+_MOVE = struct.Struct(">H")
+_U8 = struct.Struct(">B")
+
+# 勝負原因代碼 (0 表示沒有勝負，例如伺服器關閉)
+REASON_CODES = {
+    None: 0,
+    constants.WIN_REASON_CAPTURE_ALL_GOOD: 1,
+    constants.WIN_REASON_LOSE_ALL_BAD: 2,
+    constants.WIN_REASON_ESCAPE: 3,
+    constants.WIN_REASON_DISCONNECT: 4,
+    constants.WIN_REASON_TIMEOUT: 5,
+}
+REASONS = {code: reason for reason, code in REASON_CODES.items()}
+
+# 每步 2 bytes：出發格 (6 bits) + 方向 (2 bits) + 吃到的鬼 (2 bits)
+DIRECTIONS = (-6, 6, -1, 1)
+CAPTURE_CODES = {None: 0, GOOD: 1, BAD: 2}
+CAPTURES = (None, GOOD, BAD)
+
+# players/nicknames: (玩家 1, 玩家 2)；setups: 各玩家佈局格中好鬼的位置 (bit i 對應 SETUP_SQUARES[pid][i])
+# moves: [(玩家, 出發格, 目的格, 吃到的鬼), ...]
+GameRecord = namedtuple(
+    "GameRecord",
+    "room_id started_at duration players nicknames first_player setups moves winner reason",
+)
+
+
+class GameLogError(ValueError):
+    pass
+
+
+def setup_byte(player_id, good_mask):
+    # 佈局區域 8 格中哪幾格是好鬼 (其餘為壞鬼)
+    value = 0
+    for i, sq in enumerate(engine.SETUP_SQUARES[player_id]):
+        if good_mask & BIT[sq]:
+            value |= 1 << i
+    return value
+
+
+def good_squares(player_id, value):
+    # setup_byte 的反向：好鬼所在的格子編號
+    return [sq for i, sq in enumerate(engine.SETUP_SQUARES[player_id]) if value >> i & 1]
+
+
+def _pack_name(name):
+    # 最多 255 bytes，在字元邊界截斷 (不留半個 UTF-8 字元)
+    data = name.encode("utf-8", "replace")[:255].decode("utf-8", "ignore").encode("utf-8")
+    return _U8.pack(len(data)) + data
+
+
+def _unpack_name(body, offset):
+    (size,) = _U8.unpack_from(body, offset)
+    offset += 1
+    return bytes(body[offset : offset + size]).decode("utf-8", "replace"), offset + size
+
+
+def encode_record(record):
+    # GameRecord -> 內容 bytes (不含長度與 CRC)
+    parts = [
+        _RECORD_HEAD.pack(
+            record.room_id,
+            record.started_at,
+            round(record.duration * 1000),
+            record.players[0],
+            record.players[1],
+            record.first_player,
+            record.winner or 0,
+            REASON_CODES[record.reason],
+            record.setups[0],
+            record.setups[1],
+            len(record.moves),
+        ),
+        _pack_name(record.nicknames[0]),
+        _pack_name(record.nicknames[1]),
+    ]
+    for _, frm, to, captured in record.moves:
+        parts.append(_MOVE.pack(frm | DIRECTIONS.index(to - frm) << 6 | CAPTURE_CODES[captured] << 8))
+    return b"".join(parts)
+
+
+def split_record(body):
+    # 內容 -> (固定標頭 bytes, 玩家 1 暱稱, 玩家 2 暱稱, 移動 bytes)，不解碼個別移動
+    offset = _RECORD_HEAD.size
+    nick1, offset = _unpack_name(body, offset)
+    nick2, offset = _unpack_name(body, offset)
+    return body[: _RECORD_HEAD.size], nick1, nick2, body[offset:]
+
+
+def decode_record(body):
+    head, nick1, nick2, move_bytes = split_record(body)
+    (
+        room_id,
+        started_at,
+        duration_ms,
+        gid1,
+        gid2,
+        first_player,
+        winner,
+        reason,
+        setup1,
+        setup2,
+        count,
+    ) = _RECORD_HEAD.unpack(head)
+    moves = []
+    player = first_player
+    for (code,) in _MOVE.iter_unpack(move_bytes[: count * _MOVE.size]):
+        frm = code & 0x3F
+        moves.append((player, frm, frm + DIRECTIONS[code >> 6 & 3], CAPTURES[code >> 8 & 3]))
+        player = 3 - player
+    return GameRecord(
+        room_id,
+        started_at,
+        duration_ms / 1000,
+        (gid1, gid2),
+        (nick1, nick2),
+        first_player,
+        (setup1, setup2),
+        moves,
+        winner or None,
+        REASONS.get(reason),
+    )
+
+
+def replay(record):
+    # 依紀錄重建對局，回傳最後的 GameState (用來驗證或分析)
+    game = engine.GameState()
+    for player_id in (1, 2):
+        game.setup_from_good(player_id, good_squares(player_id, record.setups[player_id - 1]))
+    game.start(record.first_player)
+    for _, frm, to, _ in record.moves:
+        game.push(frm, to)
+    return game
+
+
+class GameLogWriter:
+    # 背景 thread 批次寫出對局紀錄：房間只把 GameRecord 放進 queue，編碼、寫檔與 fsync 都在背景進行
+    # 每次啟動都開新的 segment，不會接續寫入可能只寫了一半的舊檔
+    def __init__(
+        self,
+        directory,
+        prefix=DEFAULT_PREFIX,
+        max_segment_bytes=MAX_SEGMENT_BYTES,
+        max_segment_age=MAX_SEGMENT_AGE,
+        flush_interval=FLUSH_INTERVAL,
+        fsync_interval=FSYNC_INTERVAL,
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.segment_index = 0
+        self.segment_bytes = 0
+        self.segment_opened = 0.0
+        self.records = 0
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        # 接在同一個 prefix 既有的 segment 編號之後
+        for path in list_segments(self.directory, self.prefix):
+            prefix, index = _split_segment(path)
+            if prefix == self.prefix:
+                self.segment_index = max(self.segment_index, index)
+        self.thread = threading.Thread(target=self.run, name="gamelog", daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        # 由房間呼叫，不會碰到磁碟
+        self.queue.put(record)
+
+    def stop(self):
+        # 寫出 queue 中剩下的紀錄並關檔
+        self.queue.put(None)
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        next_sync = time.monotonic() + self.fsync_interval
+        running = True
+        while running:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+            if batch:
+                try:
+                    self.write_batch(batch)
+                except OSError as e:
+                    log.error("寫入對局紀錄失敗 (%s 筆): %s", len(batch), e)
+            now = time.monotonic()
+            if self.file is not None and (now >= next_sync or not running):
+                next_sync = now + self.fsync_interval
+                try:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except OSError as e:
+                    log.error("對局紀錄 fsync 失敗: %s", e)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        log.info("對局紀錄已寫出 %s 筆。", self.records)
+
+    def write_batch(self, batch):
+        out = bytearray()
+        for record in batch:
+            try:
+                body = encode_record(record)
+            except Exception as e:
+                # 一筆有問題的紀錄不能讓寫出 thread 結束，否則之後的對局都不會寫出
+                log.error("無法編碼房間 %s 的對局紀錄: %s", record.room_id, e)
+                continue
+            frame = _RECORD_FRAME.pack(len(body), zlib.crc32(body)) + body
+            if self.file is None or self.should_rotate(len(frame)):
+                if out:
+                    self.file.write(out)
+                    out.clear()
+                self.rotate()
+            out += frame
+            self.segment_bytes += len(frame)
+            self.records += 1
+        if out:
+            self.file.write(out)
+
+    def should_rotate(self, size):
+        if self.segment_bytes + size > self.max_segment_bytes:
+            return True
+        return time.monotonic() - self.segment_opened >= self.max_segment_age
+
+    def rotate(self):
+        # 關閉目前的 segment 並開新檔
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.segment_index += 1
+        path = os.path.join(
+            self.directory, f"{self.prefix}-{self.segment_index:06d}{SEGMENT_SUFFIX}"
+        )
+        self.file = open(path, "xb")
+        self.file.write(_SEGMENT_HEAD.pack(SEGMENT_MAGIC, SEGMENT_VERSION))
+        self.segment_bytes = _SEGMENT_HEAD.size
+        self.segment_opened = time.monotonic()
+        log.debug("開始新的對局紀錄檔 %s", path)
+
+
+def _split_segment(path):
+    # "games-w1-000003.glog" -> ("games-w1", 3)
+    prefix, index = os.path.basename(path)[: -len(SEGMENT_SUFFIX)].rsplit("-", 1)
+    return prefix, int(index)
+
+
+def list_segments(directory, prefix=DEFAULT_PREFIX):
+    # 列出 prefix 開頭的 segment 檔 (含叢集模式各 worker 的 "prefix-wN")，同一個寫入者依寫入順序排列
+    paths = glob.glob(os.path.join(directory, f"{glob.escape(prefix)}-*{SEGMENT_SUFFIX}"))
+    return sorted(paths, key=_split_segment)
+
+
+def read_frames(path, offset=0):
+    # 從檔案位置 offset 起逐筆讀出 (下一筆的位置, 內容)，不解碼；結尾不完整的紀錄 (寫到一半時中斷) 直接略過
+    # segment 只會附加，呼叫端記住最後的位置，下次就能只讀新寫入的紀錄
+    with open(path, "rb") as f:
+        head = f.read(_SEGMENT_HEAD.size)
+        if len(head) < _SEGMENT_HEAD.size:
+            return
+        magic, version = _SEGMENT_HEAD.unpack(head)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise GameLogError(f"{path} 不是對局紀錄檔")
+        offset = max(offset, _SEGMENT_HEAD.size)
+        f.seek(offset)
+        data = f.read()
+    view = memoryview(data)
+    pos = 0
+    while pos + _RECORD_FRAME.size <= len(data):
+        size, crc = _RECORD_FRAME.unpack_from(data, pos)
+        start = pos + _RECORD_FRAME.size
+        body = view[start : start + size]
+        if len(body) < size:
+            return
+        if zlib.crc32(body) != crc:
+            raise GameLogError(f"{path} 位置 {offset + pos} 的紀錄已損毀")
+        pos = start + size
+        yield offset + pos, body
+
+
+def read_segment(path):
+    # 逐筆讀出一個 segment 的 GameRecord
+    for _, body in read_frames(path):
+        yield decode_record(body)
+
+
+def read_games(directory, prefix=DEFAULT_PREFIX):
+    # 依序讀出目錄下所有 segment 的對局
+    for path in list_segments(directory, prefix):
+        yield from read_segment(path)
+
+
+_writer = None
+
+
+def start(directory, prefix=DEFAULT_PREFIX):
+    # 啟用本 process 的對局紀錄 (server 啟動時呼叫一次)
+    global _writer
+    _writer = GameLogWriter(directory, prefix)
+    _writer.start()
+    log.info("對局紀錄寫入 %s", directory)
+    return _writer
+
+
+def stop():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def submit(record):
+    # 未啟用對局紀錄時不做任何事
+    if _writer is not None:
+        _writer.submit(record)
+
+
+if __name__ == "__main__":
+    # 列出對局紀錄
+    parser = argparse.ArgumentParser(description="讀取對局紀錄")
+    parser.add_argument("directory")
+    parser.add_argument("--prefix", default=DEFAULT_PREFIX)
+    parser.add_argument("--verify", action="store_true", help="重播每一局並檢查勝負是否與紀錄相同")
+    args = parser.parse_args()
+    total = mismatched = 0
+    for record in read_games(args.directory, args.prefix):
+        total += 1
+        print(
+            f"房間 {record.room_id} {record.nicknames[0]}({record.players[0]}) vs "
+            f"{record.nicknames[1]}({record.players[1]}) 先手 {record.first_player} "
+            f"{len(record.moves)} 步 勝方 {record.winner} ({record.reason})"
+        )
+        if args.verify:
+            game = replay(record)
+            # 斷線或伺服器關閉結束的對局在棋盤上沒有勝負
+            if game.over and (game.winner, game.reason) != (record.winner, record.reason):
+                mismatched += 1
+                print(f"  重播結果不符: 勝方 {game.winner} ({game.reason})")
+    print(f"共 {total} 局" + (f"，{mismatched} 局重播結果不符" if args.verify else ""))
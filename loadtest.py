@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+from common import codec, constants, framing
+
+# 各玩家自己的棋子字元
+MY_PIECES = {
+    constants.P1_ID: (constants.P1_GOOD_CHAR, constants.P1_BAD_CHAR),
+    constants.P2_ID: (constants.P2_GOOD_CHAR, constants.P2_BAD_CHAR),
+}
+
+
+def percentiles(samples):
+    # 回傳 count/mean/p50/p95/p99/max (毫秒)，使用 nearest-rank
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def rank(p):
+        return ordered[min(n - 1, max(0, int(round(p / 100 * n)) - 1))] * 1000
+
+    return {
+        "count": n,
+        "mean_ms": sum(ordered) / n * 1000,
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+class LoadStats:
+    # 所有模擬 client 共用的統計
+    def __init__(self):
+        self.accept = []  # connect() 耗時
+        self.matchmaking = []  # 連線完成到收到 assign_id
+        self.move_rtt = []  # 送出 move 到收到 update_state
+        self.connect_errors = 0
+        self.disconnects = 0
+        self.moves = 0
+        self.invalid_moves = 0
+        self.games_over = 0
+        self.abandoned = 0  # 達到步數上限而主動離線
+
+
+def random_placements(player_id, rng):
+    # 隨機選 4 格放好鬼，其餘放壞鬼
+    rows = constants.P1_SETUP_ROWS if player_id == constants.P1_ID else constants.P2_SETUP_ROWS
+    cells = [(r, c) for r in rows for c in constants.SETUP_COLS]
+    good = set(rng.sample(cells, 4))
+    return [{"row": r, "col": c, "ghost_type": "G" if (r, c) in good else "B"} for r, c in cells]
+
+
+def random_move(board, player_id, rng):
+    # 依照自己看到的棋盤挑一個合法移動
+    mine = MY_PIECES[player_id]
+    options = []
+    for r in range(6):
+        for c in range(6):
+            if board[r][c] not in mine:
+                continue
+            for dr, dc in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+                nr, nc = r + dr, c + dc
+                if 0 <= nr < 6 and 0 <= nc < 6 and board[nr][nc] not in mine:
+                    options.append(([r, c], [nr, nc]))
+    return rng.choice(options) if options else None
+
+
+async def run_client(host, port, stats, rng, max_moves, protocol, encoding):
+    # 一個模擬玩家：連線、送暱稱、佈局，輪到自己時隨機走子直到遊戲結束
+    t0 = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats.connect_errors += 1
+        return
+    connected = time.perf_counter()
+    stats.accept.append(connected - t0)
+
+    encoder = codec.encode_json
+
+    def send(data):
+        writer.write(encoder(data))
+
+    if encoding != codec.ENCODING_JSON:
+        send({"type": constants.MSG_TYPE_HELLO, "encoding": encoding})
+    nickname = f"load{id(writer) & 0xFFFF}"
+    send({"type": constants.MSG_TYPE_NICKNAME, "nickname": nickname, "protocol": protocol})
+    player_id = None
+    board = None
+    move_sent_at = None
+    moves = 0
+
+    def on_state():
+        # 收到自己這步的狀態更新時記錄延遲
+        nonlocal move_sent_at
+        if move_sent_at is not None:
+            stats.move_rtt.append(time.perf_counter() - move_sent_at)
+            move_sent_at = None
+
+    def make_move():
+        # 輪到自己時走一步；回傳 False 表示要離線
+        nonlocal move_sent_at, moves
+        if moves >= max_moves:
+            stats.abandoned += 1
+            return False
+        move = random_move(board, player_id, rng)
+        if move is None:
+            return False
+        send({"type": constants.MSG_TYPE_MOVE, "from_sq": move[0], "to_sq": move[1]})
+        move_sent_at = time.perf_counter()
+        moves += 1
+        stats.moves += 1
+        return True
+
+    frame_reader = framing.FrameReader(framing.CLIENT_MAX_FRAME_SIZE)
+    try:
+        while True:
+            chunk = await reader.read(4096)
+            if not chunk:
+                stats.disconnects += 1
+                return
+            for frame in frame_reader.feed(chunk):
+                msg = codec.decode_frame(*frame)
+                t = msg.get("type")
+                if t == constants.MSG_TYPE_HELLO_ACK:
+                    encoder = codec.ENCODERS.get(msg.get("encoding"), codec.encode_json)
+                elif t == constants.MSG_TYPE_ASSIGN_ID:
+                    if player_id is None:
+                        stats.matchmaking.append(time.perf_counter() - connected)
+                    player_id = msg["player_id"]
+                elif t == constants.MSG_TYPE_START_SETUP:
+                    placements = random_placements(player_id, rng)
+                    send({"type": constants.MSG_TYPE_SETUP_DATA, "placements": placements})
+                elif t == constants.MSG_TYPE_UPDATE_STATE:
+                    on_state()
+                    board = msg["board"]
+                    # 協定 v2 的快照已包含回合，不會另外收到 your_turn
+                    if "seq" in msg and msg["current_player"] == player_id and not make_move():
+                        return
+                elif t == constants.MSG_TYPE_STATE_DELTA:
+                    on_state()
+                    for r, c, piece in msg["changes"]:
+                        board[r][c] = piece
+                    if msg["turn"] == player_id and not make_move():
+                        return
+                elif t == constants.MSG_TYPE_YOUR_TURN:
+                    if not make_move():
+                        return
+                elif t == constants.MSG_TYPE_PING:
+                    send({"type": constants.MSG_TYPE_PONG})
+                elif t == constants.MSG_TYPE_INVALID_MOVE:
+                    stats.invalid_moves += 1
+                    move_sent_at = None
+                elif t == constants.MSG_TYPE_GAME_OVER:
+                    stats.games_over += 1
+                    return
+    except (OSError, ValueError):
+        stats.disconnects += 1
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, pairs, seed, max_moves, ramp, protocol, encoding):
+    stats = LoadStats()
+    rng = random.Random(seed)
+    tasks = []
+    started = time.perf_counter()
+    for _ in range(pairs * 2):
+        client_rng = random.Random(rng.getrandbits(64))
+        tasks.append(asyncio.create_task(run_client(host, port, stats, client_rng, max_moves, protocol, encoding)))
+        if ramp:
+            await asyncio.sleep(1 / ramp)
+    await asyncio.gather(*tasks)
+    return stats, time.perf_counter() - started
+
+
+def raise_fd_limit():
+    # 每個模擬玩家一個 socket，盡量把 fd 上限調到 hard limit
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def spawn_server(mode, host, port):
+    # 在本機啟動待測伺服器，等到 port 可連線為止
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    # 達到步數上限而離線的玩家立即判負，對手不必等待重新連線的保留時間
+    command = [sys.executable, server_py, "--mode", mode, "--host", host, "--port", str(port)]
+    proc = subprocess.Popen(
+        command + ["--resume-grace", "0"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            asyncio.run(_probe(host, port))
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"伺服器未在 {host}:{port} 啟動")
+
+
+async def _probe(host, port):
+    # 確認 port 已在監聽：開兩條連線後立刻關閉，不會佔用測試玩家的配對
+    _, first = await asyncio.open_connection(host, port)
+    try:
+        _, second = await asyncio.open_connection(host, port)
+        second.close()
+    finally:
+        first.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機並發房間壓力測試")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=constants.SERVER_PORT)
+    parser.add_argument("--pairs", type=int, default=100, help="模擬的玩家組數 (連線數為兩倍)")
+    parser.add_argument("--max-moves", type=int, default=200, help="每位玩家最多走幾步後離線")
+    parser.add_argument("--ramp", type=float, default=0, help="每秒建立的連線數，0 表示一次全部連線")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--protocol",
+        type=int,
+        choices=[constants.PROTOCOL_VERSION_FULL, constants.PROTOCOL_VERSION_DELTA],
+        default=constants.PROTOCOL_VERSION_FULL,
+        help="1: 完整狀態；2: 差量更新",
+    )
+    parser.add_argument(
+        "--encoding", choices=list(codec.ENCODERS), default=codec.ENCODING_JSON, help="訊息編碼"
+    )
+    parser.add_argument(
+        "--spawn", choices=["thread", "async", "cluster"], help="先在本機啟動指定模式的 server.py 再測試"
+    )
+    parser.add_argument("--report", default="loadtest_report.json", help="JSON 報告輸出路徑")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    proc = spawn_server(args.spawn, args.host, args.port) if args.spawn else None
+    try:
+        stats, elapsed = asyncio.run(
+            run_load(
+                args.host,
+                args.port,
+                args.pairs,
+                args.seed,
+                args.max_moves,
+                args.ramp,
+                args.protocol,
+                args.encoding,
+            )
+        )
+    finally:
+        if proc:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    report = {
+        "config": vars(args),
+        "elapsed_sec": elapsed,
+        "clients": args.pairs * 2,
+        "connect_errors": stats.connect_errors,
+        "disconnects": stats.disconnects,
+        "games_over_messages": stats.games_over,
+        "abandoned": stats.abandoned,
+        "moves": stats.moves,
+        "invalid_moves": stats.invalid_moves,
+        "moves_per_sec": stats.moves / elapsed if elapsed else 0.0,
+        "latency": {
+            "accept": percentiles(stats.accept),
+            "matchmaking": percentiles(stats.matchmaking),
+            "move_to_update_state": percentiles(stats.move_rtt),
+        },
+    }
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    rtt = report["latency"]["move_to_update_state"]
+    print(
+        f"clients={report['clients']} moves={stats.moves} ({report['moves_per_sec']:,.0f}/s) "
+        f"move p50/p95/p99 = {rtt.get('p50_ms', 0):.2f}/{rtt.get('p95_ms', 0):.2f}/{rtt.get('p99_ms', 0):.2f} ms"
+    )
+    print(f"報告已寫入 {args.report}")
+
+
+if __name__ == "__main__":
+    main()
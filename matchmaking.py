@@ -0,0 +1,475 @@
+import json
+import queue
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+import timers
+from common import codec, constants, framing
+from server_log import get_logger
+
+log = get_logger("matchmaking")
+
+DEFAULT_RATING = 1500
+# 每個 rating 區間的寬度
+RATING_BUCKET = 100
+# 每等待這麼多秒，可接受的對手範圍向外多擴一個區間
+WIDEN_EVERY = 2.0
+# 等待時間統計保留最近幾筆
+WAIT_SAMPLES = 1000
+# Elo 的 K 值
+ELO_K = 32
+# 配對迴圈的間隔 (秒)
+MATCH_INTERVAL = 0.1
+# 配對前最多暫存幾則訊息，超過視為違規
+MAX_LOBBY_FRAMES = 16
+# 連線後多久沒送出暱稱 (或 resume) 就以預設 rating 加入配對 (秒)
+IDENTIFY_TIMEOUT = 1.0
+# 觀戰失敗時最多列出幾個房間編號
+MAX_LISTED_ROOMS = 100
+
+
+def identify(frames):
+    # 從配對期間收到的 frame 找出暱稱 (用來查詢 rating) 或 resume token (重新連線)
+    # 回傳 (訊息類型, 暱稱、token 或觀戰的房間編號)，都沒有時回傳 (None, None)
+    for is_binary, payload in frames:
+        try:
+            msg = codec.decode_frame(is_binary, payload)
+        except ValueError:
+            continue
+        if not isinstance(msg, dict):
+            continue
+        msg_type = msg.get("type")
+        if msg_type == constants.MSG_TYPE_NICKNAME:
+            value = msg.get("nickname")
+        elif msg_type == constants.MSG_TYPE_RESUME:
+            value = msg.get("token")
+        elif msg_type == constants.MSG_TYPE_WATCH:
+            # 觀戰的房間編號可省略 (由 server 挑選)
+            return msg_type, msg.get("room_id")
+        else:
+            continue
+        if isinstance(value, str):
+            return msg_type, value
+    return None, None
+
+
+def is_pong(frame):
+    # 心跳的回覆不必暫存給房間，也不算在 MAX_LOBBY_FRAMES 內
+    try:
+        msg = codec.decode_frame(*frame)
+    except ValueError:
+        return False
+    return isinstance(msg, dict) and msg.get("type") == constants.MSG_TYPE_PONG
+
+
+def resume_failed_frame():
+    # token 無效時回覆的訊息 (尚未協商編碼，一律 JSON)
+    return codec.encode_json(
+        {"type": constants.MSG_TYPE_RESUME_FAILED, "message": "找不到可恢復的對局。"}
+    )
+
+
+def watch_failed_frame(rooms, message="找不到可觀戰的房間。"):
+    # 觀戰失敗時回覆的訊息，附上目前可觀戰的房間編號 (最多 MAX_LISTED_ROOMS 個)
+    return codec.encode_json(
+        {
+            "type": constants.MSG_TYPE_WATCH_FAILED,
+            "message": message,
+            "rooms": sorted(rooms)[:MAX_LISTED_ROOMS],
+        }
+    )
+
+
+class Ticket:
+    # 一位等待配對的玩家
+    __slots__ = ("key", "player", "rating", "bucket", "enqueued_at")
+
+    def __init__(self, key, player, rating, bucket, enqueued_at):
+        self.key = key
+        self.player = player
+        self.rating = rating
+        self.bucket = bucket
+        self.enqueued_at = enqueued_at
+
+
+class Matchmaker:
+    # 依 rating 分區間的配對隊伍；每個區間是依加入順序排列的 OrderedDict
+    # 加入、取出最早的玩家與取消都是 O(1)，一次配對只掃過有人的區間
+    # 不是 thread-safe：由單一配對 thread (或 event loop) 操作
+    def __init__(self, bucket_size=RATING_BUCKET, widen_every=WIDEN_EVERY, clock=time.monotonic):
+        self.bucket_size = bucket_size
+        self.widen_every = widen_every
+        self.clock = clock
+        self.buckets = {}  # 區間編號 -> OrderedDict(key -> Ticket)
+        self.tickets = {}  # key -> Ticket
+        self.waits = deque(maxlen=WAIT_SAMPLES)  # 最近配對成功的等待秒數
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def __contains__(self, key):
+        return key in self.tickets
+
+    def __iter__(self):
+        return iter(list(self.tickets.values()))
+
+    def enqueue(self, key, player, rating=DEFAULT_RATING):
+        ticket = Ticket(key, player, rating, rating // self.bucket_size, self.clock())
+        self.tickets[key] = ticket
+        self.buckets.setdefault(ticket.bucket, OrderedDict())[key] = ticket
+        return ticket
+
+    def cancel(self, key):
+        # 玩家離線或放棄等待；回傳被移除的 Ticket (不存在時為 None)
+        ticket = self.tickets.pop(key, None)
+        if ticket is not None:
+            self._unlink(ticket)
+        return ticket
+
+    def window(self, ticket, now):
+        # 可接受相差幾個區間的對手，隨等待時間變寬
+        return int((now - ticket.enqueued_at) / self.widen_every)
+
+    def match(self):
+        # 回傳這一輪配對成功的 [(Ticket, Ticket), ...]
+        now = self.clock()
+        pairs = []
+        # 同一區間內依加入順序兩兩配對
+        singles = []
+        for bucket in self.buckets.values():
+            while len(bucket) >= 2:
+                pairs.append((bucket.popitem(last=False)[1], bucket.popitem(last=False)[1]))
+            if bucket:
+                singles.append(next(iter(bucket.values())))
+        # 各區間剩下的一人依 rating 排序，相鄰兩人的差距在等較久那位的範圍內就配對
+        singles.sort(key=lambda t: t.rating)
+        i = 0
+        while i + 1 < len(singles):
+            a, b = singles[i], singles[i + 1]
+            gap = b.bucket - a.bucket
+            if gap <= max(self.window(a, now), self.window(b, now)):
+                self._unlink(a)
+                self._unlink(b)
+                pairs.append((a, b))
+                i += 2
+            else:
+                i += 1
+        for a, b in pairs:
+            for ticket in (a, b):
+                del self.tickets[ticket.key]
+                wait = now - ticket.enqueued_at
+                self.waits.append(wait)
+                metrics.MATCH_WAIT_SECONDS.observe(wait)
+        self.buckets = {b: q for b, q in self.buckets.items() if q}
+        return pairs
+
+    def take_overdue(self, max_wait):
+        # 取出等待超過 max_wait 秒仍未配對的玩家 (改與 AI 對戰)
+        # tickets 依加入順序排列，遇到未逾時的即停
+        now = self.clock()
+        taken = []
+        for ticket in self.tickets.values():
+            if now - ticket.enqueued_at < max_wait:
+                break
+            taken.append(ticket)
+        for ticket in taken:
+            self.cancel(ticket.key)
+            wait = now - ticket.enqueued_at
+            self.waits.append(wait)
+            metrics.MATCH_WAIT_SECONDS.observe(wait)
+        return taken
+
+    def wait_stats(self):
+        # 最近配對的等待時間 (秒)：筆數、平均、p50、p95、最大值
+        if not self.waits:
+            return {"count": 0}
+        ordered = sorted(self.waits)
+        n = len(ordered)
+        return {
+            "count": n,
+            "mean": sum(ordered) / n,
+            "p50": ordered[(n - 1) // 2],
+            "p95": ordered[min(n - 1, int(n * 0.95))],
+            "max": ordered[-1],
+        }
+
+    def _unlink(self, ticket):
+        bucket = self.buckets.get(ticket.bucket)
+        if bucket is not None:
+            bucket.pop(ticket.key, None)
+
+
+class RatingBook:
+    # 以暱稱記錄的 Elo 分數 (只存在記憶體中)，對局結束時由房間更新
+    def __init__(self):
+        self.ratings = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            return self.ratings.get(name, DEFAULT_RATING)
+
+    def record(self, winner_name, loser_name):
+        if winner_name == loser_name:
+            return
+        with self.lock:
+            winner = self.ratings.get(winner_name, DEFAULT_RATING)
+            loser = self.ratings.get(loser_name, DEFAULT_RATING)
+            expected = 1 / (1 + 10 ** ((loser - winner) / 400))
+            delta = round(ELO_K * (1 - expected))
+            self.ratings[winner_name] = winner + delta
+            self.ratings[loser_name] = loser - delta
+
+
+class WaitingPlayer:
+    # 配對前的連線：由配對 thread 先讀取訊息 (暱稱決定 rating)，配對後連同讀到的 frame 交給房間
+    __slots__ = ("conn", "pid", "reader", "frames", "arrived_at", "last_seen")
+
+    def __init__(self, conn, pid):
+        self.conn = conn
+        self.pid = pid
+        self.reader = framing.server_reader()
+        self.frames = []
+        self.arrived_at = None
+        self.last_seen = None  # 最後一次收到訊息的時間
+
+
+class Lobby:
+    # 配對 thread：接手新連線、讀取等待中玩家的訊息並偵測離線，定期依 rating 配對
+    # on_pair(p1, p2) 收到兩個已改回 blocking 的 WaitingPlayer；on_drop(waiting) 負責關閉離開的連線
+    # on_resume(waiting, token) 把帶 resume token 的連線交還原本的房間，token 無效時回傳 False
+    # on_bot(waiting) 讓等待超過 bot_after 秒的玩家改與 AI 對戰 (None 表示不啟用)
+    # on_watch(waiting, room_id) 接手要觀戰的連線 (仍是 non-blocking)，None 表示不支援觀戰
+    # idle_timeout > 0 時對閒置的等待中連線送 ping，超過該秒數沒有任何訊息就中斷 (半開連線)
+    # 其他 thread 只能透過 add() / call() 與它互動
+    def __init__(
+        self,
+        ratings,
+        on_pair,
+        on_drop,
+        on_resume,
+        on_bot=None,
+        bot_after=0,
+        on_watch=None,
+        idle_timeout=0,
+    ):
+        self.ratings = ratings
+        self.on_pair = on_pair
+        self.on_drop = on_drop
+        self.on_resume = on_resume
+        self.on_bot = on_bot
+        self.bot_after = bot_after
+        self.on_watch = on_watch
+        self.idle_timeout = idle_timeout
+        self.matchmaker = Matchmaker()
+        # 還沒送出暱稱或 resume 的連線 (依到達順序)，表明身分或逾時後才加入配對
+        self.arrivals = {}
+        self.selector = selectors.DefaultSelector()
+        self.inbox = queue.SimpleQueue()  # WaitingPlayer 或要在配對 thread 執行的函式
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.running = True
+        self.thread = None
+
+    def __len__(self):
+        return len(self.matchmaker)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread:
+            self.thread.join(timeout=1.0)
+
+    def add(self, conn, pid):
+        # accept 迴圈呼叫：放進 inbox 後立刻返回，不等待配對
+        self.inbox.put(WaitingPlayer(conn, pid))
+        self.wake()
+
+    def call(self, func):
+        # 在配對 thread 執行 func (例如註冊新的控制連線)
+        self.inbox.put(func)
+        self.wake()
+
+    def wake(self):
+        # 緩衝區已滿代表配對 thread 本來就會醒來
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def watch(self, fileobj, callback):
+        # 配對 thread 內使用：fileobj 可讀時呼叫 callback()
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def unwatch(self, fileobj):
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(MATCH_INTERVAL):
+                if key.data is None:
+                    self.drain_inbox()
+                elif isinstance(key.data, WaitingPlayer):
+                    self.on_waiting_readable(key.data)
+                else:
+                    key.data()
+            self.admit_arrivals(time.monotonic())
+            for a, b in self.matchmaker.match():
+                for waiting in (a.player, b.player):
+                    self.unwatch(waiting.conn)
+                    waiting.conn.setblocking(True)
+                self.on_pair(a.player, b.player)
+            if self.on_bot:
+                for ticket in self.matchmaker.take_overdue(self.bot_after):
+                    self.unwatch(ticket.player.conn)
+                    ticket.player.conn.setblocking(True)
+                    self.on_bot(ticket.player)
+
+    def drain_inbox(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while True:
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, WaitingPlayer):
+                self.enqueue(item)
+            else:
+                item()
+
+    def enqueue(self, waiting):
+        # 配對 thread 內使用：開始讀取該連線，收到暱稱後 (或逾時) 加入配對隊伍
+        try:
+            waiting.conn.setblocking(False)
+            self.selector.register(waiting.conn, selectors.EVENT_READ, waiting)
+            # 通知 client 等待對手
+            waiting.conn.sendall(
+                json.dumps({"type": constants.MSG_TYPE_WAIT_OPPONENT}).encode("utf-8") + b"\n"
+            )
+        except Exception as e:
+            log.warning("向等待中的玩家 %s 發送消息失敗: %s", waiting.pid, e)
+            self.drop(waiting)
+            return
+        waiting.arrived_at = waiting.last_seen = time.monotonic()
+        self.arrivals[waiting.pid] = waiting
+        if self.idle_timeout > 0:
+            self.schedule_heartbeat(waiting)
+
+    def schedule_heartbeat(self, waiting):
+        # 心跳由時間輪觸發，交回配對 thread 執行
+        timers.schedule(self.idle_timeout / 3, self.call, lambda: self.heartbeat(waiting))
+
+    def heartbeat(self, waiting):
+        # 已離開配對的連線不再檢查；閒置的連線送 ping，超過 idle_timeout 沒有回應則中斷
+        if waiting.pid not in self.arrivals and waiting.pid not in self.matchmaker:
+            return
+        idle = time.monotonic() - waiting.last_seen
+        if idle >= self.idle_timeout:
+            log.info("等待中的玩家 %s 已 %.0f 秒沒有回應，中斷連線。", waiting.pid, idle)
+            metrics.IDLE_DROPPED.inc()
+            self.drop(waiting)
+            return
+        if idle >= self.idle_timeout / 3:
+            try:
+                waiting.conn.sendall(codec.encode_json({"type": constants.MSG_TYPE_PING}))
+            except OSError as e:
+                log.debug("向等待中的玩家 %s 送出 ping 失敗: %s", waiting.pid, e)
+                self.drop(waiting)
+                return
+        self.schedule_heartbeat(waiting)
+
+    def admit_arrivals(self, now):
+        # 逾時仍未表明身分的連線以預設 rating 加入配對
+        while self.arrivals:
+            waiting = next(iter(self.arrivals.values()))
+            if now - waiting.arrived_at < IDENTIFY_TIMEOUT:
+                return
+            self.admit(waiting, DEFAULT_RATING)
+
+    def admit(self, waiting, rating):
+        del self.arrivals[waiting.pid]
+        self.matchmaker.enqueue(waiting.pid, waiting, rating)
+        log.debug("玩家 %s 加入匹配隊伍。等待人數: %s", waiting.pid, len(self.matchmaker))
+
+    def resume(self, waiting, token):
+        # 帶 resume token 的連線不進入配對，交還原本的房間；token 無效時告知後關閉
+        del self.arrivals[waiting.pid]
+        self.unwatch(waiting.conn)
+        waiting.conn.setblocking(True)
+        if self.on_resume(waiting, token):
+            return
+        log.info("玩家 %s 的 resume token 無效。", waiting.pid)
+        try:
+            waiting.conn.sendall(resume_failed_frame())
+        except OSError:
+            pass
+        self.on_drop(waiting)
+
+    def spectate(self, waiting, room_id):
+        # 觀戰的連線不進入配對，交給 on_watch
+        del self.arrivals[waiting.pid]
+        self.unwatch(waiting.conn)
+        if self.on_watch is not None:
+            self.on_watch(waiting, room_id)
+            return
+        try:
+            waiting.conn.sendall(watch_failed_frame((), "此伺服器不支援觀戰。"))
+        except OSError:
+            pass
+        self.on_drop(waiting)
+
+    def on_waiting_readable(self, waiting):
+        # 等待中的玩家送來訊息：暫存給房間，收到暱稱時依 rating 加入配對；離線則取消配對
+        try:
+            frames = waiting.reader.recv(waiting.conn)
+        except BlockingIOError:
+            return
+        except framing.FrameError as e:
+            log.warning("等待中的玩家 %s 違反連線限制: %s", waiting.pid, e)
+            self.drop(waiting)
+            return
+        except OSError:
+            frames = None
+        if frames is None:
+            log.debug("玩家 %s 在配對前離線。", waiting.pid)
+            self.drop(waiting)
+            return
+        waiting.last_seen = time.monotonic()
+        frames = [frame for frame in frames if not is_pong(frame)]
+        waiting.frames.extend(frames)
+        if len(waiting.frames) > MAX_LOBBY_FRAMES:
+            log.warning("等待中的玩家 %s 傳送過多訊息。", waiting.pid)
+            self.drop(waiting)
+            return
+        if waiting.pid not in self.arrivals:
+            return
+        kind, value = identify(frames)
+        if kind == constants.MSG_TYPE_NICKNAME:
+            self.admit(waiting, self.ratings.get(value))
+        elif kind == constants.MSG_TYPE_RESUME:
+            self.resume(waiting, value)
+        elif kind == constants.MSG_TYPE_WATCH:
+            self.spectate(waiting, value)
+
+    def drop(self, waiting):
+        self.unwatch(waiting.conn)
+        self.arrivals.pop(waiting.pid, None)
+        self.matchmaker.cancel(waiting.pid)
+        self.on_drop(waiting)
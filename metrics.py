@@ -0,0 +1,228 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Prometheus text exposition format 0.0.4
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _fmt(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    # 只增不減的計數器；thread 模式下多個房間 thread 同時更新，以 lock 保護
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def merge(self, values):
+        return sum(values)
+
+    def render(self, value):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {_fmt(value)}",
+        ]
+
+
+class Gauge:
+    # 目前值在輸出時才由 callback 讀取 (例如房間數)，平常不需要維護
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.func = None
+
+    def set_function(self, func):
+        self.func = func
+
+    def snapshot(self):
+        return self.func() if self.func else 0
+
+    def merge(self, values):
+        # 多個 process 的值直接相加 (各 process 的房間數、連線數)
+        return sum(values)
+
+    def render(self, value):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_fmt(value)}",
+        ]
+
+
+class Histogram:
+    # 固定區間的直方圖；counts[i] 為落在 buckets[i] 以下 (不累計) 的次數，最後一格為 +Inf
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def merge(self, values):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        count = 0
+        for other_counts, other_sum, other_count in values:
+            for i, n in enumerate(other_counts):
+                counts[i] += n
+            total += other_sum
+            count += other_count
+        return counts, total, count
+
+    def render(self, value):
+        counts, total, count = value
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{le="{_fmt(float(bound))}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {_fmt(total)}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        # 目前所有數值 {名稱: 值}，可 pickle 傳給其他 process
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def merge(self, snapshots):
+        # 合併多個 process 的 snapshot (叢集模式由 supervisor 彙總)
+        merged = {}
+        for metric in self.metrics:
+            values = [snap[metric.name] for snap in snapshots if metric.name in snap]
+            merged[metric.name] = metric.merge(values)
+        return merged
+
+    def render(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(snapshot[metric.name]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+ACTIVE_ROOMS = REGISTRY.register(Gauge("geister_active_rooms", "進行中的房間數"))
+QUEUE_DEPTH = REGISTRY.register(Gauge("geister_matching_queue_depth", "等待配對的玩家數"))
+CONNECTED_CLIENTS = REGISTRY.register(Gauge("geister_connected_clients", "連線中的 client 數"))
+SPECTATORS = REGISTRY.register(Gauge("geister_spectators", "觀戰中的連線數"))
+SEND_QUEUE_BYTES = REGISTRY.register(
+    Gauge("geister_send_queue_bytes", "所有玩家連線送出佇列中尚未寫出的 bytes")
+)
+SLOW_CONNECTIONS = REGISTRY.register(
+    Gauge("geister_slow_connections", "送出佇列超過高水位的玩家連線數")
+)
+SLOW_CONSUMERS = REGISTRY.register(
+    Counter("geister_slow_consumers_total", "送出佇列超過高水位而被標記為慢速的次數")
+)
+SLOW_CONSUMERS_DROPPED = REGISTRY.register(
+    Counter("geister_slow_consumers_dropped_total", "送出佇列超過上限而被中斷的連線數")
+)
+PENDING_TIMERS = REGISTRY.register(
+    Gauge("geister_pending_timers", "時間輪中排定的計時器數 (回合時限、心跳、斷線保留座位)")
+)
+GAME_TIMEOUTS = REGISTRY.register(
+    Counter("geister_game_timeouts_total", "因超過佈局/每步時限或用完總時間而結束的對局數")
+)
+IDLE_DROPPED = REGISTRY.register(
+    Counter("geister_idle_connections_dropped_total", "太久沒有任何訊息 (半開連線) 而被中斷的連線數")
+)
+MESSAGES_IN = REGISTRY.register(Counter("geister_messages_received_total", "收到的訊息數"))
+MESSAGES_OUT = REGISTRY.register(Counter("geister_messages_sent_total", "送出的訊息數"))
+BYTES_IN = REGISTRY.register(Counter("geister_bytes_received_total", "收到的 bytes (含 frame 標頭/換行)"))
+BYTES_OUT = REGISTRY.register(Counter("geister_bytes_sent_total", "送出的 bytes"))
+INVALID_MOVES = REGISTRY.register(Counter("geister_invalid_moves_total", "被拒絕的移動"))
+GAMES_FINISHED = REGISTRY.register(Counter("geister_games_finished_total", "已結束的對局數"))
+MOVE_SECONDS = REGISTRY.register(
+    Histogram(
+        "geister_move_handling_seconds",
+        "處理一步移動 (規則判斷與送出通知) 的時間",
+        (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+    )
+)
+GAME_SECONDS = REGISTRY.register(
+    Histogram(
+        "geister_game_duration_seconds",
+        "對局開始到結束的時間",
+        (10, 30, 60, 120, 300, 600, 1200, 1800, 3600),
+    )
+)
+MATCH_WAIT_SECONDS = REGISTRY.register(
+    Histogram(
+        "geister_matchmaking_wait_seconds",
+        "進入配對隊伍到配對成功的等待時間",
+        (0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120),
+    )
+)
+
+
+def track_server(server):
+    # 房間數、配對隊伍與連線數直接讀取 server 的資料結構 (thread/asyncio 模式共用)
+    ACTIVE_ROOMS.set_function(lambda: len(server.active_rooms))
+    QUEUE_DEPTH.set_function(lambda: len(server.matchmaker))
+    CONNECTED_CLIENTS.set_function(lambda: len(server.clients))
+    SPECTATORS.set_function(
+        lambda: sum(len(room.audience) for room in list(server.active_rooms.values()))
+    )
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不把每次抓取都印出來
+        pass
+
+
+def start_http_server(host, port, render=None):
+    # 在背景 thread 提供 GET /metrics；render 預設輸出本 process 的數值
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.render = render or REGISTRY.render
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
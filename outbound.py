@@ -0,0 +1,251 @@
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+import metrics
+from server_log import get_logger
+
+log = get_logger("outbound")
+
+# 送出佇列超過高水位時標記為慢速連線，降回低水位以下時解除
+HIGH_WATERMARK = 64 * 1024
+LOW_WATERMARK = 16 * 1024
+# 超過此上限仍送不出去就中斷連線 (房間視同斷線，可用 resume token 重新連線)
+MAX_QUEUED = 1024 * 1024
+# close() 後最多等這麼久把剩下的訊息送完 (秒)
+CLOSE_TIMEOUT = 5.0
+# 一次寫入最多合併多少 bytes 的 frame
+MAX_WRITE = 64 * 1024
+# 檢查關閉逾時的間隔 (秒)
+WRITER_TICK = 1.0
+# 讀取 thread 仍以 blocking 模式 recv，寫入改用 per-call 的 non-blocking 旗標
+_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+class SendQueue:
+    # 一條連線的送出佇列，提供與 socket 相同的 sendall/close：
+    # 房間在 lock 內呼叫 sendall 只是把 frame 放進佇列，實際寫入由 Writer thread 在 lock 外進行
+    # 其餘屬性 (recv_into、shutdown、fileno...) 直接轉給原本的 socket，讀取 thread 照舊 blocking recv
+    __slots__ = (
+        "sock",
+        "writer",
+        "name",
+        "lock",
+        "frames",
+        "queued",
+        "slow",
+        "scheduled",
+        "closing",
+        "closed",
+        "close_by",
+        "writing",
+    )
+
+    def __init__(self, sock, writer, name):
+        self.sock = sock
+        self.writer = writer
+        self.name = name  # 記錄慢速連線時顯示的名稱
+        self.lock = threading.Lock()
+        self.frames = deque()
+        self.queued = 0  # 佇列中尚未寫出的 bytes
+        self.slow = False  # 超過高水位，尚未降回低水位
+        self.scheduled = False  # 已交給 Writer，送完前不必再通知
+        self.closing = False  # 已呼叫 close，送完即關閉
+        self.closed = False
+        self.close_by = 0.0
+        self.writing = False  # Writer 是否正在等待可寫 (只由 Writer thread 存取)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data):
+        with self.lock:
+            if self.closed or self.closing:
+                raise ConnectionError("連線已關閉")
+            self.frames.append(data)
+            self.queued += len(data)
+            queued = self.queued
+            notify = not self.scheduled
+            self.scheduled = True
+            flagged = queued > HIGH_WATERMARK and not self.slow
+            if flagged:
+                self.slow = True
+        if flagged:
+            log.warning("%s 的送出佇列達 %s bytes，標記為慢速連線。", self.name, queued)
+            metrics.SLOW_CONSUMERS.inc()
+        if queued > MAX_QUEUED:
+            self.writer.drop(self)
+            raise ConnectionError(f"送出佇列超過 {MAX_QUEUED} bytes")
+        if notify:
+            self.writer.notify(self)
+
+    def close(self):
+        # 送完佇列中的訊息 (例如 game_over) 才關閉，最多等 CLOSE_TIMEOUT 秒
+        with self.lock:
+            if self.closed or self.closing:
+                return
+            self.closing = True
+            self.close_by = time.monotonic() + CLOSE_TIMEOUT
+        self.writer.notify(self)
+
+
+class Writer:
+    # 單一 thread 以 selector 為所有 SendQueue 做 non-blocking 寫入，對方收不下時等可寫再送
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.ready = []  # 有新資料或要關閉的 SendQueue
+        self.queues = set()  # 所有尚未關閉的 SendQueue (統計用)
+        self.active = set()  # 佇列不是空的或等待關閉的 SendQueue (只由 Writer thread 存取)
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.running = True
+        self.deadline = 0.0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=1.0):
+        # 最多再等 timeout 秒把剩下的訊息 (例如伺服器關閉通知) 送完
+        self.deadline = time.monotonic() + timeout
+        self.running = False
+        self.wake()
+        if self.thread:
+            self.thread.join(timeout + 1.0)
+
+    def wrap(self, sock, name):
+        queue = SendQueue(sock, self, name)
+        with self.lock:
+            self.queues.add(queue)
+        return queue
+
+    def queued_bytes(self):
+        with self.lock:
+            queues = list(self.queues)
+        return sum(queue.queued for queue in queues)
+
+    def slow_count(self):
+        with self.lock:
+            queues = list(self.queues)
+        return sum(1 for queue in queues if queue.slow)
+
+    def notify(self, queue):
+        with self.lock:
+            self.ready.append(queue)
+        self.wake()
+
+    def drop(self, queue):
+        # 慢速連線超過上限：不再接受新訊息，叫醒讀取 thread (視同斷線)，socket 由 Writer 關閉
+        with queue.lock:
+            if queue.closed:
+                return
+            queue.closed = True
+        log.warning("%s 的送出佇列超過 %s bytes，中斷連線。", queue.name, MAX_QUEUED)
+        metrics.SLOW_CONSUMERS_DROPPED.inc()
+        try:
+            queue.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.notify(queue)
+
+    def wake(self):
+        # 緩衝區已滿代表 Writer thread 本來就會醒來
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def run(self):
+        while self.running or (self.active and time.monotonic() < self.deadline):
+            for key, _ in self.selector.select(WRITER_TICK):
+                if key.data is None:
+                    self.drain_wakeup()
+                else:
+                    self.flush(key.data)
+            with self.lock:
+                ready, self.ready = self.ready, []
+            for queue in ready:
+                self.flush(queue)
+            now = time.monotonic()
+            for queue in [q for q in self.active if q.closing and now >= q.close_by]:
+                self.finish(queue)
+        for queue in list(self.active):
+            self.finish(queue)
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def flush(self, queue):
+        # 合併佇列中的 frame 盡量寫出；寫不完時等可寫，清空後若已 close 則關閉 socket
+        self.active.add(queue)
+        while True:
+            with queue.lock:
+                if queue.closed:
+                    break
+                if not queue.frames:
+                    queue.scheduled = False
+                    if not queue.closing:
+                        self.want_write(queue, False)
+                        self.active.discard(queue)
+                        return
+                    break
+                data = queue.frames.popleft()
+                while queue.frames and len(data) + len(queue.frames[0]) <= MAX_WRITE:
+                    data += queue.frames.popleft()
+            try:
+                sent = queue.sock.send(data, _DONTWAIT)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                break
+            with queue.lock:
+                if sent < len(data):
+                    queue.frames.appendleft(data[sent:])
+                queue.queued -= sent
+                recovered = queue.slow and queue.queued <= LOW_WATERMARK
+                if recovered:
+                    queue.slow = False
+            if recovered:
+                log.info("%s 的送出佇列已降回 %s bytes 以下。", queue.name, LOW_WATERMARK)
+            if sent < len(data):
+                self.want_write(queue, True)
+                return
+        self.finish(queue)
+
+    def want_write(self, queue, writing):
+        if queue.writing == writing:
+            return
+        try:
+            if writing:
+                self.selector.register(queue.sock, selectors.EVENT_WRITE, queue)
+            else:
+                self.selector.unregister(queue.sock)
+        except (KeyError, ValueError, OSError):
+            return
+        queue.writing = writing
+
+    def finish(self, queue):
+        # 關閉 socket (只在 Writer thread 進行，避免 selector 留著已關閉的 fd)
+        self.want_write(queue, False)
+        with queue.lock:
+            queue.closed = True
+            queue.frames.clear()
+            queue.queued = 0
+            queue.slow = False
+        self.active.discard(queue)
+        with self.lock:
+            self.queues.discard(queue)
+        try:
+            queue.sock.close()
+        except OSError:
+            pass
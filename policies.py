@@ -0,0 +1,53 @@
+import importlib
+
+from bitboard import BIT, ESCAPE_MASK
+from engine import SETUP_SQUARES
+
+# 玩家策略：choose_setup 回傳 4 個好鬼的格子編號，choose_move 回傳 (frm, to)
+# 策略只能看自己的棋子與對手棋子的位置 (game.bb.occupied)，不可讀取對手的 good/bad mask
+
+
+class RandomPolicy:
+    # 隨機佈局、隨機走子
+    name = "random"
+
+    def choose_setup(self, player_id, rng):
+        return rng.sample(SETUP_SQUARES[player_id], 4)
+
+    def choose_move(self, game, rng):
+        return rng.choice(game.legal_moves())
+
+
+class GreedyPolicy(RandomPolicy):
+    # 好鬼能逃脫就逃脫，其次吃子，否則隨機
+    name = "greedy"
+
+    def choose_move(self, game, rng):
+        me = game.turn
+        moves = game.legal_moves()
+        good = game.bb.good[me]
+        escape = ESCAPE_MASK[me]
+        opp_occupied = game.bb.occupied(3 - me)
+        captures = []
+        for frm, to in moves:
+            if good & BIT[frm] and escape & BIT[to]:
+                return frm, to
+            if opp_occupied & BIT[to]:
+                captures.append((frm, to))
+        return rng.choice(captures or moves)
+
+
+POLICIES = {
+    RandomPolicy.name: RandomPolicy,
+    GreedyPolicy.name: GreedyPolicy,
+}
+
+
+def load_policy(spec):
+    # 依名稱 ("random") 或 "module:ClassName" 建立策略物件
+    if spec in POLICIES:
+        return POLICIES[spec]()
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise ValueError(f"未知的策略: {spec} (可用: {', '.join(POLICIES)} 或 module:ClassName)")
+    return getattr(importlib.import_module(module_name), attr)()
@@ -1,12 +1,74 @@
 import json
 import random
+import secrets
+import socket
 import threading
+import time
+from collections import namedtuple
 
-from common import constants
+import engine
+import gamelog
+import timers
+from bitboard import SQUARE_RC
+from board_views import OBSERVER, BoardViews
+import metrics
+from spectate import Audience
+from common import codec, constants, framing
+from server_log import RoomLog, get_logger
+
+log = get_logger("room")
+
+# 引擎錯誤代碼對應的提示訊息
+MOVE_ERROR_MESSAGES = {
+    engine.MOVE_GAME_OVER: "遊戲已結束。",
+    engine.MOVE_NOT_YOUR_TURN: "現在不是你的回合。",
+    engine.MOVE_OUT_OF_BOUNDS: "無效的座標。",
+    engine.MOVE_NOT_YOUR_PIECE: "你不能移動該位置的棋子。",
+    engine.MOVE_NOT_ADJACENT: "無效的移動方式，只能前後左右移動一格。",
+    engine.MOVE_OWN_PIECE: "目標位置有你自己的棋子。",
+}
+
+# binary frame 標頭的長度 (JSON 行則是結尾的換行)
+FRAME_OVERHEAD = codec.FRAME_HEADER.size
+
+# 斷線後保留座位等待重新連線的預設秒數 (0 表示斷線即判負)
+RESUME_GRACE = 30.0
+
+# 時間限制 (秒)，0 表示不限制：每一步 (佈局也適用)、每位玩家整局的總時間、
+# 連線多久沒收到任何訊息就視為半開連線而中斷 (每隔三分之一的時間對閒置的連線送 ping)
+# 舊版 client 不會回覆 ping，閒置檢查預設關閉，確定所有 client 都支援時再開啟
+MOVE_TIME = 60.0
+GAME_TIME = 900.0
+IDLE_TIMEOUT = 0.0
+TimeLimits = namedtuple("TimeLimits", "move game idle")
+DEFAULT_LIMITS = TimeLimits(MOVE_TIME, GAME_TIME, IDLE_TIMEOUT)
+
+# 勝負原因對應的訊息 (winner/loser 為全域玩家 ID)
+WIN_MESSAGES = {
+    constants.WIN_REASON_CAPTURE_ALL_GOOD: "玩家 {winner} 吃掉了對手所有好鬼！",
+    constants.WIN_REASON_LOSE_ALL_BAD: "玩家 {winner} 的所有壞鬼被對手玩家 {loser} 吃掉，玩家 {winner} 獲勝！",
+    constants.WIN_REASON_ESCAPE: "玩家 {winner} 的好鬼成功逃脫！",
+}
+
+
+def new_token():
+    # 給玩家重新連線用的 resume token
+    return secrets.token_urlsafe(16)
 
 
 class Room:
-    def __init__(self, room_id, p1_conn, p1_gid, p2_conn, p2_gid, server):
+    def __init__(
+        self,
+        room_id,
+        p1_conn,
+        p1_gid,
+        p2_conn,
+        p2_gid,
+        server,
+        tokens=None,
+        resume_grace=0,
+        limits=DEFAULT_LIMITS,
+    ):
         # 初始化房間，儲存玩家 socket、ID、server
         self.id = room_id
         self.server = server
@@ -14,127 +76,410 @@ class Room:
         self.global_ids = {1: p1_gid, 2: p2_gid}  # 兩位玩家的全域 ID
         self.threads = {}  # 玩家 thread
         self.setups = {}   # 玩家佈局資料
-        self.turn = None   # 當前回合
         self.over = False  # 遊戲是否結束
+        self.cleaned = False  # cleanup 是否已執行
         self.lock = threading.Lock()  # 多執行緒同步鎖
-        self.board = [[None for _ in range(6)] for _ in range(6)]
-        self.captured = {1: {"good": 0, "bad": 0}, 2: {"good": 0, "bad": 0}}  # 各玩家吃掉的鬼
+        self.game = engine.GameState()  # 棋盤、回合、吃子數與勝負 (規則引擎)
+        self.views = None  # 各視角棋盤快取，遊戲開始時建立
         self.nicknames = {}
-        print(f"[Room {self.id}] Created: {p1_gid}(P1) vs {p2_gid}(P2)")
+        self.protocols = {1: constants.PROTOCOL_VERSION_FULL, 2: constants.PROTOCOL_VERSION_FULL}
+        self.state_seq = {1: 0, 2: 0}  # 協定 v2：已送出的狀態訊息序號
+        self.encoders = {1: codec.encode_json, 2: codec.encode_json}  # 各玩家協商後的編碼
+        self.started_at = None  # 對局開始時間 (統計對局長度)
+        self.opening = None  # (開始時間 epoch, 先手, 雙方佈局)，寫入對局紀錄用
+        self.winner = None  # 勝方 (房內編號)，用來更新 rating
+        self.tokens = tokens or {1: new_token(), 2: new_token()}  # 各玩家的 resume token
+        self.resume_grace = resume_grace
+        self.away = {}  # 斷線等待重新連線的玩家 -> 保留座位的期限 (monotonic)
+        self.audience = Audience()  # 觀戰者，每次狀態改變只編碼一次
+        self.end_reason = None  # 結束原因 (給觀戰者的結束訊息)
+        self.result_reason = None  # 引擎以外的勝負原因代碼 (超時)，寫入對局紀錄用
+        self.limits = limits
+        # 各玩家剩下的總時間 (不限制時為 None)；turn_timer 為目前回合或佈局的逾時計時器
+        self.clocks = {1: limits.game, 2: limits.game} if limits.game > 0 else None
+        self.turn_started = None
+        self.turn_timer = None
+        self.last_seen = {1: time.monotonic(), 2: time.monotonic()}  # 最後一次收到訊息的時間
+        self.heartbeats = {}  # 玩家 -> 心跳計時器
+        self.resume_timers = {}  # 斷線的玩家 -> 保留座位到期的計時器
+        self.log = RoomLog(log, {"room": room_id})
+        self.log.info("Created: %s(P1) vs %s(P2)", p1_gid, p2_gid)
 
-    def start(self):
+    def start(self, readers=None, pending=None):
         # 房間啟動，分配 ID、廣播開始佈局、啟動玩家 thread
+        # readers/pending: 配對期間已開始讀取的 FrameReader 與收到的 frame
+        self.begin()
+        self.replay(pending)
         for player_id in (1, 2):
-            opp_id = 2 if player_id == 1 else 1
-            self.send(
-                player_id,
-                {
-                    "type": constants.MSG_TYPE_ASSIGN_ID,
-                    "player_id": player_id,
-                    "global_player_id": self.global_ids[player_id],
-                    "my_nickname": self.nicknames.get(player_id, f"玩家{player_id}"),
-                    "opponent_nickname": self.nicknames.get(opp_id, f"玩家{opp_id}"),
-                },
+            if getattr(self.players[player_id], "local", False):
+                # server 端的 AI 座位 (bot.BotSeat) 不需要讀取 thread
+                continue
+            reader = readers[player_id] if readers else None
+            t = threading.Thread(
+                target=self.player_loop, args=(self.players[player_id], player_id, reader)
             )
-        self.broadcast({"type": constants.MSG_TYPE_START_SETUP})
-        for player_id in (1, 2):
-            t = threading.Thread(target=self.player_loop, args=(self.players[player_id], player_id))
             self.threads[player_id] = t
             t.start()
 
+    def begin(self):
+        # 分配 ID 並廣播開始佈局 (thread 與 asyncio 模式共用)
+        for player_id in (1, 2):
+            self.send_assign_id(player_id)
+        self.broadcast({"type": constants.MSG_TYPE_START_SETUP})
+        if self.limits.move > 0:
+            self.turn_timer = timers.schedule(self.limits.move, self.on_setup_timeout)
+        if self.limits.idle > 0:
+            for player_id, conn in self.players.items():
+                if not getattr(conn, "local", False):
+                    self.heartbeats[player_id] = timers.schedule(
+                        self.limits.idle / 3, self.heartbeat, player_id
+                    )
+
+    def send_assign_id(self, player_id):
+        # 玩家編號、雙方暱稱與重新連線用的 token
+        opp_id = 2 if player_id == 1 else 1
+        self.send(
+            player_id,
+            {
+                "type": constants.MSG_TYPE_ASSIGN_ID,
+                "player_id": player_id,
+                "global_player_id": self.global_ids[player_id],
+                "my_nickname": self.nicknames.get(player_id, f"玩家{player_id}"),
+                "opponent_nickname": self.nicknames.get(opp_id, f"玩家{opp_id}"),
+                "resume_token": self.tokens[player_id],
+            },
+        )
+
+    def replay(self, pending):
+        # 依序處理配對期間收到的訊息 (通常是 hello 與 nickname)
+        for player_id, frames in (pending or {}).items():
+            for is_binary, payload in frames:
+                self.handle_frame(player_id, is_binary, payload)
+
     def send(self, player_id, data):
         # 傳送訊息給指定玩家
         try:
             conn = self.players.get(player_id)
             if conn:
-                conn.sendall(json.dumps(data).encode("utf-8") + b"\n")
+                frame = self.encoders[player_id](data)
+                conn.sendall(frame)
+                metrics.MESSAGES_OUT.inc()
+                metrics.BYTES_OUT.inc(len(frame))
         except Exception as e:
-            print(f"[Room {self.id}] Send to {self.global_ids[player_id]} failed: {e}")
+            self.log.warning("Send to %s failed: %s", self.global_ids[player_id], e)
 
     def broadcast(self, data):
         # 廣播訊息給所有玩家
         for pid in self.players:
             self.send(pid, data)
 
-    def player_loop(self, conn, player_id):
+    def player_loop(self, conn, player_id, reader=None):
         # 處理單一玩家的訊息收發 (threaded)
         global_player_id = self.global_ids[player_id]
         try:
-            buffer = ""
+            reader = reader or framing.server_reader()
             while not self.over:
-                chunk = conn.recv(1024).decode("utf-8")
-                if not chunk:
-                    print(f"[Room {self.id}] Player {global_player_id} disconnected.")
-                    self.on_disconnect(player_id)
+                frames = reader.recv(conn)
+                if frames is None:
+                    self.log.info("Player %s disconnected.", global_player_id)
+                    self.on_disconnect(player_id, conn)
                     break
-                buffer += chunk
-                while "\n" in buffer:
-                    msg_str, buffer = buffer.split("\n", 1)
-                    try:
-                        print(f"[DEBUG][Room {self.id}] 收到玩家 {global_player_id} 訊息: {msg_str}")
-                        msg = json.loads(msg_str)
-                        # 新增處理 nickname
-                        if msg.get("type") == "nickname":
-                            self.nicknames[player_id] = msg.get("nickname", f"玩家{player_id}")
-                            # 兩邊都送過來才廣播
-                            if len(self.nicknames) == 2:
-                                for pid in (1, 2):
-                                    opp_id = 2 if pid == 1 else 1
-                                    self.send(
-                                        pid,
-                                        {
-                                            "type": constants.MSG_TYPE_ASSIGN_ID,
-                                            "player_id": pid,
-                                            "global_player_id": self.global_ids[pid],
-                                            "my_nickname": self.nicknames[pid],
-                                            "opponent_nickname": self.nicknames[opp_id],
-                                        },
-                                    )
-                            continue
-                        self.on_message(player_id, msg)
-                    except json.JSONDecodeError:
-                        print(f"[Room {self.id}] 玩家 {global_player_id} 傳送無效 JSON。")
+                for is_binary, payload in frames:
+                    self.handle_frame(player_id, is_binary, payload)
+        except framing.FrameError as e:
+            self.on_violation(player_id, e)
         except (ConnectionResetError, OSError) as e:
             if not self.over:
-                print(f"[Room {self.id}] 玩家 {global_player_id} 連線錯誤: {e}")
-                self.on_disconnect(player_id)
+                self.log.warning("玩家 %s 連線錯誤: %s", global_player_id, e)
+                self.on_disconnect(player_id, conn)
         finally:
-            print(f"[Room {self.id}] 玩家 {global_player_id} 的 thread 結束。")
+            self.log.debug("玩家 %s 的 thread 結束。", global_player_id)
+
+    def handle_frame(self, player_id, is_binary, payload):
+        # 解析一個 frame (JSON 行或 binary frame) 並分派 (thread 與 asyncio 模式共用)
+        metrics.MESSAGES_IN.inc()
+        metrics.BYTES_IN.inc(len(payload) + (FRAME_OVERHEAD if is_binary else 1))
+        self.last_seen[player_id] = time.monotonic()
+        if not is_binary:
+            self.handle_line(player_id, payload.decode("utf-8", "replace"))
+            return
+        try:
+            msg = codec.decode_binary(payload)
+        except codec.CodecError as e:
+            self.log.warning("玩家 %s 傳送無效 binary frame: %s", self.global_ids[player_id], e)
+            return
+        self.log.debug("收到玩家 %s 訊息: %s", self.global_ids[player_id], msg)
+        self.handle_message(player_id, msg)
+
+    def handle_line(self, player_id, msg_str):
+        # 解析一行 JSON 訊息並分派
+        global_player_id = self.global_ids[player_id]
+        try:
+            self.log.debug("收到玩家 %s 訊息: %s", global_player_id, msg_str)
+            msg = json.loads(msg_str)
+        except json.JSONDecodeError:
+            msg = None
+        if not isinstance(msg, dict):
+            self.log.warning("玩家 %s 傳送無效 JSON。", global_player_id)
+            return
+        self.handle_message(player_id, msg)
 
-    def on_disconnect(self, player_id):
-        # 處理玩家斷線，通知對手並清理房間
+    def handle_message(self, player_id, msg):
+        # 分派已解碼的訊息
+        msg_type = msg.get("type")
+        # 新增處理 nickname
+        if msg_type == constants.MSG_TYPE_NICKNAME:
+            nickname = msg.get("nickname")
+            if not isinstance(nickname, str):
+                nickname = f"玩家{player_id}"
+            self.nicknames[player_id] = nickname
+            if msg.get("protocol") == constants.PROTOCOL_VERSION_DELTA:
+                self.protocols[player_id] = constants.PROTOCOL_VERSION_DELTA
+            # 兩邊都送過來才廣播
+            if len(self.nicknames) == 2:
+                for pid in (1, 2):
+                    self.send_assign_id(pid)
+            return
+        if msg_type == constants.MSG_TYPE_HELLO:
+            self.on_hello(player_id, msg.get("encoding"))
+            return
+        if msg_type == constants.MSG_TYPE_PING:
+            self.send(player_id, {"type": constants.MSG_TYPE_PONG})
+            return
+        if msg_type == constants.MSG_TYPE_PONG:
+            # 收到訊息時已更新 last_seen
+            return
+        self.on_message(player_id, msg)
+
+    def on_hello(self, player_id, encoding):
+        # 編碼協商：先以目前的編碼回覆 hello_ack，之後送出的訊息改用新編碼
+        if encoding not in codec.ENCODERS:
+            encoding = codec.ENCODING_JSON
+        with self.lock:
+            self.send(player_id, {"type": constants.MSG_TYPE_HELLO_ACK, "encoding": encoding})
+            self.encoders[player_id] = codec.ENCODERS[encoding]
+
+    def on_violation(self, player_id, error):
+        # 玩家超過 frame 大小或速率限制：告知原因後視同斷線
+        if self.over:
+            return
+        self.log.warning("玩家 %s 違反連線限制: %s", self.global_ids[player_id], error)
+        self.send(player_id, {"type": constants.MSG_TYPE_ERROR, "message": f"連線已中斷: {error}"})
+        self.on_disconnect(player_id, resumable=False)
+
+    def heartbeat(self, player_id):
+        # 由時間輪定期呼叫：閒置超過三分之一時限的連線送 ping，超過時限視為半開連線而中斷 (之後照一般斷線處理)
+        interval = self.limits.idle / 3
         with self.lock:
             if self.over:
                 return
-            self.over = True
+            conn = self.players.get(player_id)
+            idle = time.monotonic() - self.last_seen[player_id]
+            if conn is not None and idle >= self.limits.idle:
+                self.log.info("玩家 %s 已 %.0f 秒沒有回應，中斷連線。", self.global_ids[player_id], idle)
+                metrics.IDLE_DROPPED.inc()
+                try:
+                    # 叫醒讀取端，由讀取端的斷線處理接手
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            elif conn is not None and idle >= interval:
+                self.send(player_id, {"type": constants.MSG_TYPE_PING})
+            self.heartbeats[player_id] = timers.schedule(interval, self.heartbeat, player_id)
+
+    def on_disconnect(self, player_id, conn=None, resumable=True):
+        # 處理玩家斷線：保留座位等待重新連線，或通知對手並清理房間
+        # conn: 斷線的連線，已被重新連線取代的舊連線不影響房間
+        with self.lock:
+            if self.over:
+                return
+            if conn is not None and self.players.get(player_id) is not conn:
+                return
             global_player_id = self.global_ids[player_id]
-            print(f"[Room {self.id}] 玩家 {global_player_id} 中斷連線。")
-            opp_id = 2 if player_id == 1 else 1
-            if opp_id in self.players:
-                self.send(
-                    opp_id,
-                    {
-                        "type": constants.MSG_TYPE_GAME_OVER,
-                        "winner": opp_id,
-                        "reason": f"對手玩家 {global_player_id} 斷線。",
-                    },
+            self.log.info("玩家 %s 中斷連線。", global_player_id)
+            if resumable and self.resume_grace > 0:
+                self.suspend(player_id)
+                return
+            self.forfeit(player_id, f"對手玩家 {global_player_id} 斷線。")
+
+    def suspend(self, player_id):
+        # 關閉斷線玩家的連線並保留座位，房間不為等待中的玩家占用 thread 或 socket
+        conn = self.players.pop(player_id, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.away[player_id] = time.monotonic() + self.resume_grace
+        timers.cancel(self.resume_timers.get(player_id))
+        self.resume_timers[player_id] = timers.schedule(self.resume_grace, self.expire)
+        self.publish_spectators(f"玩家 {self.global_ids[player_id]} 斷線，等待重新連線...")
+        opp_id = 2 if player_id == 1 else 1
+        self.send(
+            opp_id,
+            {
+                "type": constants.MSG_TYPE_INFO,
+                "message": f"對手玩家 {self.global_ids[player_id]} 斷線，"
+                f"等待重新連線 (最多 {self.resume_grace:g} 秒)...",
+            },
+        )
+        if not self.players:
+            self.log.info("雙方都已斷線，等待重新連線。")
+
+    def expire(self):
+        # 保留座位的計時器到期：斷線超過保留時間仍未回來的玩家判負 (雙方都斷線時先斷的判負)
+        with self.lock:
+            if self.over or not self.away:
+                return
+            player_id = min(self.away, key=self.away.get)
+            if self.away[player_id] > time.monotonic():
+                return
+            self.log.info("玩家 %s 未在時限內重新連線。", self.global_ids[player_id])
+            self.forfeit(
+                player_id,
+                f"對手玩家 {self.global_ids[player_id]} 斷線後未在 {self.resume_grace:g} 秒內重新連線。",
+            )
+
+    def forfeit(self, player_id, reason):
+        # 玩家因斷線判負，通知對手並清理房間 (呼叫端持有 self.lock)
+        self.over = True
+        opp_id = 2 if player_id == 1 else 1
+        self.winner = opp_id
+        self.end_reason = (
+            f"玩家 {self.global_ids[player_id]} 斷線，玩家 {self.global_ids[opp_id]} 獲勝。"
+        )
+        if opp_id in self.players:
+            self.send(
+                opp_id,
+                {"type": constants.MSG_TYPE_GAME_OVER, "winner": opp_id, "reason": reason},
+            )
+            self.log.info("因為斷線而結束。玩家 %s 獲勝。", self.global_ids[opp_id])
+        self.cleanup()
+
+    def resume(self, player_id, conn, reader, frames):
+        # thread 模式：換上重新連線的 socket 後，在目前的 thread 繼續讀取該玩家的訊息
+        if self.reattach(player_id, conn, frames):
+            self.player_loop(conn, player_id, reader)
+
+    def reattach(self, player_id, conn, frames):
+        # 玩家以 resume token 重新連線：換上新連線 (仍連著的舊連線會被關閉)，
+        # 處理新連線已送來的訊息 (hello 等) 後送出 ID 與一則完整狀態，不重播對局過程
+        with self.lock:
+            over = self.over
+            if not over:
+                old = self.players.get(player_id)
+                self.players[player_id] = conn
+                self.away.pop(player_id, None)
+                timers.cancel(self.resume_timers.pop(player_id, None))
+                self.last_seen[player_id] = time.monotonic()
+                self.encoders[player_id] = codec.encode_json
+        if over:
+            try:
+                conn.sendall(
+                    codec.encode_json(
+                        {"type": constants.MSG_TYPE_RESUME_FAILED, "message": "對局已結束。"}
+                    )
                 )
-                print(
-                    f"[Room {self.id}] 因為斷線而結束。玩家 {self.global_ids[opp_id]} 獲勝。"
+                conn.close()
+            except Exception:
+                pass
+            return False
+        if old is not None:
+            try:
+                # 喚醒仍在 recv 的舊 thread
+                old.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            try:
+                old.close()
+            except Exception:
+                pass
+        global_player_id = self.global_ids[player_id]
+        self.log.info("玩家 %s 重新連線。", global_player_id)
+        self.replay({player_id: frames})
+        opp_id = 2 if player_id == 1 else 1
+        with self.lock:
+            self.send_assign_id(player_id)
+            if self.views is not None:
+                self.send_state(player_id, "重新連線成功。")
+                self.send_clock(player_id)
+            elif player_id in self.setups:
+                self.send(
+                    player_id, {"type": constants.MSG_TYPE_INFO, "message": "佈局完成，等待對手..."}
                 )
-            self.cleanup()
+            else:
+                self.send(player_id, {"type": constants.MSG_TYPE_START_SETUP})
+            self.send(
+                opp_id,
+                {"type": constants.MSG_TYPE_INFO, "message": f"對手玩家 {global_player_id} 已重新連線。"},
+            )
+            self.publish_spectators(f"玩家 {global_player_id} 已重新連線。")
+        return True
 
     def cleanup(self):
-        # 關閉所有 socket 並通知 server 移除房間
-        print(f"[Room {self.id}] 正在清理房間...")
+        # 關閉所有 socket 並通知 server 移除房間 (呼叫端持有 self.lock)；只執行一次，
+        # 避免對局紀錄與積分被重複寫入
+        if self.cleaned:
+            return
+        self.cleaned = True
+        self.log.debug("正在清理房間...")
+        timers.cancel(self.turn_timer)
+        for timer in [*self.heartbeats.values(), *self.resume_timers.values()]:
+            timers.cancel(timer)
+        result = None  # (勝方暱稱, 敗方暱稱)，房間清理完成後才更新 rating
+        if self.started_at is not None:
+            duration = time.monotonic() - self.started_at
+            metrics.GAMES_FINISHED.inc()
+            metrics.GAME_SECONDS.observe(duration)
+            gamelog.submit(self.game_record(duration))
+            self.started_at = None
+            loser = 3 - self.winner if self.winner else None
+            if self.server and loser and len(self.nicknames) == 2:
+                result = (self.nicknames[self.winner], self.nicknames[loser])
         for pid, conn in self.players.items():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[Room {self.id}] 關閉玩家 {self.global_ids[pid]} 的連線時發生錯誤: {e}")
+                self.log.warning("關閉玩家 %s 的連線時發生錯誤: %s", self.global_ids[pid], e)
         self.players.clear()
+        self.audience.close(
+            codec.encode_json(
+                {
+                    "type": constants.MSG_TYPE_GAME_OVER,
+                    "winner": self.winner,
+                    "reason": self.end_reason or "對局已結束。",
+                }
+            )
+        )
         if self.server:
             self.server.remove_room(self.id)
+        if result is not None:
+            try:
+                self.server.record_result(*result)
+            except Exception as e:
+                self.log.warning("更新 rating 失敗: %s", e)
+
+    def game_record(self, duration):
+        # 寫入對局紀錄的內容：雙方佈局、每一步 (含吃子) 與結果，由背景 thread 編碼寫出
+        started, first_player, setups = self.opening
+        if self.game.reason is not None:
+            reason = self.game.reason
+        elif self.result_reason is not None:
+            reason = self.result_reason
+        else:
+            reason = constants.WIN_REASON_DISCONNECT if self.winner else None
+        return gamelog.GameRecord(
+            self.id,
+            started,
+            duration,
+            (self.global_ids[1], self.global_ids[2]),
+            (self.nicknames.get(1, "玩家1"), self.nicknames.get(2, "玩家2")),
+            first_player,
+            setups,
+            [(player, frm, to, captured) for player, frm, to, _, captured in self.game.history],
+            self.winner,
+            reason,
+        )
 
     def on_message(self, player_id, msg):
         # 處理玩家傳來的各種訊息 (佈局/移動)
@@ -142,6 +487,7 @@ class Room:
         with self.lock:
             if self.over:
                 if msg_type == constants.MSG_TYPE_MOVE:
+                    metrics.INVALID_MOVES.inc()
                     self.send(
                         player_id,
                         {"type": constants.MSG_TYPE_INVALID_MOVE, "message": "遊戲已結束。"},
@@ -149,10 +495,17 @@ class Room:
                 return
             if msg_type == constants.MSG_TYPE_SETUP_DATA:
                 self.on_setup(player_id, msg.get("placements"))
+            elif msg_type == constants.MSG_TYPE_RESYNC:
+                if self.turn is not None:
+                    self.send_state(player_id)
+                    self.send_clock(player_id)
             elif msg_type == constants.MSG_TYPE_MOVE:
                 if self.turn == player_id:
+                    started = time.perf_counter()
                     self.on_move(player_id, msg.get("from_sq"), msg.get("to_sq"))
+                    metrics.MOVE_SECONDS.observe(time.perf_counter() - started)
                 else:
+                    metrics.INVALID_MOVES.inc()
                     self.send(
                         player_id,
                         {"type": constants.MSG_TYPE_INVALID_MOVE, "message": "現在不是你的回合。"},
@@ -160,85 +513,66 @@ class Room:
 
     def on_setup(self, player_id, placements):
         # 處理玩家佈局資料，檢查合法性
-        if not placements or len(placements) != 8:
-            self.send(
-                player_id,
-                {
-                    "type": constants.MSG_TYPE_SETUP_INVALID,
-                    "message": f"你需要放置 8 個棋子。",
-                },
-            )
-            return
-        good = sum(1 for p in placements if p["ghost_type"] == "G")
-        bad = sum(1 for p in placements if p["ghost_type"] == "B")
-        if good != 4 or bad != 4:
+        result = self.game.apply_setup(player_id, placements)
+        if not result.ok:
             self.send(
                 player_id,
                 {
                     "type": constants.MSG_TYPE_SETUP_INVALID,
-                    "message": f"你需要放置 4 個好鬼和 4 個壞鬼。",
+                    "message": self.setup_error_message(player_id, result),
                 },
             )
             return
-        valid_rows = constants.P1_SETUP_ROWS if player_id == 1 else constants.P2_SETUP_ROWS
-        valid_cols = [1, 2, 3, 4]
-        temp_board = [[None for _ in range(6)] for _ in range(6)]
-        for p in placements:
-            r, c, t = p["row"], p["col"], p["ghost_type"]
-            if not (0 <= r < 6 and 0 <= c < 6 and r in valid_rows and c in valid_cols):
-                self.send(
-                    player_id,
-                    {
-                        "type": constants.MSG_TYPE_SETUP_INVALID,
-                        "message": f"棋子位置 ({r},{c}) 無效。必須在列 {valid_rows} 且行 {valid_cols} 的範圍內。",
-                    },
-                )
-                return
-            if temp_board[r][c] is not None:
-                self.send(
-                    player_id,
-                    {
-                        "type": constants.MSG_TYPE_SETUP_INVALID,
-                        "message": f"位置 ({r},{c}) 上不能重複放置棋子。",
-                    },
-                )
-                return
-            temp_board[r][c] = (player_id, t)
         self.setups[player_id] = placements
-        for p in placements:
-            self.board[p["row"]][p["col"]] = (player_id, p["ghost_type"])
         self.send(player_id, {"type": constants.MSG_TYPE_INFO, "message": "佈局完成，等待對手..."})
         if len(self.setups) == 2:
             self.start_game()
 
+    def setup_error_message(self, player_id, result):
+        # 佈局錯誤代碼轉成提示訊息
+        if result.error == engine.SETUP_BAD_COUNT:
+            return "你需要放置 8 個棋子。"
+        if result.error == engine.SETUP_BAD_COMPOSITION:
+            return "你需要放置 4 個好鬼和 4 個壞鬼。"
+        if result.error == engine.SETUP_LOCKED:
+            return "遊戲已開始，無法重新佈局。"
+        r, c = result.square
+        if result.error == engine.SETUP_DUPLICATE:
+            return f"位置 ({r},{c}) 上不能重複放置棋子。"
+        valid_rows = constants.P1_SETUP_ROWS if player_id == 1 else constants.P2_SETUP_ROWS
+        return f"棋子位置 ({r},{c}) 無效。必須在列 {valid_rows} 且行 {constants.SETUP_COLS} 的範圍內。"
+
     def start_game(self):
         # 遊戲正式開始，隨機決定先手
-        self.turn = random.choice([1, 2])
-        print(f"[Room {self.id}] 遊戲正式開始！先手玩家: {self.turn}")
+        self.game.start(random.choice([1, 2]))
+        self.views = BoardViews(self.game.bb)
+        self.started_at = time.monotonic()
+        bb = self.game.bb
+        self.opening = (
+            time.time(),
+            self.turn,
+            (gamelog.setup_byte(1, bb.good[1]), gamelog.setup_byte(2, bb.good[2])),
+        )
+        self.log.info("遊戲正式開始！先手玩家: %s", self.turn)
+        self.start_turn()
         for pid in self.players:
             self.send_state(pid, "遊戲開始！")
+            self.send_clock(pid)
+        self.publish_spectators("遊戲開始！")
+
+    @property
+    def turn(self):
+        # 當前回合
+        return self.game.turn
+
+    @property
+    def board(self):
+        # 6x6 list-of-lists 形式的棋盤，相容舊程式/除錯用
+        return self.game.bb.rows()
 
     def board_view(self, player_id):
-        # 產生給指定玩家的棋盤視角 (隱藏對手資訊)
-        view = [[constants.EMPTY_SQUARE_CHAR for _ in range(6)] for _ in range(6)]
-        for r in range(6):
-            for c in range(6):
-                piece = self.board[r][c]
-                if piece:
-                    owner, t = piece
-                    if owner == player_id:
-                        view[r][c] = (
-                            constants.P1_GOOD_CHAR
-                            if (player_id == 1 and t == "G")
-                            else (
-                                constants.P1_BAD_CHAR
-                                if (player_id == 1)
-                                else (constants.P2_GOOD_CHAR if t == "G" else constants.P2_BAD_CHAR)
-                            )
-                        )
-                    else:
-                        view[r][c] = constants.OPPONENT_GHOST_CHAR
-        return view
+        # 給指定玩家 (或觀戰者 board_views.OBSERVER) 的棋盤視角，直接取自快取
+        return self.views.get(player_id)
 
     def send_state(self, player_id, last_action_desc=""):
         # 傳送遊戲狀態給玩家
@@ -250,14 +584,20 @@ class Room:
             "board": self.board_view(player_id),
             "current_player": self.turn,
             "my_player_id": player_id,
-            "my_good_captured_by_opponent": self.captured[opp]["good"],
-            "my_bad_captured_by_opponent": self.captured[opp]["bad"],
-            "opponent_good_captured_by_me": self.captured[player_id]["good"],
-            "opponent_bad_captured_by_me": self.captured[player_id]["bad"],
+            "my_good_captured_by_opponent": self.game.captured[opp][0],
+            "my_bad_captured_by_opponent": self.game.captured[opp][1],
+            "opponent_good_captured_by_me": self.game.captured[player_id][0],
+            "opponent_bad_captured_by_me": self.game.captured[player_id][1],
             "last_action_desc": last_action_desc,
             "my_nickname": self.nicknames.get(player_id, f"玩家{player_id}"),
             "opponent_nickname": self.nicknames.get(opp, f"玩家{opp}"),
         }
+        if self.protocols[player_id] == constants.PROTOCOL_VERSION_DELTA:
+            # 完整快照已包含 current_player，不另送回合訊息
+            self.state_seq[player_id] += 1
+            state["seq"] = self.state_seq[player_id]
+            self.send(player_id, state)
+            return
         self.send(player_id, state)
         self.send(
             player_id,
@@ -270,88 +610,207 @@ class Room:
             },
         )
 
-    def on_move(self, player_id, from_sq, to_sq):
-        # 處理玩家移動，檢查規則、吃子、勝負判斷
-        from_r, from_c = from_sq
-        to_r, to_c = to_sq
-        if not (0 <= from_r < 6 and 0 <= from_c < 6 and 0 <= to_r < 6 and 0 <= to_c < 6):
-            self.send(
-                player_id, {"type": constants.MSG_TYPE_INVALID_MOVE, "message": "無效的座標。"}
-            )
-            self.send(player_id, {"type": constants.MSG_TYPE_YOUR_TURN})
+    def on_setup_timeout(self):
+        # 佈局時限到：沒有完成佈局的一方判負，雙方都沒完成則不分勝負
+        with self.lock:
+            if self.over or self.views is not None:
+                return
+            late = [pid for pid in (1, 2) if pid not in self.setups]
+            if len(late) == 2:
+                self.finish_timeout(None, "雙方都未在時限內完成佈局。")
+            elif late:
+                loser = late[0]
+                self.finish_timeout(
+                    3 - loser,
+                    f"玩家 {self.global_ids[loser]} 未在 {self.limits.move:g} 秒內完成佈局，"
+                    f"玩家 {self.global_ids[3 - loser]} 獲勝！",
+                )
+
+    def start_turn(self):
+        # 新回合開始：依每步時限與該玩家剩下的總時間排定逾時
+        timers.cancel(self.turn_timer)
+        self.turn_timer = None
+        self.turn_started = time.monotonic()
+        remaining = self.turn_remaining(self.turn)
+        if remaining is not None:
+            self.turn_timer = timers.schedule(remaining, self.on_turn_timeout, self.game.ply)
+
+    def turn_remaining(self, player_id):
+        # 目前回合還剩幾秒 (None 表示不限制)
+        elapsed = time.monotonic() - self.turn_started
+        limits = []
+        if self.limits.move > 0:
+            limits.append(self.limits.move - elapsed)
+        if self.clocks is not None:
+            limits.append(self.clocks[player_id] - elapsed)
+        return min(limits) if limits else None
+
+    def on_turn_timeout(self, ply):
+        # 回合計時器到期 (ply 用來忽略已經走完的回合)
+        with self.lock:
+            if self.over or self.views is None or self.game.ply != ply:
+                return
+            remaining = self.turn_remaining(self.turn)
+            if remaining is not None and remaining > 0:
+                self.turn_timer = timers.schedule(remaining, self.on_turn_timeout, ply)
+                return
+            self.on_overtime(self.turn)
+
+    def on_overtime(self, player_id):
+        # 玩家超過每步時限或用完總時間：判負
+        opp_id = 2 if player_id == 1 else 1
+        elapsed = time.monotonic() - self.turn_started
+        if self.clocks is not None and self.clocks[player_id] - elapsed <= 0:
+            self.clocks[player_id] = 0.0
+            text = f"玩家 {self.global_ids[player_id]} 的總時間用完"
+        else:
+            text = f"玩家 {self.global_ids[player_id]} 超過每步 {self.limits.move:g} 秒的時限"
+        self.finish_timeout(opp_id, f"{text}，玩家 {self.global_ids[opp_id]} 獲勝！")
+
+    def finish_timeout(self, winner, reason):
+        # 因超時結束對局 (呼叫端持有 self.lock)
+        self.over = True
+        self.winner = winner
+        self.end_reason = reason
+        self.result_reason = constants.WIN_REASON_TIMEOUT
+        metrics.GAME_TIMEOUTS.inc()
+        self.log.info("%s", reason)
+        self.broadcast({"type": constants.MSG_TYPE_GAME_OVER, "winner": winner, "reason": reason})
+        self.cleanup()
+
+    def send_clock(self, player_id):
+        # 時間限制與雙方剩下的時間 (秒)；client 依此自行倒數，server 端的計時為準
+        if self.turn_started is None or (self.limits.move <= 0 and self.clocks is None):
             return
-        moving_piece = self.board[from_r][from_c]
-        if not moving_piece or moving_piece[0] != player_id:
-            self.send(
-                player_id,
-                {"type": constants.MSG_TYPE_INVALID_MOVE, "message": "你不能移動該位置的棋子。"},
+        time_left = None
+        if self.clocks is not None:
+            elapsed = time.monotonic() - self.turn_started
+            time_left = [
+                round(self.clocks[pid] - (elapsed if pid == self.turn else 0), 1) for pid in (1, 2)
+            ]
+        remaining = self.turn_remaining(self.turn)
+        self.send(
+            player_id,
+            {
+                "type": constants.MSG_TYPE_CLOCK,
+                "move_time": self.limits.move,
+                "time_left": time_left,
+                "turn": self.turn,
+                "turn_left": round(remaining, 1) if remaining is not None else None,
+            },
+        )
+
+    def add_spectator(self, conn, hub):
+        # 加入觀戰：先送房間資訊，遊戲已開始時送出目前的完整狀態，之後由 hub 分送每次的狀態
+        with self.lock:
+            greeting = codec.encode_json(
+                {
+                    "type": constants.MSG_TYPE_WATCH_ACK,
+                    "room_id": self.id,
+                    "nicknames": [self.nicknames.get(1, "玩家1"), self.nicknames.get(2, "玩家2")],
+                }
             )
-            self.send(player_id, {"type": constants.MSG_TYPE_YOUR_TURN})
+            hub.attach(self.audience, conn, greeting)
+            if self.audience.latest is None:
+                self.publish_spectators()
+        self.log.debug("新的觀戰者，目前 %s 人觀戰。", len(self.audience))
+
+    def spectator_state(self, last_action_desc=""):
+        # 觀戰者視角的完整狀態：雙方的鬼都不顯示好壞
+        return {
+            "type": constants.MSG_TYPE_SPECTATE_STATE,
+            "room_id": self.id,
+            "board": self.board_view(OBSERVER),
+            "current_player": self.turn,
+            "ply": self.game.ply,
+            "nicknames": [self.nicknames.get(1, "玩家1"), self.nicknames.get(2, "玩家2")],
+            "captured": [self.game.captured[1], self.game.captured[2]],  # 各玩家吃掉的 [好鬼, 壞鬼]
+            "last_action_desc": last_action_desc,
+        }
+
+    def publish_spectators(self, last_action_desc=""):
+        # 編碼一次後交給所有觀戰者共用；沒有觀戰者時不編碼，有人加入時再補上目前的狀態
+        if self.views is None:
+            return
+        if len(self.audience) == 0:
+            self.audience.publish(None)
             return
-        if not (
-            (abs(from_r - to_r) == 1 and from_c == to_c)
-            or (abs(from_c - to_c) == 1 and from_r == to_r)
-        ):
+        self.audience.publish(codec.encode_json(self.spectator_state(last_action_desc)))
+
+    def on_move(self, player_id, from_sq, to_sq):
+        # 處理玩家移動，規則、吃子、勝負判斷交給引擎
+        remaining = self.turn_remaining(player_id)
+        if remaining is not None and remaining <= 0:
+            # 計時器還沒觸發但已經超時
+            self.on_overtime(player_id)
+            return
+        result = self.game.apply_move(player_id, from_sq, to_sq)
+        if not result.ok:
+            metrics.INVALID_MOVES.inc()
             self.send(
                 player_id,
-                {
-                    "type": constants.MSG_TYPE_INVALID_MOVE,
-                    "message": "無效的移動方式，只能前後左右移動一格。",
-                },
+                {"type": constants.MSG_TYPE_INVALID_MOVE, "message": MOVE_ERROR_MESSAGES[result.error]},
             )
             self.send(player_id, {"type": constants.MSG_TYPE_YOUR_TURN})
             return
-        target = self.board[to_r][to_c]
+        self.views.apply_move(result.player, result.frm, result.to, result.moved)
+        if self.clocks is not None:
+            self.clocks[player_id] -= time.monotonic() - self.turn_started
+        from_r, from_c = SQUARE_RC[result.frm]
+        to_r, to_c = SQUARE_RC[result.to]
         action_desc = (
             f"玩家 {self.global_ids[player_id]} 從 ({from_r},{from_c}) 移動到 ({to_r},{to_c})"
         )
-        if target and target[0] == player_id:
-            self.send(
-                player_id,
-                {"type": constants.MSG_TYPE_INVALID_MOVE, "message": "目標位置有你自己的棋子。"},
-            )
-            self.send(player_id, {"type": constants.MSG_TYPE_YOUR_TURN})
-            return
-        self.board[to_r][to_c] = moving_piece
-        self.board[from_r][from_c] = None
-        if target:
-            opp_id, captured_type = target
-            if captured_type == "G":
-                self.captured[player_id]["good"] += 1
-            else:
-                self.captured[player_id]["bad"] += 1
-            action_desc += f"，吃掉了玩家 {self.global_ids[opp_id]} 的{'好鬼' if captured_type == 'G' else '壞鬼'}！"
-        winner, reason = self.check_win(player_id, moving_piece[1], (to_r, to_c))
-        if winner:
+        if result.captured:
+            opp_id = 2 if player_id == 1 else 1
+            action_desc += f"，吃掉了玩家 {self.global_ids[opp_id]} 的{'好鬼' if result.captured == 'G' else '壞鬼'}！"
+        if result.winner:
+            winner = result.winner
+            reason = self.win_message(winner, result.reason)
             self.over = True
-            for notify_pid in self.players:
-                self.send_state(notify_pid, action_desc)
-            print(f"[Room {self.id}] {reason}")
+            self.winner = winner
+            self.end_reason = reason
+            self.notify_move(result, action_desc)
+            self.publish_spectators(action_desc)
+            self.log.info("%s", reason)
             self.broadcast(
                 {"type": constants.MSG_TYPE_GAME_OVER, "winner": winner, "reason": reason}
             )
             self.cleanup()
             return
-        self.turn = 2 if player_id == 1 else 1
+        self.start_turn()
+        self.notify_move(result, action_desc)
+        self.publish_spectators(action_desc)
+
+    def notify_move(self, result, action_desc):
+        # 通知雙方這一步的結果：v2 玩家送差量，v1 玩家送完整狀態
         for notify_pid in self.players:
-            self.send_state(notify_pid, action_desc)
+            if self.protocols[notify_pid] == constants.PROTOCOL_VERSION_DELTA:
+                self.send_delta(notify_pid, result)
+            else:
+                self.send_state(notify_pid, action_desc)
 
-    def check_win(self, player_id, moved_type, to_pos):
-        # 勝負判斷邏輯
-        opp = 2 if player_id == 1 else 1
-        pid_str = self.global_ids[player_id]
-        opp_str = self.global_ids[opp]
-        if self.captured[player_id]["good"] >= 4:
-            return player_id, f"玩家 {pid_str} 吃掉了對手所有好鬼！"
-        if self.captured[opp]["bad"] >= 4:
-            return (
-                player_id,
-                f"玩家 {pid_str} 的所有壞鬼被對手玩家 {opp_str} 吃掉，玩家 {pid_str} 獲勝！",
-            )
-        if self.captured[player_id]["bad"] >= 4:
-            return opp, f"玩家 {opp_str} 的所有壞鬼被對手玩家 {pid_str} 吃掉，玩家 {opp_str} 獲勝！"
-        if moved_type == "G":
-            corners = constants.P1_ESCAPE_CORNERS if player_id == 1 else constants.P2_ESCAPE_CORNERS
-            if to_pos in corners:
-                return player_id, f"玩家 {pid_str} 的好鬼成功逃脫！"
-        return None, ""
+    def send_delta(self, player_id, result):
+        # 協定 v2：只送變動的兩格、被吃掉的鬼與下一回合，合併成一則訊息
+        from_r, from_c = SQUARE_RC[result.frm]
+        to_r, to_c = SQUARE_RC[result.to]
+        piece = self.views.get(player_id)[to_r][to_c]
+        self.state_seq[player_id] += 1
+        self.send(
+            player_id,
+            {
+                "type": constants.MSG_TYPE_STATE_DELTA,
+                "seq": self.state_seq[player_id],
+                "changes": [[from_r, from_c, constants.EMPTY_SQUARE_CHAR], [to_r, to_c, piece]],
+                "mover": result.player,
+                "captured": result.captured,
+                "turn": self.game.turn,
+            },
+        )
+
+    def win_message(self, winner, reason):
+        # 勝負原因代碼轉成訊息
+        loser = 2 if winner == 1 else 1
+        return WIN_MESSAGES[reason].format(
+            winner=self.global_ids[winner], loser=self.global_ids[loser]
+        )
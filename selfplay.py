@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import random
+import time
+from multiprocessing import Pool
+
+from engine import GameState
+from policies import load_policy
+
+# 超過步數上限的對局視為和局
+REASON_MAX_PLIES = "max_plies"
+# 對局長度直方圖的區間寬度 (步)
+LENGTH_BUCKET = 10
+
+
+class SelfPlayStats:
+    # 只保留彙總數字，不保存個別對局，可跨 process 合併
+    def __init__(self):
+        self.games = 0
+        self.total_plies = 0
+        self.wins = [0, 0, 0]  # wins[0] 為和局，wins[pid] 為該玩家勝場
+        self.first_mover_wins = 0
+        self.reasons = {}  # 勝負原因 -> 局數
+        self.lengths = {}  # 勝負原因 -> {長度區間起點: 局數}
+
+    def add(self, winner, reason, plies, first):
+        self.games += 1
+        self.total_plies += plies
+        self.wins[winner or 0] += 1
+        if winner == first:
+            self.first_mover_wins += 1
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        buckets = self.lengths.setdefault(reason, {})
+        bucket = plies // LENGTH_BUCKET * LENGTH_BUCKET
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.games += other.games
+        self.total_plies += other.total_plies
+        for i in range(3):
+            self.wins[i] += other.wins[i]
+        self.first_mover_wins += other.first_mover_wins
+        for reason, count in other.reasons.items():
+            self.reasons[reason] = self.reasons.get(reason, 0) + count
+        for reason, buckets in other.lengths.items():
+            mine = self.lengths.setdefault(reason, {})
+            for bucket, count in buckets.items():
+                mine[bucket] = mine.get(bucket, 0) + count
+
+    def to_dict(self):
+        return {
+            "games": self.games,
+            "avg_plies": self.total_plies / self.games if self.games else 0.0,
+            "draws": self.wins[0],
+            "p1_wins": self.wins[1],
+            "p2_wins": self.wins[2],
+            "first_mover_wins": self.first_mover_wins,
+            "reasons": dict(self.reasons),
+            "length_histogram": {
+                reason: {str(k): v for k, v in sorted(buckets.items())}
+                for reason, buckets in self.lengths.items()
+            },
+        }
+
+
+def game_rng(seed, index):
+    # 每局獨立的亂數產生器，結果與 process 數量、分配順序無關
+    return random.Random((seed << 32) + index)
+
+
+def play_game(policies, rng, max_plies, setups=None):
+    # 進行一局自我對戰，回傳 (勝方, 勝負原因, 步數, 先手)
+    # policies: {1: policy, 2: policy}；setups 可指定雙方好鬼位置 {pid: good_squares}
+    game = GameState()
+    for pid in (1, 2):
+        good = setups[pid] if setups else policies[pid].choose_setup(pid, rng)
+        game.setup_from_good(pid, good)
+    first = rng.choice((1, 2))
+    game.start(first)
+    while game.winner is None:
+        if game.ply >= max_plies:
+            return None, REASON_MAX_PLIES, game.ply, first
+        game.push(*policies[game.turn].choose_move(game, rng))
+    return game.winner, game.reason, game.ply, first
+
+
+_policy_cache = {}
+
+
+def _get_policy(spec):
+    # 每個 worker process 只建立一次策略物件
+    policy = _policy_cache.get(spec)
+    if policy is None:
+        policy = _policy_cache[spec] = load_policy(spec)
+    return policy
+
+
+def run_chunk(task):
+    # worker 執行一段連續編號的對局並回傳彙總結果
+    p1_spec, p2_spec, seed, start, count, max_plies = task
+    policies = {1: _get_policy(p1_spec), 2: _get_policy(p2_spec)}
+    stats = SelfPlayStats()
+    for index in range(start, start + count):
+        stats.add(*play_game(policies, game_rng(seed, index), max_plies))
+    return stats
+
+
+def run_selfplay(p1, p2, games, seed=0, processes=None, chunk_size=500, max_plies=400, on_progress=None):
+    # 將對局切成 chunk 分散到 process pool，結果邊收邊合併
+    tasks = [
+        (p1, p2, seed, start, min(chunk_size, games - start), max_plies)
+        for start in range(0, games, chunk_size)
+    ]
+    total = SelfPlayStats()
+
+    def collect(results):
+        for stats in results:
+            total.merge(stats)
+            if on_progress:
+                on_progress(total)
+
+    if processes == 1:
+        collect(map(run_chunk, tasks))
+    else:
+        with Pool(processes) as pool:
+            collect(pool.imap_unordered(run_chunk, tasks))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多核心自我對戰模擬")
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument("--p1", default="random", help="玩家 1 策略 (名稱或 module:ClassName)")
+    parser.add_argument("--p2", default="random", help="玩家 2 策略 (名稱或 module:ClassName)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--max-plies", type=int, default=400, help="超過此步數視為和局")
+    parser.add_argument("--json", help="將彙總結果寫入指定的 JSON 檔")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    def progress(stats):
+        elapsed = time.perf_counter() - start
+        print(f"\r{stats.games}/{args.games} 局  {stats.games / elapsed:,.0f} games/sec", end="", flush=True)
+
+    stats = run_selfplay(
+        args.p1,
+        args.p2,
+        args.games,
+        seed=args.seed,
+        processes=args.processes,
+        chunk_size=args.chunk_size,
+        max_plies=args.max_plies,
+        on_progress=progress,
+    )
+    print()
+    report = stats.to_dict()
+    report.update({"p1_policy": args.p1, "p2_policy": args.p2, "seed": args.seed})
+    report["elapsed_sec"] = round(time.perf_counter() - start, 3)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,124 +1,251 @@
+import argparse
 import json
+import os
 import socket
+import sys
 import threading
 
+import bot
+import gamelog
+import metrics
+import timers
 from common import constants
-from room import Room
+from matchmaking import Lobby, Matchmaker, RatingBook, watch_failed_frame
+from outbound import Writer
+from room import DEFAULT_LIMITS, RESUME_GRACE, Room, TimeLimits
+from server_log import LOG_FORMATS, LOG_LEVELS, get_logger, setup_logging
+from spectate import SpectatorHub, pick_room
+
+log = get_logger("server")
+
+# listen backlog，大量玩家同時登入時避免 SYN 被丟棄
+ACCEPT_BACKLOG = 4096
 
 
 class GhostChessServer:
-    def __init__(self, host, port):
+    def __init__(
+        self, host, port, resume_grace=RESUME_GRACE, bot_after=0, limits=DEFAULT_LIMITS
+    ):
         # 初始化伺服器 socket，設定監聽 host/port
+        # bot_after > 0 時等待配對超過該秒數的玩家改與 AI 對戰；limits 為房間的時間限制
         self.host = host
         self.port = port
+        self.resume_grace = resume_grace
+        self.limits = limits
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.clients = {}  # 儲存所有連線中的 client
         self.next_player_id = 1
         self.next_room_id = 1
-        self.matching_queue = []  # 等待配對的玩家
+        self.ratings = RatingBook()
+        # 等待配對的玩家由配對 thread 管理，accept 迴圈交出連線後立刻回去 accept
+        self.lobby = Lobby(
+            self.ratings,
+            self.create_room,
+            self.drop_waiting,
+            self.resume_player,
+            self.create_bot_room if bot_after else None,
+            bot_after,
+            self.watch_room,
+            limits.idle,
+        )
+        self.matchmaker = self.lobby.matchmaker
+        self.spectators = SpectatorHub()  # 所有房間的觀戰者由同一個 thread non-blocking 送出
+        # 房間內玩家的連線包成送出佇列，房間在 lock 內只排入訊息，由 writer thread 寫出
+        self.writer = Writer()
+        metrics.SEND_QUEUE_BYTES.set_function(self.writer.queued_bytes)
+        metrics.SLOW_CONNECTIONS.set_function(self.writer.slow_count)
         self.active_rooms = {}  # 活動中的房間
-        self.server_lock = threading.Lock()
+        self.sessions = {}  # resume token -> (房間 ID, 房內玩家編號)
+        self.server_lock = threading.RLock()
+        metrics.track_server(self)
 
     def start(self):
         # 啟動伺服器，開始接受 client 連線
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen()
-        print(f"伺服器已啟動於 {self.host}:{self.port}，等待玩家連線...")
-        self.server_socket.settimeout(1.0)
+        self.server_socket.listen(ACCEPT_BACKLOG)
+        log.info("伺服器已啟動於 %s:%s，等待玩家連線...", self.host, self.port)
+        # 回合時限、心跳與斷線保留座位都由時間輪的 thread 觸發
+        timers.start()
+        self.lobby.start()
+        self.spectators.start()
+        self.writer.start()
         while True:
             try:
                 conn, addr = self.server_socket.accept()
-                print(f"來自 {addr} 的新連線。")
+                log.debug("來自 %s 的新連線。", addr)
                 with self.server_lock:
                     pid = self.next_player_id
                     self.next_player_id += 1
                     self.clients[pid] = conn
-                    self.matching_queue.append((conn, pid))
-                    print(f"玩家 {pid} 加入匹配隊伍。等待人數: {len(self.matching_queue)}")
-
-                    if len(self.matching_queue) >= 2:
-                        # 當有兩位玩家時，配對進入新房間
-                        p1 = self.matching_queue.pop(0)
-                        p2 = self.matching_queue.pop(0)
-
-                        room_id = self.next_room_id
-                        self.next_room_id += 1
-                        print(f"匹配成功！玩家 {p1[1]} 和玩家 {p2[1]} 進入房間 {room_id}")
-                        print(f"[DEBUG] 建立 Room: id={room_id}, 玩家={p1[1]},{p2[1]}")
-                        room = Room(room_id, p1[0], p1[1], p2[0], p2[1], self)
-                        self.active_rooms[room_id] = room
-
-                        # 為每個房間開新 thread 處理遊戲流程 (concurrent/threaded)
-                        threading.Thread(target=room.start, daemon=True).start()
-                    else:
-                        try:
-                            # 若尚未配對，通知 client 等待對手
-                            conn.sendall(
-                                json.dumps({"type": constants.MSG_TYPE_WAIT_OPPONENT}).encode(
-                                    "utf-8"
-                                )
-                                + b"\n"
-                            )
-                        except Exception as e:
-                            print(f"向等待中的玩家 {pid} 發送消息失敗: {e}")
-                            if pid in self.clients:
-                                del self.clients[pid]
-                            self.matching_queue = [p for p in self.matching_queue if p[1] != pid]
-                            try:
-                                conn.close()
-                            except:
-                                pass
-            except socket.timeout:
-                continue
+                self.lobby.add(conn, pid)
             except KeyboardInterrupt:
-                print("伺服器正在關閉...")
+                log.info("伺服器正在關閉...")
                 self.shutdown_server()
+                break
+
+    def create_room(self, p1, p2):
+        # 配對成功：交給新房間 (每個房間開新 thread 處理遊戲流程)
+        with self.server_lock:
+            room_id = self.next_room_id
+            self.next_room_id += 1
+            log.info("匹配成功！玩家 %s 和玩家 %s 進入房間 %s", p1.pid, p2.pid, room_id)
+            log.debug("建立 Room: id=%s, 玩家=%s,%s", room_id, p1.pid, p2.pid)
+            room = Room(
+                room_id,
+                self.writer.wrap(p1.conn, f"玩家 {p1.pid}"),
+                p1.pid,
+                self.writer.wrap(p2.conn, f"玩家 {p2.pid}"),
+                p2.pid,
+                self,
+                resume_grace=self.resume_grace,
+                limits=self.limits,
+            )
+            self.active_rooms[room_id] = room
+            for player_id, token in room.tokens.items():
+                self.sessions[token] = (room_id, player_id)
+        threading.Thread(
+            target=room.start,
+            args=({1: p1.reader, 2: p2.reader}, {1: p1.frames, 2: p2.frames}),
+            daemon=True,
+        ).start()
+
+    def create_bot_room(self, waiting):
+        # 等太久沒有對手：與 AI 在一般的房間對戰，AI 座位不占用 thread
+        seat = bot.BotSeat()
+        with self.server_lock:
+            room_id = self.next_room_id
+            self.next_room_id += 1
+            bot_pid = self.next_player_id
+            self.next_player_id += 1
+            log.info("玩家 %s 等待逾時，與 AI 進入房間 %s", waiting.pid, room_id)
+            room = Room(
+                room_id,
+                self.writer.wrap(waiting.conn, f"玩家 {waiting.pid}"),
+                waiting.pid,
+                seat,
+                bot_pid,
+                self,
+                resume_grace=self.resume_grace,
+                limits=self.limits,
+            )
+            seat.attach(room, 2)
+            self.active_rooms[room_id] = room
+            # AI 座位不能以 token 重新連線
+            self.sessions[room.tokens[1]] = (room_id, 1)
+        threading.Thread(
+            target=room.start,
+            args=({1: waiting.reader}, {1: waiting.frames, 2: seat.opening_frames()}),
+            daemon=True,
+        ).start()
+
+    def drop_waiting(self, waiting):
+        # 等待中的玩家離線或違規
+        self.remove_client(waiting.pid)
+
+    def resume_player(self, waiting, token):
+        # 帶 resume token 的新連線回到原本的房間 (在新 thread 送出狀態並接手讀取)
+        with self.server_lock:
+            room_id, player_id = self.sessions.get(token, (None, None))
+            room = self.active_rooms.get(room_id)
+            if room is None:
+                return False
+            # 連線改以原本的玩家 ID 記錄，舊連線由房間關閉
+            self.clients.pop(waiting.pid, None)
+            global_player_id = room.global_ids[player_id]
+            self.clients[global_player_id] = waiting.conn
+        conn = self.writer.wrap(waiting.conn, f"玩家 {global_player_id}")
+        threading.Thread(
+            target=room.resume,
+            args=(player_id, conn, waiting.reader, waiting.frames),
+            daemon=True,
+        ).start()
+        return True
+
+    def watch_room(self, waiting, room_id):
+        # 觀戰的連線交給房間的 Audience，不算在 clients 裡 (房間結束時由 hub 關閉)
+        with self.server_lock:
+            room = pick_room(self.active_rooms, room_id)
+            self.clients.pop(waiting.pid, None)
+            rooms = list(self.active_rooms)
+        if room is None:
+            log.info("連線 %s 要觀戰的房間 %s 不存在。", waiting.pid, room_id)
+            try:
+                waiting.conn.sendall(watch_failed_frame(rooms))
+            except OSError:
+                pass
+            waiting.conn.close()
+            return
+        room.add_spectator(waiting.conn, self.spectators)
+
+    def record_result(self, winner_name, loser_name):
+        # 對局結束時由房間呼叫，更新雙方 rating
+        self.ratings.record(winner_name, loser_name)
 
     def remove_room(self, room_id):
         # 移除已結束的房間
         with self.server_lock:
             if room_id in self.active_rooms:
-                print(f"移除已結束的房間 {room_id}。")
-                del self.active_rooms[room_id]
+                log.info("移除已結束的房間 %s。", room_id)
+                room = self.active_rooms.pop(room_id)
+                # 房間已關閉兩位玩家的 socket，連線數統計不再計入
+                for pid in room.global_ids.values():
+                    self.clients.pop(pid, None)
+                for token in room.tokens.values():
+                    self.sessions.pop(token, None)
             else:
-                print(f"嘗試移除不存在的房間 {room_id}。")
+                log.warning("嘗試移除不存在的房間 %s。", room_id)
 
     def remove_client(self, pid):
         # 移除離線或中斷連線的 client
         with self.server_lock:
             if pid in self.clients:
-                print(f"從伺服器移除客戶端 {pid}。")
+                log.debug("從伺服器移除客戶端 %s。", pid)
                 try:
                     self.clients[pid].close()
                 except Exception:
                     pass
                 del self.clients[pid]
-            self.matching_queue = [p for p in self.matching_queue if p[1] != pid]
 
     def shutdown_server(self):
         # 關閉伺服器，通知所有 client 並釋放資源
-        print("正在關閉所有活動房間和客戶端連接...")
+        log.info("正在關閉所有活動房間和客戶端連接...")
+        # 先關閉 AI 的搜尋 pool，之後不會再有 AI 的走子進入房間
+        bot.stop()
+        self.lobby.stop()
+        timers.stop()
+        log.info("配對等待時間統計: %s", self.matchmaker.wait_stats())
         with self.server_lock:
-            for room_id, room in list(self.active_rooms.items()):
+            rooms = list(self.active_rooms.values())
+        # cleanup 會取得 server_lock，所以在 server_lock 之外逐一以房間的 lock 結束對局；
+        # 已經自行結束的房間由結束的一方清理
+        for room in rooms:
+            with room.lock:
+                if room.over:
+                    continue
                 room.over = True
+                room.end_reason = "伺服器關閉。"
                 room.broadcast(
                     {"type": constants.MSG_TYPE_GAME_OVER, "winner": None, "reason": "伺服器關閉。"}
                 )
                 room.cleanup()
+        with self.server_lock:
             self.active_rooms.clear()
-            for conn, pid in self.matching_queue:
-                try:
-                    conn.sendall(
-                        json.dumps(
-                            {"type": constants.MSG_TYPE_ERROR, "message": "伺服器正在關閉。"}
-                        ).encode("utf-8")
-                        + b"\n"
-                    )
-                    conn.close()
-                except Exception:
-                    pass
-            self.matching_queue.clear()
+            self.sessions.clear()
+            waiting = [ticket.player for ticket in self.matchmaker]
+            waiting += list(self.lobby.arrivals.values())
+            self.matchmaker = self.lobby.matchmaker = Matchmaker()
+        # 等待中的連線仍是 non-blocking：盡力送出通知，不在 lock 內等待對方
+        notice = json.dumps({"type": constants.MSG_TYPE_ERROR, "message": "伺服器正在關閉。"})
+        for player in waiting:
+            try:
+                player.conn.send(notice.encode("utf-8") + b"\n")
+            except OSError:
+                pass
+        # 送出各房間的結束通知後才關閉其餘連線
+        self.writer.stop()
+        self.spectators.stop()
+        with self.server_lock:
             for pid, conn in self.clients.items():
                 try:
                     conn.close()
@@ -127,10 +254,114 @@ class GhostChessServer:
             self.clients.clear()
         if self.server_socket:
             self.server_socket.close()
-        print("伺服器已關閉。")
+        log.info("伺服器已關閉。")
 
 
 if __name__ == "__main__":
     # 啟動伺服器主程式
-    server = GhostChessServer(constants.SERVER_HOST, constants.SERVER_PORT)
-    server.start()
+    parser = argparse.ArgumentParser(description="幽靈棋伺服器")
+    parser.add_argument("--host", default=constants.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=constants.SERVER_PORT)
+    parser.add_argument(
+        "--mode",
+        choices=["thread", "async", "cluster"],
+        default="thread",
+        help="thread: 每個房間/玩家一個 thread；async: 單一 asyncio event loop；"
+        "cluster: 多個 worker process 共用 port (SO_REUSEPORT)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="cluster 模式的 worker process 數"
+    )
+    parser.add_argument(
+        "--resume-grace",
+        type=float,
+        default=RESUME_GRACE,
+        help="玩家斷線後保留座位等待重新連線的秒數，0 表示斷線即判負",
+    )
+    parser.add_argument(
+        "--move-time",
+        type=float,
+        default=DEFAULT_LIMITS.move,
+        help="每一步 (以及佈局) 的時限秒數，超過判負，0 表示不限制",
+    )
+    parser.add_argument(
+        "--game-time",
+        type=float,
+        default=DEFAULT_LIMITS.game,
+        help="每位玩家整局的總時間秒數，用完判負，0 表示不限制",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=DEFAULT_LIMITS.idle,
+        help="連線多少秒沒有任何訊息 (包括回覆 ping) 就中斷，0 (預設) 表示不檢查；"
+        "不會回覆 ping 的舊版 client 在開啟後會被中斷",
+    )
+    parser.add_argument(
+        "--bot-after",
+        type=float,
+        default=0,
+        help="等待配對超過此秒數改與 AI 對戰 (thread/async 模式)，0 表示不啟用",
+    )
+    parser.add_argument(
+        "--bot-think", type=float, default=bot.THINK_TIME, help="AI 每一步的思考秒數"
+    )
+    parser.add_argument(
+        "--bot-workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) // 2),
+        help="AI 搜尋使用的 process 數 (所有 AI 對局共用)",
+    )
+    parser.add_argument(
+        "--tablebase", metavar="FILE", help="AI 模擬時查詢的殘局庫 (以 tablebase.py 產生)"
+    )
+    parser.add_argument(
+        "--game-log", metavar="DIR", help="把結束的對局以二進位格式附加寫入此目錄，未指定則不記錄"
+    )
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default="text")
+    parser.add_argument(
+        "--metrics-port", type=int, default=0, help="在 127.0.0.1 的此 port 提供 /metrics，0 表示不啟用"
+    )
+    args = parser.parse_args()
+    limits = TimeLimits(args.move_time, args.game_time, args.idle_timeout)
+    if args.mode == "cluster":
+        from cluster import Supervisor
+
+        log_listener = setup_logging(args.log_level, args.log_format, with_process=True)
+        try:
+            Supervisor(
+                args.host,
+                args.port,
+                args.workers,
+                args.resume_grace,
+                args.log_level,
+                args.log_format,
+                args.game_log,
+                limits,
+            ).start(args.metrics_port)
+        finally:
+            log_listener.stop()
+        sys.exit(0)
+    log_listener = setup_logging(args.log_level, args.log_format)
+    if args.game_log:
+        gamelog.start(args.game_log)
+    if args.bot_after:
+        bot.start(args.bot_workers, args.bot_think, args.tablebase)
+    if args.metrics_port:
+        metrics.start_http_server("127.0.0.1", args.metrics_port)
+        log.info("metrics: http://127.0.0.1:%s/metrics", args.metrics_port)
+    if args.mode == "async":
+        from async_server import AsyncGhostChessServer
+
+        server = AsyncGhostChessServer(
+            args.host, args.port, args.resume_grace, args.bot_after, limits
+        )
+    else:
+        server = GhostChessServer(args.host, args.port, args.resume_grace, args.bot_after, limits)
+    try:
+        server.start()
+    finally:
+        bot.stop()
+        gamelog.stop()
+        log_listener.stop()
@@ -0,0 +1,67 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# server 端所有 logger 的共同前綴 (geister.server / geister.room ...)
+LOGGER_NAME = "geister"
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+LOG_FORMATS = ["text", "json"]
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# 叢集模式多個 process 寫到同一個輸出，多加上 process 名稱 (coordinator / worker-N)
+CLUSTER_TEXT_FORMAT = "%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s"
+
+
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+class RoomLog(logging.LoggerAdapter):
+    # 訊息前加上 [Room N]，並把房號放進 record (JSON 格式時成為欄位)
+    def process(self, msg, kwargs):
+        kwargs["extra"] = self.extra
+        return f"[Room {self.extra['room']}] {msg}", kwargs
+
+
+class JsonFormatter(logging.Formatter):
+    # 一行一筆 JSON：時間、等級、logger、訊息與房號
+    def __init__(self, with_process=False):
+        super().__init__()
+        self.with_process = with_process
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if self.with_process:
+            entry["process"] = record.processName
+        room = getattr(record, "room", None)
+        if room is not None:
+            entry["room"] = room
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level="INFO", fmt="text", stream=None, with_process=False):
+    # 房間 thread 與 event loop 只把紀錄放進 queue，格式化與寫出由背景 listener thread 負責
+    # 低於 level 的紀錄在呼叫端就被略過，不會組字串
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter(with_process))
+    else:
+        handler.setFormatter(
+            logging.Formatter(CLUSTER_TEXT_FORMAT if with_process else TEXT_FORMAT)
+        )
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger(LOGGER_NAME)
+    root.setLevel(level)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.propagate = False
+    listener.start()
+    return listener
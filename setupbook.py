@@ -0,0 +1,138 @@
+import argparse
+import hashlib
+import inspect
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+import batchsim
+import engine
+from analytics import ROTATE_SETUP1, setup_diagram
+from common import openings
+from common.openings import SETUPS, SetupBook
+from gamelog import good_squares
+from policies import load_policy
+from selfplay import game_rng, play_game
+
+# 每個 process 一次處理的佈局組合數
+CHUNK_CELLS = 70
+# 每一輪每組佈局補上的局數，每輪結束都存檔，中斷後重跑會從存檔接著算
+ROUND_GAMES = 20
+
+
+def fingerprint(p1, p2, max_plies):
+    # 結果取決於雙方策略與規則：策略名稱加上策略、引擎與批次模擬原始碼的 hash，任一項改變時開局庫要重新計算
+    digest = hashlib.sha1()
+    modules = {engine.__name__: engine, batchsim.__name__: batchsim}
+    for spec in (p1, p2):
+        module = sys.modules[type(load_policy(spec)).__module__]
+        modules[module.__name__] = module
+    for name in sorted(modules):
+        digest.update(inspect.getsource(modules[name]).encode("utf-8"))
+    return f"{p1} vs {p2} max_plies={max_plies} {digest.hexdigest()[:16]}"
+
+
+def run_cells(task):
+    # worker：cells 為 [(佈局組合編號, 起始局號, 局數)]，回傳 [(編號, 局數, 玩家 1 勝場, 玩家 2 勝場)]
+    p1, p2, seed, cells, max_plies = task
+    if p1 == p2 == "random":
+        return _run_batch(seed, cells, max_plies)
+    policies = {1: load_policy(p1), 2: load_policy(p2)}
+    results = []
+    for cell, start, count in cells:
+        index1, index2 = divmod(cell, len(SETUPS))
+        setups = {1: good_squares(1, SETUPS[index1]), 2: good_squares(2, SETUPS[index2])}
+        wins = [0, 0, 0]
+        for k in range(start, start + count):
+            rng = game_rng(seed, cell << 32 | k)
+            winner = play_game(policies, rng, max_plies, setups)[0]
+            wins[winner or 0] += 1
+        results.append((cell, count, wins[1], wins[2]))
+    return results
+
+
+def _run_batch(seed, cells, max_plies):
+    # 雙方都是隨機策略時改用 numpy 批次模擬，整個 chunk 的對局同時進行
+    ids = np.array([cell for cell, _, count in cells for _ in range(count)])
+    if not len(ids):
+        return []
+    first_cell, first_start = cells[0][0], cells[0][1]
+    sim = batchsim.BatchSimulator(len(ids), (seed, first_cell, first_start), max_plies)
+    setup_bytes = np.array(SETUPS)
+    index1, index2 = np.divmod(ids, len(SETUPS))
+    sim.reset(np.arange(len(ids)), np.stack([setup_bytes[index1], setup_bytes[index2]], axis=1))
+    while sim.active.any():
+        sim.step()
+    size = len(SETUPS) ** 2
+    games = np.bincount(ids, minlength=size)
+    wins1 = np.bincount(ids, weights=sim.winner == 1, minlength=size)
+    wins2 = np.bincount(ids, weights=sim.winner == 2, minlength=size)
+    return [
+        (cell, count, int(wins1[cell]), int(wins2[cell])) for cell, _, count in cells if games[cell]
+    ]
+
+
+def build(path, p1, p2, games, seed=0, processes=None, max_plies=400, on_round=None):
+    # 把每組佈局補到 games 局：策略或規則改變時從頭計算，否則只補不足的局數
+    # 以輪為單位平均補齊所有組合，每輪存檔一次
+    key = fingerprint(p1, p2, max_plies)
+    book = openings.load_default(path) if os.path.exists(path) else None
+    if book is None or book.fingerprint != key:
+        book = SetupBook(key)
+    size = len(SETUPS) ** 2
+    with Pool(processes) as pool:
+        while True:
+            counts = [book.cells[3 * cell] for cell in range(size)]
+            low = min(counts)
+            if low >= games:
+                break
+            target = min(games, low + ROUND_GAMES)
+            cells = [(cell, counts[cell], target - counts[cell]) for cell in range(size)]
+            cells = [item for item in cells if item[2] > 0]
+            tasks = [
+                (p1, p2, seed, cells[i : i + CHUNK_CELLS], max_plies)
+                for i in range(0, len(cells), CHUNK_CELLS)
+            ]
+            for results in pool.imap_unordered(run_cells, tasks):
+                for cell, count, wins1, wins2 in results:
+                    book.add(*divmod(cell, len(SETUPS)), count, wins1, wins2)
+            book.save(path)
+            if on_round:
+                on_round(book, target)
+    return book
+
+
+def main():
+    parser = argparse.ArgumentParser(description="產生佈局開局庫 (70x70 佈局對戰結果)")
+    parser.add_argument("--book", default=openings.DEFAULT_PATH, help="開局庫檔案")
+    parser.add_argument("--games", type=int, default=200, help="每組佈局的模擬局數")
+    parser.add_argument("--p1", default="random", help="玩家 1 策略 (名稱或 module:ClassName)")
+    parser.add_argument("--p2", default="random", help="玩家 2 策略 (名稱或 module:ClassName)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--max-plies", type=int, default=400, help="超過此步數視為和局")
+    parser.add_argument("--top", type=int, default=10, help="列出雙方得分率最高的幾種佈局")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    def progress(book, target):
+        elapsed = time.perf_counter() - start
+        print(f"每組 {target}/{args.games} 局  {elapsed:.1f}s", flush=True)
+
+    book = build(
+        args.book, args.p1, args.p2, args.games, args.seed, args.processes, args.max_plies, progress
+    )
+    print(f"開局庫：{args.book} ({book.fingerprint})")
+    for player_id in (1, 2):
+        print(f"玩家 {player_id} 得分率最高的佈局 (自己的視角，前排/後排)：")
+        for setup, rate, count in book.win_rates(player_id)[: args.top]:
+            own_view = int(ROTATE_SETUP1[setup]) if player_id == 1 else setup
+            print(f"  {setup_diagram(own_view)}  {rate:.3f}  ({count} 局)")
+
+
+if __name__ == "__main__":
+    main()
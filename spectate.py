@@ -0,0 +1,280 @@
+import queue
+import selectors
+import socket
+import threading
+
+import metrics
+from common import framing
+from server_log import get_logger
+
+log = get_logger("spectate")
+
+
+class Watcher:
+    # 一位觀戰者：記錄已送出的狀態序號，同一時間最多只有一個 frame 等著送出
+    __slots__ = ("conn", "audience", "greeting", "sent", "out", "closing", "writing", "reader")
+
+    def __init__(self, conn, audience, greeting):
+        self.conn = conn
+        self.audience = audience
+        self.greeting = greeting  # 加入時的問候訊息 (每位觀戰者各自編碼，只有一次)
+        self.sent = 0  # 已開始送出的最新狀態序號
+        self.out = None  # thread 模式：還沒送完的 frame (memoryview)
+        self.closing = False  # 已排入對局結束訊息，送完即關閉
+        self.writing = False  # thread 模式：是否正在等待可寫
+        self.reader = framing.server_reader()
+
+    def next_frame(self):
+        # 下一個要送出的 frame：先送問候，之後只送最新狀態 (中間的狀態直接略過)，對局結束時送結束訊息
+        if self.greeting is not None:
+            frame, self.greeting = self.greeting, None
+            return frame
+        audience = self.audience
+        with audience.lock:
+            if self.sent < audience.seq and audience.latest is not None:
+                self.sent = audience.seq
+                return audience.latest
+            if audience.final is not None and not self.closing:
+                self.closing = True
+                return audience.final
+        return None
+
+
+class Audience:
+    # 一個房間的觀戰者：房間每次狀態改變只編碼一次觀戰者視角的完整狀態，所有觀戰者共用同一份 bytes
+    # 每則狀態都是完整快照，送得慢的觀戰者跳過中間的狀態直接收最新的一則，不拖慢玩家也不累積緩衝
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watchers = set()
+        self.seq = 0  # 最新狀態的序號
+        self.latest = None  # 最新狀態的 frame，沒有觀戰者時不保留
+        self.final = None  # 對局結束的 frame
+        self.hub = None
+
+    def __len__(self):
+        return len(self.watchers)
+
+    def add(self, watcher, hub):
+        with self.lock:
+            self.watchers.add(watcher)
+            self.hub = hub
+
+    def discard(self, watcher):
+        with self.lock:
+            self.watchers.discard(watcher)
+
+    def members(self):
+        with self.lock:
+            return list(self.watchers)
+
+    def publish(self, frame):
+        # 房間呼叫：換上最新狀態並通知 hub 送出，本身不做任何網路 I/O
+        # 沒有觀戰者時丟掉舊的狀態，之後有人加入時由房間重新編碼目前的狀態
+        with self.lock:
+            self.seq += 1
+            self.latest = frame if self.watchers else None
+            hub = self.hub if self.watchers else None
+        if hub is not None:
+            hub.notify(self)
+
+    def close(self, frame):
+        # 對局結束：送完結束訊息後關閉所有觀戰者的連線
+        with self.lock:
+            self.final = frame
+            hub = self.hub if self.watchers else None
+        if hub is not None:
+            hub.notify(self)
+
+
+def pick_room(rooms, room_id):
+    # 要觀戰的房間：room_id 為 None 時挑觀戰人數最多的房間 (人數相同時挑最新的)
+    if room_id is None:
+        return max(rooms.values(), key=lambda room: (len(room.audience), room.id), default=None)
+    if isinstance(room_id, int):
+        return rooms.get(room_id)
+    return None
+
+
+class SpectatorHub:
+    # thread 模式：單一 thread 以 selector 對所有觀戰者做 non-blocking 送出
+    # 房間只通知哪個 Audience 有新狀態，送不出去的連線等可寫時再送最新狀態，房間 thread 從不等待觀戰者
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.inbox = queue.SimpleQueue()  # 新加入的 Watcher
+        self.dirty = set()  # 有新狀態的 Audience
+        self.dirty_lock = threading.Lock()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.running = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread:
+            self.thread.join(timeout=1.0)
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, Watcher):
+                self.remove(key.data)
+
+    def attach(self, audience, conn, greeting):
+        # 房間呼叫 (持有房間的 lock)：立刻算入觀戰人數，連線由 hub thread 接手
+        watcher = Watcher(conn, audience, greeting)
+        audience.add(watcher, self)
+        self.inbox.put(watcher)
+        self.wake()
+
+    def notify(self, audience):
+        with self.dirty_lock:
+            self.dirty.add(audience)
+        self.wake()
+
+    def wake(self):
+        # 緩衝區已滿代表 hub thread 本來就會醒來
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select():
+                if key.data is None:
+                    self.drain()
+                    continue
+                watcher = key.data
+                if events & selectors.EVENT_READ and not self.on_readable(watcher):
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self.pump(watcher)
+
+    def drain(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while True:
+            try:
+                watcher = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                watcher.conn.setblocking(False)
+                self.selector.register(watcher.conn, selectors.EVENT_READ, watcher)
+            except (OSError, ValueError):
+                watcher.audience.discard(watcher)
+                watcher.conn.close()
+                continue
+            self.pump(watcher)
+        with self.dirty_lock:
+            dirty, self.dirty = self.dirty, set()
+        for audience in dirty:
+            for watcher in audience.members():
+                # 還在等可寫的觀戰者等輪到時自然會拿到最新狀態
+                if not watcher.writing:
+                    self.pump(watcher)
+
+    def on_readable(self, watcher):
+        # 觀戰者送來的訊息一律忽略，只用來偵測離線與套用連線限制；回傳連線是否仍有效
+        try:
+            frames = watcher.reader.recv(watcher.conn)
+        except BlockingIOError:
+            return True
+        except (framing.FrameError, OSError):
+            frames = None
+        if frames is None:
+            self.remove(watcher)
+            return False
+        return True
+
+    def pump(self, watcher):
+        # 盡量送出，送不完時改等可寫；結束訊息送完後關閉連線
+        conn = watcher.conn
+        while True:
+            if watcher.out is None:
+                frame = watcher.next_frame()
+                if frame is None:
+                    if watcher.closing:
+                        self.remove(watcher)
+                    else:
+                        self.want_write(watcher, False)
+                    return
+                watcher.out = memoryview(frame)
+                metrics.MESSAGES_OUT.inc()
+            try:
+                sent = conn.send(watcher.out)
+            except BlockingIOError:
+                self.want_write(watcher, True)
+                return
+            except OSError:
+                self.remove(watcher)
+                return
+            metrics.BYTES_OUT.inc(sent)
+            watcher.out = watcher.out[sent:] or None
+
+    def want_write(self, watcher, writing):
+        if watcher.writing == writing:
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+        try:
+            self.selector.modify(watcher.conn, events, watcher)
+        except (KeyError, ValueError, OSError):
+            return
+        watcher.writing = writing
+
+    def remove(self, watcher):
+        watcher.audience.discard(watcher)
+        try:
+            self.selector.unregister(watcher.conn)
+        except (KeyError, ValueError):
+            pass
+        try:
+            watcher.conn.close()
+        except OSError:
+            pass
+
+
+class AsyncSpectatorHub:
+    # asyncio 模式：觀戰者是 PlayerProtocol，直接寫入 transport；
+    # 寫入緩衝超過上限 (pause_writing) 時先不送，恢復 (resume_writing) 後直接送最新狀態
+    def __init__(self, loop):
+        self.loop = loop
+        self.dirty = set()
+        self.scheduled = False
+
+    def attach(self, audience, conn, greeting):
+        watcher = Watcher(conn, audience, greeting)
+        conn.watcher = watcher
+        audience.add(watcher, self)
+        self.pump(watcher)
+
+    def notify(self, audience):
+        # 等 event loop 處理完這一輪玩家訊息後再分送
+        self.loop.call_soon_threadsafe(self.flush, audience)
+
+    def flush(self, audience):
+        for watcher in audience.members():
+            self.pump(watcher)
+
+    def pump(self, watcher):
+        conn = watcher.conn
+        while not conn.paused and not conn.transport.is_closing():
+            frame = watcher.next_frame()
+            if frame is None:
+                break
+            conn.transport.write(frame)
+            metrics.MESSAGES_OUT.inc()
+            metrics.BYTES_OUT.inc(len(frame))
+        if watcher.closing and not conn.transport.is_closing():
+            # transport.close 會先送完緩衝區內的結束訊息
+            conn.close()
+
+    def detach(self, watcher):
+        watcher.audience.discard(watcher)
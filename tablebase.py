@@ -0,0 +1,353 @@
+import argparse
+import mmap
+import os
+import struct
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from bitboard import ESCAPE_MASK, NEIGHBOR_SQUARES, NUM_SQUARES, iter_squares
+
+# 殘局庫：盤面上剩不超過 K 顆棋子、雙方鬼的身分都已知時，每個局面的完美對弈結果
+# 依雙方剩下的好鬼/壞鬼數 (g1, b1, g2, b2) 分類，每類一個 uint8 陣列，索引為
+#   (輪到的玩家 - 1) * 36^n + 各棋子格子編號組成的 36 進位數
+# 棋子依 P1 好鬼、P1 壞鬼、P2 好鬼、P2 壞鬼排列 (同種棋子不分先後，每種排列都有同樣的值)
+# 值：0 為和局 (或不可能出現的局面)，1~127 為輪到的一方 n 步內獲勝，LOSS | n 為 n 步後落敗
+LOSS = 0x80
+MAX_DISTANCE = 0x7F  # 超過這個步數才分出勝負的局面記為和局
+MAX_PIECES = 5  # 6 顆以上的陣列太大 (36^6 * 2 bytes 一類)
+DEFAULT_PIECES = 4
+
+# 檔案格式：標頭 (magic, 版本, K, 類別數)，每類 (g1, b1, g2, b2, 資料起點)，之後接各類的陣列
+TB_MAGIC = b"GTB1"
+TB_VERSION = 1
+_HEADER = struct.Struct(">4sBBB")
+_CLASS = struct.Struct(">4BQ")
+
+# 產生時每次向量運算處理的局面數，記憶體用量與 K 無關
+CHUNK = 1 << 20
+
+_OFF = NUM_SQUARES  # 棋盤外，當作第 37 個格子讓查表不用另外判斷
+# _NEIGHBOR[sq, d]：sq 往 4 個方向的相鄰格，出界為 _OFF
+_NEIGHBOR = np.full((NUM_SQUARES + 1, 4), _OFF, np.int64)
+for _sq, _near in enumerate(NEIGHBOR_SQUARES):
+    _NEIGHBOR[_sq, : len(_near)] = _near
+# _ESCAPE[pid][sq]：sq 是否為 pid 的逃脫點
+_ESCAPE = np.zeros((3, NUM_SQUARES + 1), bool)
+for _pid in (1, 2):
+    for _sq in iter_squares(ESCAPE_MASK[_pid]):
+        _ESCAPE[_pid, _sq] = True
+
+
+def material_classes(max_pieces):
+    # 總棋子數 4~max_pieces 的所有類別 (每種鬼至少 1 顆，否則遊戲已結束)，依棋子數分組
+    groups = {}
+    for counts in np.ndindex(4, 4, 4, 4):
+        counts = tuple(c + 1 for c in counts)
+        if sum(counts) <= max_pieces:
+            groups.setdefault(sum(counts), []).append(counts)
+    return [groups[n] for n in sorted(groups)]
+
+
+def _pieces(counts):
+    # 類別中每顆棋子的 (owner, 是否為好鬼)，順序同索引
+    g1, b1, g2, b2 = counts
+    return [(1, True)] * g1 + [(1, False)] * b1 + [(2, True)] * g2 + [(2, False)] * b2
+
+
+def _decode(local, n):
+    # 局面索引 (不含輪到誰) -> 每顆棋子的格子，shape (n, len(local))
+    squares = np.empty((n, len(local)), np.int64)
+    rest = local
+    for i in range(n - 1, -1, -1):
+        rest, squares[i] = np.divmod(rest, NUM_SQUARES)
+    return squares
+
+
+def _valid(squares, pieces):
+    # 棋子不重疊，且好鬼不在自己的逃脫點 (走到那裡就已經獲勝)
+    ok = np.ones(squares.shape[1], bool)
+    for i, (owner, good) in enumerate(pieces):
+        for j in range(i):
+            ok &= squares[i] != squares[j]
+        if good:
+            ok &= ~_ESCAPE[owner, squares[i]]
+    return ok
+
+
+def _capture_index(counts, pieces, squares, mover, i, dest, j):
+    # 棋子 i 走到 dest 吃掉 j 之後的局面在較小類別中的索引 (輪到對手)
+    smaller = list(counts)
+    smaller[(2 if pieces[j][0] == 2 else 0) + (0 if pieces[j][1] else 1)] -= 1
+    index = np.full(len(dest), 2 - mover, np.int64)  # 輪到 3 - mover
+    for k in range(len(pieces)):
+        if k != j:
+            index = index * NUM_SQUARES + (dest if k == i else squares[k])
+    return tuple(smaller), index
+
+
+def _init_chunk(counts, pieces, smaller, mover, local):
+    # 逐一檢查 mover 的每一步：直接分出勝負的、吃子後進入較小類別的 (查表)、留在本類別的 (待解)
+    # 回傳 (初始值, 待解的步數, 最差的吃子結果)；最差結果為 255 表示有吃子後和局的步，不可能落敗
+    n = len(pieces)
+    squares = _decode(local, n)
+    ok_position = _valid(squares, pieces)
+    size = len(local)
+    win_now = np.zeros(size, bool)
+    capture_win = np.zeros(size, np.int64)  # 吃子後最快獲勝的步數，0 表示沒有
+    capture_draw = np.zeros(size, bool)
+    loss_max = np.zeros(size, np.int64)  # 所有會輸的步中最慢落敗的步數
+    pending = np.zeros(size, np.int8)
+    has_move = np.zeros(size, bool)
+    own = [k for k, piece in enumerate(pieces) if piece[0] == mover]
+    opp = [k for k, piece in enumerate(pieces) if piece[0] != mover]
+    opp_good = sum(1 for k in opp if pieces[k][1])
+    opp_bad = len(opp) - opp_good
+    for i in own:
+        good = pieces[i][1]
+        for d in range(4):
+            dest = _NEIGHBOR[squares[i], d]
+            ok = ok_position & (dest != _OFF)
+            for k in own:
+                if k != i:
+                    ok &= dest != squares[k]
+            has_move |= ok
+            quiet = ok.copy()
+            escape = _ESCAPE[mover, dest] if good else np.zeros(size, bool)
+            for j in opp:
+                hit = ok & (dest == squares[j])
+                if not hit.any():
+                    continue
+                quiet &= ~hit
+                # 勝負判斷順序同 GameState._check_win：吃光好鬼 > 吃光壞鬼 (對手勝) > 逃脫
+                if pieces[j][1] and opp_good == 1:
+                    win_now |= hit
+                    continue
+                if not pieces[j][1] and opp_bad == 1:
+                    loss_max[hit] = np.maximum(loss_max[hit], 1)
+                    continue
+                win_now |= hit & escape
+                hit &= ~escape
+                key, index = _capture_index(counts, pieces, squares[:, hit], mover, i, dest[hit], j)
+                value = smaller[key][index].astype(np.int64)
+                distance = (value & MAX_DISTANCE) + 1
+                where = np.flatnonzero(hit)
+                draw = (value == 0) | (distance > MAX_DISTANCE)
+                capture_draw[where[draw]] = True
+                lost = ~draw & (value & LOSS == LOSS)  # 對手落敗 -> 我方獲勝
+                at = where[lost]
+                capture_win[at] = np.where(
+                    capture_win[at] > 0, np.minimum(capture_win[at], distance[lost]), distance[lost]
+                )
+                won = ~draw & (value & LOSS == 0)
+                at = where[won]
+                loss_max[at] = np.maximum(loss_max[at], distance[won])
+            win_now |= quiet & escape
+            pending += quiet & ~escape
+    values = np.zeros(size, np.uint8)
+    values[capture_win > 0] = capture_win[capture_win > 0]
+    values[win_now] = 1
+    lost = (values == 0) & (pending == 0) & has_move & ~capture_draw
+    values[lost] = LOSS | loss_max[lost]
+    worst = np.where(capture_draw, 255, loss_max).astype(np.uint8)
+    return values, pending, worst
+
+
+def _predecessors(pieces, side, local, n_positions):
+    # 輪到 side 的局面 (local 為本側索引) 的所有前一手局面：對手的某顆棋子從相鄰空格走過來
+    # 回傳 (frontier 中的位置, 前一手局面的完整索引)
+    n = len(pieces)
+    squares = _decode(local, n)
+    mover = 3 - side
+    base = (mover - 1) * n_positions + local
+    positions, indexes = [], []
+    for i, (owner, good) in enumerate(pieces):
+        if owner != mover:
+            continue
+        weight = NUM_SQUARES ** (n - 1 - i)
+        for d in range(4):
+            prev = _NEIGHBOR[squares[i], d]
+            ok = prev != _OFF
+            for k in range(n):
+                ok &= prev != squares[k]
+            if good:
+                # 好鬼走進逃脫點會直接獲勝，不會留在盤面上；好鬼也不會停在自己的逃脫點
+                ok &= ~_ESCAPE[mover, squares[i]] & ~_ESCAPE[mover, prev]
+            at = np.flatnonzero(ok)
+            positions.append(at)
+            indexes.append(base[at] + (prev[at] - squares[i][at]) * weight)
+    return np.concatenate(positions), np.concatenate(indexes)
+
+
+def solve_class(counts, smaller_paths):
+    # 退步分析：先找出一步內分出勝負或吃子後查得到結果的局面，再從距離 1 開始一層層往回推
+    # 輸掉的局面的前一手為獲勝；獲勝局面的前一手少一個待解步，全部都輸時即為落敗
+    pieces = _pieces(counts)
+    n = len(pieces)
+    n_positions = NUM_SQUARES**n
+    smaller = {key: np.memmap(path, np.uint8, "r") for key, path in smaller_paths.items()}
+    values = np.zeros(2 * n_positions, np.uint8)
+    pending = np.zeros(2 * n_positions, np.int8)
+    worst = np.zeros(2 * n_positions, np.uint8)
+    for side in (1, 2):
+        for start in range(0, n_positions, CHUNK):
+            local = np.arange(start, min(start + CHUNK, n_positions), dtype=np.int64)
+            offset = (side - 1) * n_positions + start
+            chunk = slice(offset, offset + len(local))
+            values[chunk], pending[chunk], worst[chunk] = _init_chunk(
+                counts, pieces, smaller, side, local
+            )
+    distances = values & MAX_DISTANCE
+    for level in range(1, MAX_DISTANCE + 1):
+        frontier = np.flatnonzero(distances == level)
+        if not frontier.size and not (distances > level).any():
+            break
+        for start in range(0, len(frontier), CHUNK):
+            part = frontier[start : start + CHUNK]
+            for side in (1, 2):
+                at = part[(part >= n_positions) == (side == 2)]
+                local = at - (side - 1) * n_positions
+                where, preds = _predecessors(pieces, side, local, n_positions)
+                lost = values[at[where]] & LOSS == LOSS
+                # 對手輸掉的局面：前一手直接獲勝 (比吃子得到的勝利更快時改寫)
+                wins = preds[lost]
+                current = values[wins]
+                better = (current == 0) | ((current & LOSS == 0) & (current > level + 1))
+                wins = wins[better]
+                values[wins] = level + 1
+                distances[wins] = level + 1
+                # 對手獲勝的局面：前一手少一個待解步
+                losses = preds[~lost]
+                np.subtract.at(pending, losses, 1)
+                losses = np.unique(losses)
+                done = (pending[losses] == 0) & (values[losses] == 0) & (worst[losses] != 255)
+                losses = losses[done]
+                distance = np.maximum(worst[losses], level + 1)
+                keep = distance <= MAX_DISTANCE
+                losses, distance = losses[keep], distance[keep]
+                values[losses] = LOSS | distance
+                distances[losses] = distance
+    return values
+
+
+def _solve_job(job):
+    counts, smaller_paths, path = job
+    started = time.perf_counter()
+    values = solve_class(counts, smaller_paths)
+    values.tofile(path)
+    wins = int(np.count_nonzero(values & LOSS == 0) - np.count_nonzero(values == 0))
+    losses = int(np.count_nonzero(values & LOSS))
+    return counts, wins, losses, time.perf_counter() - started
+
+
+def generate(path, max_pieces=DEFAULT_PIECES, processes=None):
+    # 由少到多逐層產生，同一層 (棋子數相同) 的類別互不依賴，交給多個 process 同時計算
+    # 每類先寫成暫存檔讓下一層以 memmap 查詢，最後合併成單一檔案
+    if not 4 <= max_pieces <= MAX_PIECES:
+        raise ValueError(f"K 必須介於 4 與 {MAX_PIECES} 之間")
+    parts = {}
+    try:
+        with Pool(processes) as pool:
+            for group in material_classes(max_pieces):
+                jobs = []
+                for counts in group:
+                    parts[counts] = f"{path}.{''.join(map(str, counts))}.part"
+                    needed = {}
+                    for t in range(4):
+                        key = counts[:t] + (counts[t] - 1,) + counts[t + 1 :]
+                        if key in parts:
+                            needed[key] = parts[key]
+                    jobs.append((counts, needed, parts[counts]))
+                for counts, wins, losses, elapsed in pool.imap_unordered(_solve_job, jobs):
+                    print(f"{counts}: 勝 {wins} 負 {losses} 局面，{elapsed:.1f} 秒", flush=True)
+        classes = sorted(parts)
+        offset = _HEADER.size + _CLASS.size * len(classes)
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(TB_MAGIC, TB_VERSION, max_pieces, len(classes)))
+            for counts in classes:
+                f.write(_CLASS.pack(*counts, offset))
+                offset += 2 * NUM_SQUARES ** sum(counts)
+            for counts in classes:
+                with open(parts[counts], "rb") as part:
+                    while True:
+                        block = part.read(1 << 24)
+                        if not block:
+                            break
+                        f.write(block)
+    finally:
+        for part in parts.values():
+            if os.path.exists(part):
+                os.remove(part)
+
+
+class Tablebase:
+    # 以 mmap 讀取殘局庫，查詢一個局面只需算出索引讀 1 byte，不搜尋
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.max_pieces, count = _HEADER.unpack_from(self.data)
+        if magic != TB_MAGIC or version != TB_VERSION:
+            raise ValueError(f"{path} 不是殘局庫檔案")
+        self.offsets = {}
+        for i in range(count):
+            g1, b1, g2, b2, offset = _CLASS.unpack_from(self.data, _HEADER.size + _CLASS.size * i)
+            self.offsets[(g1, b1, g2, b2)] = offset
+
+    def close(self):
+        self.data.close()
+
+    def probe(self, game):
+        # 輪到的一方的 (結果, 步數)：結果 1 勝 / 0 和 / -1 負；不在殘局庫範圍內回傳 None
+        bb = game.bb
+        masks = (bb.good[1], bb.bad[1], bb.good[2], bb.bad[2])
+        offset = self.offsets.get(tuple(mask.bit_count() for mask in masks))
+        if offset is None or game.winner is not None:
+            return None
+        index = game.turn - 1
+        for mask in masks:
+            for sq in iter_squares(mask):
+                index = index * NUM_SQUARES + sq
+        value = self.data[offset + index]
+        if not value:
+            return 0, 0
+        if value & LOSS:
+            return -1, value & MAX_DISTANCE
+        return 1, value
+
+    def best_move(self, game):
+        # 完美對弈的一步 (最快獲勝 > 和局 > 最慢落敗)；不在殘局庫範圍內回傳 None
+        if self.probe(game) is None:
+            return None
+        player = game.turn
+        best, best_score = None, None
+        for move in game.legal_moves():
+            game.push(*move)
+            if game.winner is not None:
+                score = (2, 0) if game.winner == player else (-2, 0)
+            else:
+                result, distance = self.probe(game)
+                # 對手的結果反過來；獲勝越快越好，落敗越慢越好
+                score = (-result, distance if result > 0 else -distance)
+            game.undo()
+            if best_score is None or score > best_score:
+                best, best_score = move, score
+        return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="產生殘局庫 (退步分析)")
+    parser.add_argument("path", help="輸出檔案")
+    parser.add_argument(
+        "--pieces", type=int, default=DEFAULT_PIECES, help=f"棋子總數上限 K (4~{MAX_PIECES})"
+    )
+    parser.add_argument("--processes", type=int, default=None, help="預設為 CPU 核心數")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    generate(args.path, args.pieces, args.processes)
+    size = os.path.getsize(args.path)
+    print(f"完成：{args.path} ({size / 1e6:.1f} MB)，{time.perf_counter() - started:.1f} 秒")
+
+
+if __name__ == "__main__":
+    main()
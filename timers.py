@@ -0,0 +1,178 @@
+import threading
+import time
+
+import metrics
+from server_log import get_logger
+
+log = get_logger("timers")
+
+# 時間輪的最小刻度 (秒)：計時器最多晚這麼久觸發，不會提早
+TICK = 0.1
+# 每層 2**SLOT_BITS 格，共 LEVELS 層；第 k 層的一格涵蓋第 k-1 層轉一整圈 (4 層約可排 13 年)
+SLOT_BITS = 8
+LEVELS = 4
+
+
+class Timer:
+    # schedule 回傳的計時器；slot 為目前所在的格子 (觸發或取消後為 None)
+    __slots__ = ("expires", "callback", "args", "slot")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires  # 到期的刻度
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+
+class TimerWheel:
+    # 階層式時間輪 (hashed hierarchical timing wheel)：加入與取消都是 O(1)，
+    # 每個刻度只處理第 0 層的一格，第 0 層轉完一圈時才把上一層對應格子內的計時器往下搬
+    # 每格是 dict (當作有序的 set)，取消只需從所在的 dict 移除；不是 thread-safe
+    def __init__(self, now=0.0, tick=TICK, bits=SLOT_BITS, levels=LEVELS):
+        self.origin = now
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = [[{} for _ in range(1 << bits)] for _ in range(levels)]
+        self.current = 0  # 已處理到的刻度
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, callback, *args):
+        # 在 deadline (與建立時傳入的 now 同一個時鐘) 之後的第一個刻度呼叫 callback(*args)
+        expires = -int(-(deadline - self.origin) // self.tick)
+        timer = Timer(max(expires, self.current + 1), callback, args)
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        # 已觸發或已取消的計時器直接忽略
+        slot = timer.slot
+        if slot is not None:
+            del slot[timer]
+            timer.slot = None
+            self.count -= 1
+
+    def advance(self, now):
+        # 推進到 now，回傳這段期間到期的計時器 (依刻度先後)，由呼叫端執行 callback
+        target = int((now - self.origin) // self.tick)
+        due = []
+        while self.current < target:
+            if not self.count:
+                # 沒有計時器時直接跳過空轉的刻度
+                self.current = target
+                break
+            self.current += 1
+            index = self.current & self.mask
+            if index == 0:
+                self._cascade(1)
+            slot = self.levels[0][index]
+            if slot:
+                for timer in slot:
+                    timer.slot = None
+                due.extend(slot)
+                self.count -= len(slot)
+                slot.clear()
+        return due
+
+    def _insert(self, timer):
+        delta = timer.expires - self.current
+        top = len(self.levels) - 1
+        for level in range(top + 1):
+            if delta < 1 << (self.bits * (level + 1)) or level == top:
+                break
+        if level == top:
+            # 超出最上層範圍的計時器先放在最上層，搬下來時會再放回最上層直到範圍內
+            delta = min(delta, (1 << (self.bits * (level + 1))) - 1)
+        index = ((self.current + delta) >> (self.bits * level)) & self.mask
+        slot = self.levels[level][index]
+        slot[timer] = None
+        timer.slot = slot
+
+    def _cascade(self, level):
+        # 把第 level 層目前這一格的計時器重新放到較低的層 (上一層也轉完一圈時一併往下搬)
+        if level >= len(self.levels):
+            return
+        index = (self.current >> (self.bits * level)) & self.mask
+        if index == 0:
+            self._cascade(level + 1)
+        slot = self.levels[level][index]
+        if not slot:
+            return
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._insert(timer)
+
+
+# 全 process 共用的時間輪與驅動它的 thread：回合時限、心跳與閒置連線都排在這裡，不各自開 thread 或 sleep
+_wheel = None
+_lock = threading.Lock()
+_thread = None
+_stopping = None
+_dispatch = None
+
+
+def start(dispatch=None):
+    # dispatch(callback, *args)：在其他 thread 執行到期的 callback (例如 loop.call_soon_threadsafe)
+    # 未指定時直接在時間輪的 thread 執行，callback 應該很快結束
+    global _wheel, _thread, _stopping, _dispatch
+    if _thread is not None:
+        return
+    _wheel = TimerWheel(time.monotonic())
+    _dispatch = dispatch
+    _stopping = threading.Event()
+    _thread = threading.Thread(target=_run, args=(_stopping,), daemon=True)
+    _thread.start()
+    metrics.PENDING_TIMERS.set_function(pending)
+
+
+def stop():
+    global _wheel, _thread, _dispatch
+    if _thread is None:
+        return
+    _stopping.set()
+    _thread.join(timeout=1.0)
+    _wheel = _thread = _dispatch = None
+
+
+def schedule(delay, callback, *args):
+    # delay 秒後呼叫 callback(*args)，回傳可傳給 cancel 的 Timer；時間輪未啟動時回傳 None
+    # 取消與觸發可能同時發生，callback 需自行確認狀態是否仍有效
+    with _lock:
+        if _wheel is None:
+            return None
+        return _wheel.schedule(time.monotonic() + delay, callback, *args)
+
+
+def cancel(timer):
+    if timer is None:
+        return
+    with _lock:
+        if _wheel is not None:
+            _wheel.cancel(timer)
+
+
+def pending():
+    # 目前排定的計時器數 (metrics 用)
+    with _lock:
+        return len(_wheel) if _wheel is not None else 0
+
+
+def _run(stopping):
+    while not stopping.wait(TICK):
+        with _lock:
+            if _wheel is None:
+                return
+            due = _wheel.advance(time.monotonic())
+        for timer in due:
+            try:
+                if _dispatch is not None:
+                    _dispatch(timer.callback, *timer.args)
+                else:
+                    timer.callback(*timer.args)
+            except Exception:
+                log.exception("計時器 callback 發生錯誤")
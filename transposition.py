@@ -0,0 +1,88 @@
+from array import array
+
+# 預設 2^16 格
+DEFAULT_BITS = 16
+
+
+class TranspositionTable:
+    # 固定大小的置換表：key (Zobrist hash) 的低位元決定位置，每兩格一組 (2-way)，記憶體用量固定
+    # key/權重/世代放在 array 中，值 (任意物件) 放在等長的 list
+    # 寫入時的取代順序：同一個 key > 空格 > 上一輪搜尋留下的 > 權重較低且不高於新資料的；
+    # 兩格都是本輪且權重較高時放棄寫入
+    def __init__(self, bits=DEFAULT_BITS):
+        size = 1 << bits
+        self.size = size
+        self.mask = (size - 1) & ~1
+        self.keys = array("Q", bytes(8 * size))
+        self.weights = array("i", bytes(4 * size))
+        self.ages = array("I", bytes(4 * size))  # 寫入時的世代，0 表示空格
+        self.values = [None] * size
+        self.generation = 1
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+        self.rejections = 0
+
+    def new_search(self):
+        # 開始新一輪搜尋 (例如下一步)：舊資料仍可命中，但會優先被取代
+        self.generation += 1
+
+    def get(self, key, default=None):
+        slot = key & self.mask
+        keys = self.keys
+        ages = self.ages
+        if ages[slot] and keys[slot] == key:
+            self.hits += 1
+            return self.values[slot]
+        slot += 1
+        if ages[slot] and keys[slot] == key:
+            self.hits += 1
+            return self.values[slot]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, weight=0):
+        # 寫入成功回傳 True；權重越高越不容易被取代 (例如較淺的節點、較多的模擬次數)
+        first = key & self.mask
+        ages = self.ages
+        for slot in (first, first + 1):
+            if ages[slot] and self.keys[slot] == key:
+                self._write(slot, key, value, weight)
+                return True
+        for slot in (first, first + 1):
+            if not ages[slot]:
+                self.used += 1
+                self._write(slot, key, value, weight)
+                return True
+        victim = min(
+            (first, first + 1), key=lambda s: (ages[s] == self.generation, self.weights[s])
+        )
+        if ages[victim] == self.generation and self.weights[victim] > weight:
+            self.rejections += 1
+            return False
+        self.replacements += 1
+        self._write(victim, key, value, weight)
+        return True
+
+    def _write(self, slot, key, value, weight):
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.weights[slot] = weight
+        self.ages[slot] = self.generation
+        self.stores += 1
+
+    def stats(self):
+        # 命中率與使用量
+        lookups = self.hits + self.misses
+        return {
+            "size": self.size,
+            "used": self.used,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "replacements": self.replacements,
+            "rejections": self.rejections,
+        }
@@ -0,0 +1,37 @@
+import random
+
+from bitboard import NUM_SQUARES, iter_squares
+
+# Zobrist hash 的亂數表。種子固定，server 與搜尋 process 算出的 hash 相同
+# 局面 hash 分成三部分 (GameState.zobrist)：
+#   [0] 公開資訊：雙方棋子位置 (不分好壞)、輪到誰、雙方吃掉的好鬼/壞鬼數
+#   [1] [2] 該玩家好鬼的位置 (只有自己知道)
+# 完整局面為三者 XOR；某位玩家看得到的局面 (資訊集) 為 [0] XOR 自己的那一份
+_rng = random.Random(0x47454953)
+
+
+def _keys(n):
+    return tuple(_rng.getrandbits(64) for _ in range(n))
+
+
+# 索引 0 不使用，讓玩家 ID 可直接當索引
+OCCUPIED = (None, _keys(NUM_SQUARES), _keys(NUM_SQUARES))  # OCCUPIED[owner][sq]
+GOOD_GHOST = (None, _keys(NUM_SQUARES), _keys(NUM_SQUARES))  # GOOD_GHOST[owner][sq]
+SIDE_TO_MOVE = _rng.getrandbits(64)  # 輪到玩家 2 時加入
+# CAPTURED[pid][0 好鬼 / 1 壞鬼][數量]：pid 吃掉的對手鬼數 (0~4)
+CAPTURED = (None, (_keys(5), _keys(5)), (_keys(5), _keys(5)))
+
+
+def compute(game):
+    # 從頭計算 GameState 的三部分 hash (遊戲開始時呼叫一次，之後由引擎每步更新)
+    public = SIDE_TO_MOVE if game.turn == 2 else 0
+    parts = [0, 0, 0]
+    for owner in (1, 2):
+        for sq in iter_squares(game.bb.occupied(owner)):
+            public ^= OCCUPIED[owner][sq]
+        for sq in iter_squares(game.bb.good[owner]):
+            parts[owner] ^= GOOD_GHOST[owner][sq]
+        for kind in (0, 1):
+            public ^= CAPTURED[owner][kind][game.captured[owner][kind]]
+    parts[0] = public
+    return parts